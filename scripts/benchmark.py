@@ -0,0 +1,426 @@
+"""
+    Times the hot paths of the processing scripts over a data folder, such as one written by
+    generate_synthetic_data.py, and reports throughput and peak memory per stage.
+
+    Each stage runs in its own process so that memory from one stage does not hide another's.
+    Setup, such as loading buildings for the stages that need them, is not timed. Peak memory is
+    the process high water mark while the timed part runs, including the inputs it was handed.
+    Results can be appended to a JSON lines file, and compared against an earlier run with --baseline.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from util import bingmaps, buildingfile, buildings, masks
+from util.tilestore import TileStore
+
+import generate_training_and_truth
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+MASKS_HELD = 1024
+
+
+def reset_peak_rss():
+    """
+        Resets the kernel's peak RSS for this process, where Linux allows it.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+        Peak resident memory of this process in bytes.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def building_files(data_folder):
+    return sorted((Path(data_folder) / "validated_buildings").glob("*-buildings.csv"))
+
+
+def tile_files(data_folder, zoom_level):
+    return sorted((Path(data_folder) / "map_tiles" / str(zoom_level)).glob("a*.jpeg"))
+
+
+def load_table(data_folder):
+    return buildings.concatenate_tables([buildings.load_buildings_columnar(f) for f in building_files(data_folder)])
+
+
+def sample_indices(count, sample):
+    return np.arange(count) if sample is None or sample >= count else np.linspace(0, count - 1, sample).astype(np.int64)
+
+
+# Stages. Each takes (data_folder, zoom_level, sample, scratch) and does its untimed setup, then
+# returns (items, bytes, run) where run is the function to time. Bytes may be None.
+
+def stage_quadkey_scalar(data_folder, zoom_level, sample, scratch):
+    table = load_table(data_folder)
+    rows = sample_indices(len(table.latitudes), sample)
+    latitudes = table.latitudes[rows].tolist()
+    longitudes = table.longitudes[rows].tolist()
+
+    def run():
+        for (lat, lon) in zip(latitudes, longitudes):
+            bingmaps.quadkey_containing_lat_lon(lat, lon, zoom_level)
+
+    return (len(rows), None, run)
+
+
+def stage_quadkey_batch(data_folder, zoom_level, sample, scratch):
+    table = load_table(data_folder)
+
+    def run():
+        bingmaps.quadkey_containing_lat_lon_batch(table.latitudes, table.longitudes, zoom_level)
+
+    return (len(table.latitudes), None, run)
+
+
+def stage_pixel_scalar(data_folder, zoom_level, sample, scratch):
+    table = load_table(data_folder)
+    rows = sample_indices(len(table.latitudes), sample)
+    latitudes = table.latitudes[rows].tolist()
+    longitudes = table.longitudes[rows].tolist()
+
+    def run():
+        for (lat, lon) in zip(latitudes, longitudes):
+            bingmaps.pixel_xy_relative_to_tile(lat, lon, zoom_level)
+
+    return (len(rows), None, run)
+
+
+def stage_pixel_batch(data_folder, zoom_level, sample, scratch):
+    table = load_table(data_folder)
+
+    def run():
+        bingmaps.pixel_xy_relative_to_tile_batch(table.latitudes, table.longitudes, zoom_level)
+
+    return (len(table.latitudes), None, run)
+
+
+def stage_load_csv_rows(data_folder, zoom_level, sample, scratch):
+    files = building_files(data_folder)
+    result = {}
+
+    def run():
+        count = 0
+        for f in files:
+            for building in generate_training_and_truth.load_buildings_from_file(f):
+                generate_training_and_truth.bounding_box_to_lat_lon_list(building["bounding_box"])
+                count = count + 1
+        result["items"] = count
+
+    return (result, sum(f.stat().st_size for f in files), run)
+
+
+def stage_load_csv_columnar(data_folder, zoom_level, sample, scratch):
+    files = building_files(data_folder)
+    result = {}
+
+    def run():
+        result["items"] = sum(len(buildings.load_buildings_columnar(f).way_ids) for f in files)
+
+    return (result, sum(f.stat().st_size for f in files), run)
+
+
+def stage_load_binary(data_folder, zoom_level, sample, scratch):
+    files = []
+    for f in building_files(data_folder):
+        files.append(Path(scratch) / (f.stem + ".bin"))
+        buildingfile.write_buildings_binary(files[-1], buildings.load_buildings_columnar(f))
+    result = {}
+
+    def run():
+        result["items"] = sum(len(buildingfile.read_buildings_binary(f).way_ids) for f in files)
+
+    return (result, sum(f.stat().st_size for f in files), run)
+
+
+def stage_same_tile_scalar(data_folder, zoom_level, sample, scratch):
+    table = load_table(data_folder)
+    rows = sample_indices(len(table.way_ids), sample)
+    boxes = [list(zip(table.latitudes[table.offsets[i]:table.offsets[i + 1]].tolist(),
+                      table.longitudes[table.offsets[i]:table.offsets[i + 1]].tolist())) for i in rows]
+
+    def run():
+        for box in boxes:
+            generate_training_and_truth.bounding_box_entirely_in_same_tile(box, zoom_level)
+
+    return (len(rows), None, run)
+
+
+def stage_same_tile_batch(data_folder, zoom_level, sample, scratch):
+    table = load_table(data_folder)
+
+    def run():
+        (pixel_x, pixel_y) = bingmaps.lat_lon_to_pixel_xy_batch(table.latitudes, table.longitudes, zoom_level)
+        buildings.assign_polygons_to_tiles(pixel_x, pixel_y, table.offsets, True)
+
+    return (len(table.way_ids), None, run)
+
+
+def stage_group_by_tile(data_folder, zoom_level, sample, scratch):
+    table = load_table(data_folder)
+
+    def run():
+        buildings.group_polygons_by_tile(table, zoom_level, True)
+
+    return (len(table.way_ids), None, run)
+
+
+def stage_draw_masks(data_folder, zoom_level, sample, scratch):
+    (quadkey_buildings, _) = buildings.group_polygons_by_tile(load_table(data_folder), zoom_level, True)
+    tile_polygons = list(quadkey_buildings.values())
+    tile_polygons = [tile_polygons[i] for i in sample_indices(len(tile_polygons), sample)]
+
+    def run():
+        mask = np.zeros([masks.TILE_SIZE, masks.TILE_SIZE], np.uint8)
+        for polygons in tile_polygons:
+            masks.draw_mask(polygons, mask)
+
+    return (len(tile_polygons), None, run)
+
+
+def encode_masks_stage(mask_format):
+    """
+        Encodes sample masks, cycling through the first MASKS_HELD rather than holding every one.
+    """
+    def stage(data_folder, zoom_level, sample, scratch):
+        (quadkey_buildings, _) = buildings.group_polygons_by_tile(load_table(data_folder), zoom_level, True)
+        tile_polygons = list(quadkey_buildings.values())
+        rows = sample_indices(len(tile_polygons), sample)
+        drawn = [masks.draw_mask(tile_polygons[i]) for i in rows[:MASKS_HELD]]
+        result = {}
+
+        def run():
+            result["bytes"] = sum(len(masks.encode_mask(drawn[i % len(drawn)], mask_format)) for i in range(len(rows)))
+
+        return (len(rows), result, run)
+
+    return stage
+
+
+def stage_tile_read(data_folder, zoom_level, sample, scratch):
+    files = tile_files(data_folder, zoom_level)
+    files = [files[i] for i in sample_indices(len(files), sample)]
+    result = {}
+
+    def run():
+        total = 0
+        for f in files:
+            with open(f, "rb") as tile:
+                total = total + len(tile.read())
+        result["bytes"] = total
+
+    return (len(files), result, run)
+
+
+def stage_tile_decode(data_folder, zoom_level, sample, scratch):
+    files = tile_files(data_folder, zoom_level)
+    data = []
+    for i in sample_indices(len(files), sample):
+        with open(files[i], "rb") as tile:
+            data.append(np.frombuffer(tile.read(), np.uint8))
+
+    def run():
+        for tile in data:
+            cv2.imdecode(tile, cv2.IMREAD_COLOR)
+
+    return (len(data), sum(len(d) for d in data), run)
+
+
+def read_sample_tiles(data_folder, zoom_level, sample):
+    files = tile_files(data_folder, zoom_level)
+    tiles = []
+    for i in sample_indices(len(files), sample):
+        with open(files[i], "rb") as tile:
+            tiles.append((files[i].stem[1:], tile.read()))
+    return tiles
+
+
+def stage_tile_write(data_folder, zoom_level, sample, scratch):
+    tiles = read_sample_tiles(data_folder, zoom_level, sample)
+    folder = Path(scratch) / "tiles"
+    folder.mkdir()
+
+    def run():
+        for (quadkey, data) in tiles:
+            with open(folder / ("a%s.jpeg" % quadkey), "wb") as out:
+                out.write(data)
+
+    return (len(tiles), sum(len(d) for (_, d) in tiles), run)
+
+
+def stage_tile_store_write(data_folder, zoom_level, sample, scratch):
+    tiles = read_sample_tiles(data_folder, zoom_level, sample)
+
+    def run():
+        with TileStore(Path(scratch) / "store", writable=True) as store:
+            for (quadkey, data) in tiles:
+                store.put(quadkey, data)
+
+    return (len(tiles), sum(len(d) for (_, d) in tiles), run)
+
+
+def stage_tile_store_read(data_folder, zoom_level, sample, scratch):
+    tiles = read_sample_tiles(data_folder, zoom_level, sample)
+    with TileStore(Path(scratch) / "store", writable=True) as store:
+        for (quadkey, data) in tiles:
+            store.put(quadkey, data)
+    quadkeys = [quadkey for (quadkey, _) in tiles]
+    size = sum(len(d) for (_, d) in tiles)
+    del tiles
+
+    def run():
+        with TileStore(Path(scratch) / "store") as store:
+            for quadkey in quadkeys:
+                store[quadkey]
+
+    return (len(quadkeys), size, run)
+
+
+STAGES = {
+    "quadkey_scalar": stage_quadkey_scalar,
+    "quadkey_batch": stage_quadkey_batch,
+    "pixel_scalar": stage_pixel_scalar,
+    "pixel_batch": stage_pixel_batch,
+    "load_csv_rows": stage_load_csv_rows,
+    "load_csv_columnar": stage_load_csv_columnar,
+    "load_binary": stage_load_binary,
+    "same_tile_scalar": stage_same_tile_scalar,
+    "same_tile_batch": stage_same_tile_batch,
+    "group_by_tile": stage_group_by_tile,
+    "draw_masks": stage_draw_masks,
+    "encode_masks_jpeg": encode_masks_stage("jpeg"),
+    "encode_masks_png": encode_masks_stage("png"),
+    "encode_masks_packed": encode_masks_stage("packed"),
+    "tile_read": stage_tile_read,
+    "tile_decode": stage_tile_decode,
+    "tile_write": stage_tile_write,
+    "tile_store_write": stage_tile_store_write,
+    "tile_store_read": stage_tile_store_read,
+}
+
+
+def run_stage(name, data_folder, zoom_level, sample):
+    """
+        Sets up and times one stage. Meant to run in a fresh process.
+    """
+    scratch = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        (items, size, run) = STAGES[name](data_folder, zoom_level, sample, scratch)
+        before = peak_rss()
+        exact_peak = reset_peak_rss()
+
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+
+        peak = peak_rss() if exact_peak else max(peak_rss(), before)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    items = items["items"] if isinstance(items, dict) else items
+    size = size.get("bytes") if isinstance(size, dict) else size
+
+    return {
+        "stage": name,
+        "items": items,
+        "bytes": size,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds > 0 else None,
+        "bytes_per_second": size / seconds if size and seconds > 0 else None,
+        "peak_rss_bytes": peak,
+        "exact_peak": exact_peak,
+    }
+
+
+def run_in_subprocess(name, data_folder, zoom_level, sample):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_stage, name, data_folder, zoom_level, sample).result()
+
+
+def load_baseline(path):
+    """
+        The most recent result per stage in a JSON lines file written by --output.
+    """
+    baseline = {}
+    with open(path, "r") as f:
+        for line in f:
+            result = json.loads(line)
+            baseline[result["stage"]] = result
+    return baseline
+
+
+def format_result(result, baseline=None):
+    line = "%-20s %10s %9.3fs %12.0f/s" % (result["stage"], result["items"], result["seconds"], result["items_per_second"] or 0)
+    line = line + (" %9.1f MB/s" % (result["bytes_per_second"] / 1e6) if result["bytes_per_second"] else " " * 14)
+    line = line + " %9.1f MB" % (result["peak_rss_bytes"] / 1e6)
+
+    if baseline is not None and result["stage"] in baseline and result["items_per_second"]:
+        line = line + " %7.2fx" % (result["items_per_second"] / baseline[result["stage"]]["items_per_second"])
+
+    return line
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--dataFolder", dest="dataFolder", default="data/synthetic",
+                        help="Folder holding validated_buildings/ and map_tiles/<zoom>/, as written by generate_synthetic_data.py")
+    parser.add_argument("-z", "--zoomLevel", dest="zoomLevel", type=int, default=18,
+                        help="Level of zoom of the tiles and building grouping")
+    parser.add_argument("-s", "--stages", dest="stages", default=",".join(STAGES.keys()),
+                        help="Comma separated stages to run, from: %s" % ", ".join(STAGES.keys()))
+    parser.add_argument("--sample", dest="sample", type=int, default=20000,
+                        help="Limit scalar, mask and tile stages to this many items, spread evenly over the data")
+    parser.add_argument("--label", dest="label", default=None,
+                        help="Label recorded with each result, such as a commit or machine name")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="Append results to this JSON lines file")
+    parser.add_argument("-b", "--baseline", dest="baseline", default=None,
+                        help="Show throughput relative to the latest results in this JSON lines file")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    stages = args.stages.split(",")
+    for name in stages:
+        if name not in STAGES:
+            raise ValueError("Unknown stage %s, expected one of %s" % (name, list(STAGES.keys())))
+
+    baseline = load_baseline(args.baseline) if args.baseline is not None else None
+    print("%-20s %10s %10s %14s %14s %12s%s" % ("stage", "items", "time", "throughput", "bandwidth", "peak memory",
+                                             "  vs baseline" if baseline is not None else ""))
+
+    for name in stages:
+        result = run_in_subprocess(name, args.dataFolder, args.zoomLevel, args.sample)
+        result["label"] = args.label
+        result["timestamp"] = time.time()
+        print(format_result(result, baseline))
+
+        if args.output is not None:
+            with open(args.output, "a") as out:
+                out.write(json.dumps(result) + "\n")
@@ -0,0 +1,41 @@
+"""
+    Builds a spatial index over the buildings of one or more building files, so the polygons in a
+    tile or box, or nearest a point, can be looked up without reading every building.
+"""
+
+from argparse import ArgumentParser
+from util import buildingfile, buildings, metrics
+from util.spatialindex import DEFAULT_NODE_SIZE, build_index
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--buildingFile", dest="buildingFiles", action="append", required=True,
+                        help="A csv, or binary building file, of buildings to index, may be repeated")
+    parser.add_argument("-o", "--outputFolder", dest="outputFolder", default="data/building_index",
+                        help="Write the index into this folder")
+    parser.add_argument("--nodeSize", dest="nodeSize", type=int, default=DEFAULT_NODE_SIZE,
+                        help="Number of entries under each node of the tree")
+    parser.add_argument("-p", "--precision", dest="precision", type=int, default=buildingfile.DEFAULT_PRECISION,
+                        help="Decimal places kept for coordinates; building fails rather than round")
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    exporter = metrics.metrics_from_arguments(args)
+
+    with metrics.stage("load_buildings"):
+        table = buildings.concatenate_tables([buildingfile.load_buildings(f) for f in args.buildingFiles])
+        metrics.increment("buildings_loaded", len(table.way_ids))
+
+    with metrics.stage("build_index"):
+        build_index(args.outputFolder, table, args.nodeSize, args.precision)
+
+    print("Indexed %s buildings into %s" % (len(table.way_ids), args.outputFolder))
+
+    if exporter is not None:
+        exporter.close()
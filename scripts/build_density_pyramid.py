@@ -0,0 +1,47 @@
+"""
+    Bins every building's footprint centroid by tile at a base zoom level, rolls building counts and
+    footprint areas up through every coarser level, and saves the pyramid for query_density.py.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from util import buildingfile, metrics
+from util.density import DensityPyramid
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--buildingFile", dest="buildingFiles", action="append", required=True,
+                        help="A csv, or binary building file, of buildings to count, may be repeated")
+    parser.add_argument("-z", "--zoomLevel", dest="zoomLevel", type=int, default=18,
+                        help="Finest level of zoom to count buildings at")
+    parser.add_argument("--minZoom", dest="minZoom", type=int, default=0,
+                        help="Coarsest level of zoom to roll counts up to")
+    parser.add_argument("-o", "--output", dest="output", default="data/density/pyramid.npz",
+                        help="Save the pyramid into this file")
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    exporter = metrics.metrics_from_arguments(args)
+
+    with metrics.stage("load_buildings"):
+        tables = [buildingfile.load_buildings(building_file) for building_file in args.buildingFiles]
+        metrics.increment("buildings_loaded", sum(len(table.way_ids) for table in tables))
+
+    with metrics.stage("build_density"):
+        pyramid = DensityPyramid.build(tables, args.zoomLevel, args.minZoom)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    pyramid.save(args.output)
+
+    (codes, counts, areas) = pyramid.levels[args.zoomLevel]
+    print("Counted %s buildings, %.0f square metres, in %s tiles at zoom %s, saved levels %s to %s into %s" %
+          (int(counts.sum()), areas.sum(), len(codes), args.zoomLevel, args.minZoom, args.zoomLevel, args.output))
+
+    if exporter is not None:
+        exporter.close()
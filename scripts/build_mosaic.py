@@ -0,0 +1,230 @@
+"""
+    Assembles the map tiles of a task, a project or a lat/lon box into one memory mapped mosaic,
+    with the buildings drawn into its mask layer, so a whole area can be reviewed or run through a
+    model as windows of a single raster rather than thousands of separate tiles.
+
+    Workers each map the mosaic and write their own tiles straight into it, tiles never overlapping,
+    and a mosaic that already exists with the same extent is carried on, skipping filled tiles.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tqdm import tqdm
+from util import bingmaps, buildingfile, buildings, masks, metrics, pools
+from util.mosaic import GEOREF_FILE, Mosaic
+from util.spatialindex import SpatialIndex
+from util.tilestore import TileStore
+
+import fetch_bing_tiles
+import json
+
+import cv2
+import numpy as np
+
+
+def region_quadkeys(args):
+    """
+        Quadkeys of the tasks in --taskCsv, only those in --taskId if given, or of every tile in --box.
+    """
+    if args.box is not None:
+        return bingmaps.enumerate_quadkeys_in_box(*args.box, args.zoomLevel)
+
+    tasks = []
+    for task_csv in args.taskCsvs:
+        for task in fetch_bing_tiles.load_tasks_from_file(task_csv):
+            if args.taskIds is None or task["task_id"] in args.taskIds:
+                tasks.append(task)
+
+    if len(tasks) == 0:
+        raise ValueError("No tasks found in %s" % args.taskCsvs)
+    return fetch_bing_tiles.enumerate_unique_quadkeys(tasks, args.zoomLevel)
+
+
+def tile_extent(tiles):
+    """
+        (tile_x, tile_y, tiles_wide, tiles_high) of the rectangle enclosing every (quadkey, x, y).
+    """
+    xs = [x for (_, x, _) in tiles]
+    ys = [y for (_, _, y) in tiles]
+    return (min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1)
+
+
+def open_mosaic(folder, extent, zoom_level):
+    """
+        Reopens the mosaic in folder when it has this extent and zoom level, else creates it afresh.
+    """
+    georef_path = Path(folder) / GEOREF_FILE
+
+    if georef_path.exists():
+        with open(georef_path) as georef_file:
+            georef = json.load(georef_file)
+        existing = (georef["tile_x"], georef["tile_y"], georef["tiles_wide"], georef["tiles_high"])
+
+        if existing == tuple(extent) and georef["zoom_level"] == zoom_level:
+            return Mosaic(folder, writable=True)
+        print("Replacing mosaic in %s, as its extent differs" % folder)
+
+    return Mosaic.create(folder, *extent, zoom_level)
+
+
+def extent_bounds(extent, zoom_level):
+    """
+        (min_lat, min_lon, max_lat, max_lon) of a (tile_x, tile_y, tiles_wide, tiles_high) extent.
+    """
+    (tile_x, tile_y, tiles_wide, tiles_high) = extent
+    size = bingmaps.BING_TILE_SIZE_PIXELS
+    (max_lat, min_lon) = bingmaps.pixel_xy_to_lat_lon(tile_x * size, tile_y * size, zoom_level)
+    (min_lat, max_lon) = bingmaps.pixel_xy_to_lat_lon((tile_x + tiles_wide) * size, (tile_y + tiles_high) * size, zoom_level)
+    return (min_lat, min_lon, max_lat, max_lon)
+
+
+def load_building_tables(args, extent):
+    """
+        The buildings of every --buildingFile, or just those over the extent from --buildingIndex.
+    """
+    if args.buildingIndex is not None:
+        index = SpatialIndex(args.buildingIndex)
+        return [index.subset(index.query_bbox(*extent_bounds(extent, args.zoomLevel)))]
+
+    return [buildingfile.load_buildings(building_file) for building_file in args.buildingFiles or []]
+
+
+def load_polygons(tables, zoom_level, region):
+    """
+        Tile relative building polygons for each quadkey in region, from every building table.
+    """
+    polygons = {}
+
+    for table in tables:
+        (quadkey_buildings, _) = buildings.group_polygons_by_tile(table, zoom_level)
+
+        for (quadkey, tile_polygons) in quadkey_buildings.items():
+            if quadkey in region:
+                polygons.setdefault(quadkey, []).extend(tile_polygons)
+
+    return polygons
+
+
+def read_tile(source, quadkey):
+    (kind, handle) = source
+
+    if kind == "tileStore":
+        data = handle.get(quadkey)
+    else:
+        path = handle / ("a%s.jpeg" % quadkey)
+        data = path.read_bytes() if path.exists() else None
+
+    if data is None:
+        return None
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None or image.shape[:2] != (masks.TILE_SIZE, masks.TILE_SIZE):
+        return None
+    return image
+
+
+# Each worker process maps the mosaic and opens the tile source once.
+_worker = {}
+
+
+def init_worker(mosaic_folder, source, zoom_level, with_masks):
+    (kind, path) = source
+    handle = TileStore(path) if kind == "tileStore" else Path(path) / str(zoom_level)
+
+    _worker["mosaic"] = Mosaic(mosaic_folder, writable=True)
+    _worker["source"] = (kind, handle)
+    _worker["with_masks"] = with_masks
+    _worker["mask"] = np.zeros([masks.TILE_SIZE, masks.TILE_SIZE], np.uint8)
+
+
+def process_chunk(chunk):
+    """
+        Writes each (quadkey, tile_x, tile_y, polygons) tile of the chunk. Returns (size, missing).
+    """
+    mosaic = _worker["mosaic"]
+    missing = 0
+
+    for (quadkey, tile_x, tile_y, polygons) in chunk:
+        image = read_tile(_worker["source"], quadkey)
+        if image is None:
+            missing = missing + 1
+            continue
+
+        mask = masks.draw_mask(polygons, _worker["mask"]) if _worker["with_masks"] else None
+        mosaic.put_tile(tile_x, tile_y, image, mask)
+
+    mosaic.flush()
+    return (len(chunk), missing)
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-t", "--taskCsv", dest="taskCsvs", action="append", default=None,
+                        help="Mosaic the tasks in this csv of tasks and their bounding boxes, e.g. a whole project, may be repeated")
+    parser.add_argument("--taskId", dest="taskIds", action="append", default=None,
+                        help="Only mosaic this task from --taskCsv, may be repeated")
+    parser.add_argument("--box", dest="box", type=float, nargs=4, default=None, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"),
+                        help="Mosaic every tile in this lat/lon box instead of tasks")
+    parser.add_argument("-z", "--zoomLevel", dest="zoomLevel", type=int, default=18,
+                        help="Level of zoom of the tiles")
+    parser.add_argument("-m", "--mapTiles", dest="mapTiles", default="data/map_tiles",
+                        help="Folder of per zoom folders of map tiles")
+    parser.add_argument("-s", "--tileStore", dest="tileStore", default=None,
+                        help="Read map tiles from this tile store instead")
+    parser.add_argument("-b", "--buildingFile", dest="buildingFiles", action="append", default=None,
+                        help="Draw buildings from this csv or binary building file into the mask layer, may be repeated")
+    parser.add_argument("-i", "--buildingIndex", dest="buildingIndex", default=None,
+                        help="Draw buildings looked up in this building index instead, reading only those over the mosaic")
+    parser.add_argument("-o", "--outputFolder", dest="outputFolder", default="data/mosaic",
+                        help="Write the mosaic into this folder")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="Number of processes writing tiles into the mosaic")
+    parser.add_argument("--chunkSize", dest="chunkSize", type=int, default=256,
+                        help="Number of tiles handed to a worker at a time")
+    metrics.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    if (args.taskCsvs is None) == (args.box is None):
+        parser.error("Expected exactly one of --taskCsv or --box")
+    if args.buildingFiles is not None and args.buildingIndex is not None:
+        parser.error("Expected at most one of --buildingFile or --buildingIndex")
+    return args
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    exporter = metrics.metrics_from_arguments(args)
+
+    with metrics.stage("enumerate_tiles"):
+        tiles = [(q,) + bingmaps.quadkey_to_tile_xy(q)[:2] for q in region_quadkeys(args)]
+        extent = tile_extent(tiles)
+
+    with metrics.stage("load_buildings"):
+        region = set(q for (q, _, _) in tiles)
+        polygons = load_polygons(load_building_tables(args, extent), args.zoomLevel, region)
+
+    mosaic = open_mosaic(args.outputFolder, extent, args.zoomLevel)
+    pending = [(q, x, y, polygons.get(q, [])) for (q, x, y) in tiles if not mosaic.is_filled(x, y)]
+    mosaic.close()
+
+    # Row by row, so each chunk writes one run of neighbouring tiles in the mosaic files
+    pending.sort(key=lambda tile: (tile[2], tile[1]))
+    source = ("tileStore", args.tileStore) if args.tileStore is not None else ("tiles", args.mapTiles)
+    initargs = (args.outputFolder, source, args.zoomLevel, args.buildingFiles is not None or args.buildingIndex is not None)
+    chunks = pools.chunk_list(pending, args.chunkSize)
+    missing = 0
+
+    with metrics.stage("fill_mosaic"):
+        with tqdm(total=len(pending), desc="tiles") as progress:
+            for (size, chunk_missing) in pools.process_chunks(chunks, args.workers, init_worker, initargs, process_chunk):
+                missing = missing + chunk_missing
+                metrics.increment("mosaic_tiles_filled", size - chunk_missing)
+                metrics.increment("tiles_skipped", chunk_missing, reason="missing_tile")
+                progress.update(size)
+
+    print("Filled %s of %s tiles into a %sx%s tile mosaic in %s, %s tiles missing" %
+          (len(pending) - missing, len(tiles), extent[2], extent[3], args.outputFolder, missing))
+
+    if exporter is not None:
+        exporter.close()
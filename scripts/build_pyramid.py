@@ -0,0 +1,290 @@
+"""
+    Builds lower zoom levels of map tiles, or of training tiles and masks, from a base zoom level,
+    by stitching each parent's four children and halving them. No tile is fetched or rasterized
+    again, and output goes into the same folders or stores as the input, one level at a time.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tqdm import tqdm
+from util import masks, metrics, pools, pyramid
+from util.tilestore import TileStore
+
+import cv2
+import numpy as np
+
+
+class FolderLayout:
+    """
+        Tiles in <tile_folder>/<zoom>/a<quadkey>.jpeg as fetch_bing_tiles.py saves them, or flat in
+        one folder as the Keras train/images folder holds them, with masks alongside in a flat
+        mask folder of mask_format files, or packed mask shards.
+    """
+
+    def __init__(self, tile_folder, per_zoom=True, mask_folder=None, mask_format=None, writable=False):
+        self.tile_folder = Path(tile_folder)
+        self.per_zoom = per_zoom
+        self.mask_folder = Path(mask_folder) if mask_folder is not None else None
+        self.mask_format = mask_format
+        self.mask_reader = None
+        self.mask_writer = None
+
+        if self.mask_folder is not None and mask_format == "packed":
+            if writable:
+                self.mask_writer = masks.PackedMaskWriter(self.mask_folder)
+            elif (self.mask_folder / masks.SHARD_INDEX_FILE).exists():
+                self.mask_reader = masks.PackedMaskReader(self.mask_folder)
+
+    def _tile_path(self, quadkey):
+        folder = self.tile_folder / str(len(quadkey)) if self.per_zoom else self.tile_folder
+        return folder / ("a%s.jpeg" % quadkey)
+
+    def _mask_path(self, quadkey):
+        return self.mask_folder / ("a%s%s" % (quadkey, masks.mask_extension(self.mask_format)))
+
+    def quadkeys(self, level):
+        if self.per_zoom:
+            paths = (self.tile_folder / str(level)).glob("a*.jpeg")
+        else:
+            paths = self.tile_folder.glob("a%s.jpeg" % ("[0-3]" * level))
+        return sorted(path.stem[1:] for path in paths)
+
+    def has_masks(self):
+        return self.mask_folder is not None
+
+    def __contains__(self, quadkey):
+        return self._tile_path(quadkey).exists()
+
+    def read(self, quadkey):
+        path = self._tile_path(quadkey)
+        tile = path.read_bytes() if path.exists() else None
+        mask = None
+
+        if self.mask_reader is not None:
+            mask = self.mask_reader.get_packed(quadkey)
+        elif self.mask_folder is not None and self.mask_format != "packed" and self._mask_path(quadkey).exists():
+            mask = self._mask_path(quadkey).read_bytes()
+
+        return (tile, mask)
+
+    def write(self, quadkey, tile, mask=None):
+        path = self._tile_path(quadkey)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        if mask is not None:
+            if self.mask_writer is not None:
+                self.mask_writer.put(quadkey, mask)
+            else:
+                self._mask_path(quadkey).write_bytes(mask)
+
+        # The tile goes last, as its presence is what marks the quadkey done
+        path.write_bytes(tile)
+
+    def close(self):
+        if self.mask_reader is not None:
+            self.mask_reader.close()
+        if self.mask_writer is not None:
+            self.mask_writer.close()
+
+
+class StoreLayout:
+    """
+        Tiles in a tile store, with masks of mask_format in a second store when given, as
+        generate_training_and_truth.py --outputStore writes them.
+    """
+
+    def __init__(self, tile_store, mask_store=None, mask_format=None, writable=False):
+        self.tiles = TileStore(tile_store, writable)
+        self.masks = TileStore(mask_store, writable) if mask_store is not None else None
+        self.mask_format = mask_format
+
+    def quadkeys(self, level):
+        return self.tiles.quadkeys(level)
+
+    def has_masks(self):
+        return self.masks is not None
+
+    def __contains__(self, quadkey):
+        return quadkey in self.tiles
+
+    def read(self, quadkey):
+        return (self.tiles.get(quadkey), self.masks.get(quadkey) if self.masks is not None else None)
+
+    def write(self, quadkey, tile, mask=None):
+        if mask is not None:
+            self.masks.put(quadkey, mask)
+        self.tiles.put(quadkey, tile)
+
+    def close(self):
+        self.tiles.close()
+        if self.masks is not None:
+            self.masks.close()
+
+
+def open_layout(layout, writable=False):
+    """
+        Opens a layout from its picklable (kind, path, mask_format) description.
+    """
+    (kind, path, mask_format) = layout
+
+    if kind == "tiles":
+        return FolderLayout(path, per_zoom=True, writable=writable)
+    if kind == "tileStore":
+        return StoreLayout(path, writable=writable)
+    if kind == "training":
+        mask_folder = Path(path) / "mask" / ("packed" if mask_format == "packed" else "images")
+        return FolderLayout(Path(path) / "train" / "images", False, mask_folder, mask_format, writable)
+    if kind == "trainingStore":
+        return StoreLayout(Path(path) / "train", Path(path) / "mask", mask_format, writable)
+
+    raise ValueError("Unknown layout %s" % kind)
+
+
+def decode_tile(data):
+    if data is None:
+        return None
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None or image.shape[:2] != (pyramid.TILE_SIZE, pyramid.TILE_SIZE):
+        return None
+    return image
+
+
+def build_parent(quadkey, source, fallback, mask_format, mask_reduction, min_children):
+    """
+        Returns (quadkey, tile bytes, mask bytes or None), or None with fewer than min_children.
+        A child missing from source but found in fallback is taken as imagery without buildings.
+    """
+    tiles = []
+    child_masks = []
+
+    for child in pyramid.child_quadkeys(quadkey):
+        (tile, mask) = source.read(child)
+
+        if tile is None and fallback is not None:
+            (tile, _) = fallback.read(child)
+            mask = None
+
+        tiles.append(decode_tile(tile))
+        child_masks.append(masks.decode_mask(mask, mask_format) if mask is not None else None)
+
+    if sum(tile is not None for tile in tiles) < min_children:
+        return None
+
+    tile = cv2.imencode(".jpeg", pyramid.downsample_tile(tiles))[1].tobytes()
+    if not source.has_masks():
+        return (quadkey, tile, None)
+
+    mask = pyramid.downsample_mask(child_masks, mask_reduction)
+    return (quadkey, tile, masks.encode_mask(mask, mask_format))
+
+
+# Each worker process opens its own read only handles on the layouts.
+_worker = {}
+
+
+def init_worker(layout, fallback_layout, mask_reduction, min_children):
+    _worker["source"] = open_layout(layout)
+    _worker["fallback"] = open_layout(fallback_layout) if fallback_layout is not None else None
+    _worker["mask_format"] = layout[2]
+    _worker["mask_reduction"] = mask_reduction
+    _worker["min_children"] = min_children
+
+
+def process_chunk(parents):
+    results = []
+    for quadkey in parents:
+        result = build_parent(quadkey, _worker["source"], _worker["fallback"], _worker["mask_format"],
+                              _worker["mask_reduction"], _worker["min_children"])
+        if result is not None:
+            results.append(result)
+    return (len(parents), results)
+
+
+def build_level(level, layout, fallback_layout, output, workers, chunk_size, mask_reduction, min_children):
+    """
+        Writes every missing level tile whose children are at level + 1. Returns the number written.
+    """
+    parents = [q for q in pyramid.parent_quadkeys(output.quadkeys(level + 1)) if q not in output]
+    chunks = pools.chunk_list(parents, chunk_size)
+    initargs = (layout, fallback_layout, mask_reduction, min_children)
+    written = 0
+
+    with tqdm(total=len(parents), desc="zoom %s" % level) as progress:
+        for (size, results) in pools.process_chunks(chunks, workers, init_worker, initargs, process_chunk):
+            for (quadkey, tile, mask) in results:
+                output.write(quadkey, tile, mask)
+
+            written = written + len(results)
+            metrics.increment("pyramid_tiles_written", len(results), level=level)
+            metrics.increment("pyramid_tiles_skipped", size - len(results), level=level)
+            progress.update(size)
+
+    return written
+
+
+def get_layout(args):
+    layouts = [("tiles", args.mapTiles, None), ("tileStore", args.tileStore, None),
+               ("training", args.trainingFolder, args.maskFormat), ("trainingStore", args.trainingStore, args.maskFormat)]
+    chosen = [layout for layout in layouts if layout[1] is not None]
+
+    if len(chosen) != 1:
+        raise ValueError("Expected exactly one of --mapTiles, --tileStore, --trainingFolder or --trainingStore")
+    return chosen[0]
+
+
+def get_fallback_layout(path):
+    if path is None:
+        return None
+    return ("tileStore", path, None) if (Path(path) / "tiles.idx").exists() else ("tiles", path, None)
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-z", "--baseZoom", dest="baseZoom", type=int,
+                        help="Zoom level of the tiles to build from")
+    parser.add_argument("--minZoom", dest="minZoom", type=int,
+                        help="Lowest zoom level to build")
+    parser.add_argument("-m", "--mapTiles", dest="mapTiles", default=None,
+                        help="Build map tiles in this folder of per zoom folders")
+    parser.add_argument("-s", "--tileStore", dest="tileStore", default=None,
+                        help="Build map tiles in this tile store")
+    parser.add_argument("-o", "--trainingFolder", dest="trainingFolder", default=None,
+                        help="Build tiles and masks in this training folder of train/ and mask/ folders")
+    parser.add_argument("--trainingStore", dest="trainingStore", default=None,
+                        help="Build tiles and masks in this folder of train/ and mask/ tile stores")
+    parser.add_argument("-f", "--maskFormat", dest="maskFormat", choices=masks.MASK_FORMATS, default="jpeg",
+                        help="Format the training masks were written in")
+    parser.add_argument("--fallbackTiles", dest="fallbackTiles", default=None,
+                        help="Map tile folder or store to take children without buildings from, as training folders only hold tiles with buildings")
+    parser.add_argument("--minChildren", dest="minChildren", type=int, default=1, choices=[1, 2, 3, 4],
+                        help="Only build parents with at least this many children found, missing children are left black")
+    parser.add_argument("--maskReduction", dest="maskReduction", choices=pyramid.MASK_REDUCTIONS, default="majority",
+                        help="Set a parent mask pixel when the majority, or any, of its 4 child pixels are set")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="Number of processes stitching tiles")
+    parser.add_argument("--chunkSize", dest="chunkSize", type=int, default=256,
+                        help="Number of parent tiles handed to a worker at a time")
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    exporter = metrics.metrics_from_arguments(args)
+
+    layout = get_layout(args)
+    fallback_layout = get_fallback_layout(args.fallbackTiles)
+    output = open_layout(layout, writable=True)
+
+    for level in range(args.baseZoom - 1, args.minZoom - 1, -1):
+        with metrics.stage("zoom_%s" % level):
+            written = build_level(level, layout, fallback_layout, output, args.workers, args.chunkSize,
+                                  args.maskReduction, args.minChildren)
+        print("Written %s tiles at zoom %s" % (written, level))
+
+    output.close()
+
+    if exporter is not None:
+        exporter.close()
@@ -0,0 +1,187 @@
+"""
+    Checks batched Overpass building lookups against a local stand-in Overpass endpoint, from
+    util.standins, that serves canned JSON for a grid of tasks:
+
+        group_tasks puts every task in exactly one group, in task file order of first tasks
+        batched lookups give the same buildings per task as querying each task alone, in task
+        file order, with 429 and 5xx responses along the way
+        split_polygons_by_task gives a building on a task boundary to one task only, and drops
+        one outside every task
+        a merged query answered with a timeout remark is split into per task queries, and its
+        partial response is never cached
+        a single task answered with a timeout remark is reported as failed
+
+    Exits with status 1 if any check fails.
+"""
+
+from argparse import ArgumentParser
+from util import fetching, httpcache, standins
+
+import sys
+import tempfile
+
+import collect_building_geometries
+
+ORIGIN_LAT = 16.8
+ORIGIN_LON = 94.7
+TASK_SIZE = 0.005
+BUILDING_SPACING = 0.0005
+
+
+def grid_tasks(rows, columns, project_id=1):
+    """
+        Task rows as load_tasks_from_file yields them, in row major order.
+    """
+    tasks = []
+    for row in range(rows):
+        for column in range(columns):
+            tasks.append({
+                "project_id": str(project_id),
+                "task_id": str(len(tasks) + 1),
+                "min_lat": str(round(ORIGIN_LAT + row * TASK_SIZE, 7)),
+                "min_lon": str(round(ORIGIN_LON + column * TASK_SIZE, 7)),
+                "max_lat": str(round(ORIGIN_LAT + (row + 1) * TASK_SIZE, 7)),
+                "max_lon": str(round(ORIGIN_LON + (column + 1) * TASK_SIZE, 7)),
+                "geometry": None
+            })
+    return tasks
+
+
+def grid_buildings(rows, columns):
+    """
+        A small triangle every BUILDING_SPACING degrees, each well inside one task.
+    """
+    per_task = int(round(TASK_SIZE / BUILDING_SPACING))
+    buildings = []
+    node_id = 1
+
+    for i in range(rows * per_task):
+        for j in range(columns * per_task):
+            lat = round(ORIGIN_LAT + i * BUILDING_SPACING + 0.0001, 7)
+            lon = round(ORIGIN_LON + j * BUILDING_SPACING + 0.0001, 7)
+            nodes = [(node_id, lat, lon), (node_id + 1, round(lat + 0.00005, 7), lon), (node_id + 2, lat, round(lon + 0.00005, 7))]
+            buildings.append((1000 + len(buildings), nodes + nodes[:1]))
+            node_id = node_id + 3
+
+    return buildings
+
+
+def look_up(url, tasks, max_tasks_per_query, workers=3):
+    """
+        [(task_id, polygons or None, error)] in the order in_task_order yields them.
+    """
+    groups = collect_building_geometries.group_tasks(tasks, TASK_SIZE * TASK_SIZE * 4.5, max_tasks_per_query)
+    lookups = collect_building_geometries.find_buildings_for_groups(groups, workers, url + "api/interpreter", max_attempts=5)
+    return [(task["task_id"], polygons, error) for (task, polygons, _, error) in collect_building_geometries.in_task_order(lookups, tasks)]
+
+
+def check_groups(tasks, failures):
+    positions = dict((id(task), i) for (i, task) in enumerate(tasks))
+
+    for max_tasks_per_query in [1, 2, 4, 9]:
+        groups = collect_building_geometries.group_tasks(tasks, TASK_SIZE * TASK_SIZE * 4.5, max_tasks_per_query)
+        grouped = sorted(positions[id(task)] for (_, group) in groups for task in group)
+        firsts = [positions[id(group[0])] for (_, group) in groups]
+
+        if grouped != list(range(len(tasks))):
+            failures.append("group_tasks(%s) does not put every task in exactly one group" % max_tasks_per_query)
+        if any(len(group) > max_tasks_per_query for (_, group) in groups):
+            failures.append("group_tasks(%s) made a group that is too large" % max_tasks_per_query)
+        if firsts != sorted(firsts):
+            failures.append("group_tasks(%s) groups are not in task file order" % max_tasks_per_query)
+
+
+def check_batching(tasks, buildings, failures):
+    with standins.OverpassServer(buildings) as server:
+        alone = look_up(server.url, tasks, 1)
+
+    with standins.OverpassServer(buildings, faults=[("status", 429, 0), ("status", 504, None), ("status", 502, None)]) as server:
+        batched = look_up(server.url, tasks, 4)
+        queries = server.requests["all"]
+
+    if [task["task_id"] for task in tasks] != [task_id for (task_id, _, _) in batched]:
+        failures.append("batched lookups are not in task file order")
+    if any(error is not None for (_, _, error) in alone + batched):
+        failures.append("lookups failed: %s" % [(task_id, error) for (task_id, _, error) in alone + batched if error is not None])
+    if alone != batched:
+        failures.append("batched lookups differ from per task lookups")
+    if queries >= len(tasks):
+        failures.append("batched lookups made %s requests for %s tasks" % (queries, len(tasks)))
+
+
+def check_split(tasks, failures):
+    (first, second) = (tasks[0], tasks[1])
+    boundary_lon = float(first["max_lon"])
+    lat = float(first["min_lat"]) + 0.001
+
+    # Mostly in the second task, reaching back over the boundary into the first
+    straddling = [1, lat, boundary_lon - 0.0001, lat, boundary_lon + 0.0004, lat + 0.0001, boundary_lon + 0.0004]
+    outside = [2, lat + 1, boundary_lon, lat + 1, boundary_lon + 0.0001, lat + 1.0001, boundary_lon]
+
+    (polygons_per_task, dropped) = collect_building_geometries.split_polygons_by_task([straddling, outside], [first, second])
+    if polygons_per_task != [[], [straddling]] or dropped != 1:
+        failures.append("split_polygons_by_task gave %s, dropping %s" % (polygons_per_task, dropped))
+
+
+def check_timeouts(tasks, buildings, failures):
+    with tempfile.TemporaryDirectory() as folder:
+        cache = httpcache.HttpCache(folder)
+        fetching.set_default_cache(cache)
+
+        try:
+            with standins.OverpassServer(buildings, max_area=TASK_SIZE * TASK_SIZE * 1.5) as server:
+                alone = look_up(server.url, tasks, 1)
+                split = look_up(server.url, tasks, 4)
+                merged_queries = [key for key in server.requests if key != "all" and server.requests[key] > 0
+                                  and (key[2] - key[0]) * (key[3] - key[1]) > server.max_area]
+                cached = len(list(cache.entries.glob("*.json")))
+
+            with standins.OverpassServer(buildings, max_area=0) as server:
+                timed_out = look_up(server.url, tasks[:1], 1)
+        finally:
+            fetching.set_default_cache(None)
+
+    if alone != split:
+        failures.append("merged queries that timed out were not split into the same per task lookups")
+    if len(merged_queries) == 0:
+        failures.append("no merged query reached the stand-in")
+    if cached != len(tasks):
+        failures.append("expected %s cached responses, one per task, found %s" % (len(tasks), cached))
+    if timed_out[0][2] is None:
+        failures.append("a single task that timed out was not reported as failed")
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("--rows", dest="rows", type=int, default=4,
+                        help="Rows of tasks in the stand-in grid")
+    parser.add_argument("--columns", dest="columns", type=int, default=5,
+                        help="Columns of tasks in the stand-in grid")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    tasks = grid_tasks(args.rows, args.columns)
+    buildings = grid_buildings(args.rows, args.columns)
+
+    checks = [
+        ("group_tasks", lambda failures: check_groups(tasks, failures)),
+        ("batching", lambda failures: check_batching(tasks, buildings, failures)),
+        ("split_polygons_by_task", lambda failures: check_split(tasks, failures)),
+        ("timeouts", lambda failures: check_timeouts(tasks, buildings, failures)),
+    ]
+
+    failed = False
+    for (name, check) in checks:
+        failures = []
+        check(failures)
+
+        print("%s: %s failures" % (name, len(failures)))
+        for failure in failures:
+            print("  FAIL %s" % failure)
+        failed = failed or len(failures) > 0
+
+    sys.exit(1 if failed else 0)
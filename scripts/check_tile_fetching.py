@@ -0,0 +1,112 @@
+"""
+    Checks tile fetching against a local stand-in tile server, from util.standins, that answers
+    with 429 and 5xx responses, drops connections part way through a body, and serves truncated
+    tiles and Bing's placeholders. Every case is run through fetch_bing_tiles.fetch_tiles into a
+    folder and into a tile store, checking the outcome, how often the tile was requested, what
+    was saved and that no partial file is left behind.
+
+    Exits with status 1 if any check fails.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from util import standins, tileindex
+from util.tileindex import TileIndex
+from util.tilestore import TileStore
+
+import sys
+import tempfile
+import urllib
+
+import numpy as np
+
+import fetch_bing_tiles
+import generate_synthetic_data
+
+MAX_ATTEMPTS = 3
+
+# (name, faults, expected status or None for a failure, expected requests)
+CASES = [
+    ("whole", [], tileindex.OK, 1),
+    ("rate limited", [("status", 429, 0)], tileindex.OK, 2),
+    ("server errors", [("status", 503, None), ("status", 500, None)], tileindex.OK, 3),
+    ("too many server errors", [("status", 504, None)] * MAX_ATTEMPTS, None, MAX_ATTEMPTS),
+    ("dropped mid body", [("drop", 2000)], tileindex.OK, 2),
+    ("always dropped", [("drop", 2000)] * MAX_ATTEMPTS, None, MAX_ATTEMPTS),
+    ("truncated once", [("truncated", 2000)], tileindex.OK, 2),
+    ("always truncated", [("truncated", 2000)] * MAX_ATTEMPTS, None, MAX_ATTEMPTS),
+    ("placeholder", [("placeholder",)], tileindex.PLACEHOLDER, 1),
+]
+
+
+def case_quadkeys(count, zoom_level=18):
+    return ["%0*d" % (zoom_level, int(np.base_repr(i + 1, 4))) for i in range(count)]
+
+
+def run_cases(folder, tiles, faults, expected, workers, use_store):
+    """
+        Fetches every case's tile into folder, or a tile store there. Returns a list of failures.
+    """
+    failures = []
+    store = TileStore(folder, writable=True) if use_store else None
+
+    with standins.TileServer(tiles, faults) as server, TileIndex(folder, writable=True) as index:
+        url = urllib.parse.urlparse(server.url)
+        outcomes = dict((quadkey, (status, error)) for (quadkey, status, error)
+                        in fetch_bing_tiles.fetch_tiles(list(tiles), url, folder, workers, MAX_ATTEMPTS, None, store, index))
+
+        for (quadkey, (name, expected_status, expected_requests)) in expected.items():
+            (status, error) = outcomes[quadkey]
+            requests = server.requests.get(quadkey, 0)
+            saved = quadkey in store if use_store else (folder / ("a%s.jpeg" % quadkey)).exists()
+
+            if status != expected_status:
+                failures.append("%s: expected %s, got %s (%s)" % (name, expected_status, status, error))
+            if requests != expected_requests:
+                failures.append("%s: expected %s requests, got %s" % (name, expected_requests, requests))
+            if saved != (expected_status == tileindex.OK):
+                failures.append("%s: tile %s" % (name, "saved" if saved else "not saved"))
+            if saved and (store.get(quadkey) if use_store else (folder / ("a%s.jpeg" % quadkey)).read_bytes()) != tiles[quadkey]:
+                failures.append("%s: saved tile differs from the one served" % name)
+
+    if store is not None:
+        store.close()
+
+    partials = list(folder.glob("*.partial"))
+    if len(partials) > 0:
+        failures.append("left partial files behind: %s" % [p.name for p in partials])
+
+    return failures
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=4,
+                        help="Number of tiles to fetch concurrently")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+                        help="Seed for the stand-in tiles' content")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    variants = generate_synthetic_data.tile_variants(np.random.default_rng(args.seed), len(CASES))
+    quadkeys = case_quadkeys(len(CASES))
+
+    tiles = dict(zip(quadkeys, variants))
+    faults = dict((quadkey, case[1]) for (quadkey, case) in zip(quadkeys, CASES))
+    expected = dict((quadkey, (name, status, requests)) for (quadkey, (name, _, status, requests)) in zip(quadkeys, CASES))
+
+    failed = False
+    for use_store in [False, True]:
+        with tempfile.TemporaryDirectory() as folder:
+            failures = run_cases(Path(folder), tiles, faults, expected, args.workers, use_store)
+
+        print("%s: %s cases, %s failures" % ("tile store" if use_store else "tile folder", len(CASES), len(failures)))
+        for failure in failures:
+            print("  FAIL %s" % failure)
+        failed = failed or len(failures) > 0
+
+    sys.exit(1 if failed else 0)
@@ -1,9 +1,15 @@
 from argparse import ArgumentParser
+from itertools import chain
+from math import floor, sqrt
 from pathlib import Path
+from util import fetching, httpcache, metrics, overpass, polygons
+from util.buildingfile import BuildingBinaryWriter
 
 import csv
 import json
-import requests
+import numpy as np
+
+OVERPASS_URL = "https://overpass.kumi.systems/api/interpreter"
 
 
 def get_bounding_box(element, node_coords):
@@ -45,9 +51,9 @@ def convert_to_polygons(raw_buildings):
     return ways
 
 
-def overpass_find_buildings(task):
-    data = """
-        [out:json][timeout:25];
+def overpass_query(task, query_timeout=25):
+    return """
+        [out:json][timeout:%s];
         (
         way[building=yes](%s, %s, %s, %s);
         node(w);
@@ -55,19 +61,177 @@ def overpass_find_buildings(task):
 
         out body;
         >;
-    """ % (task["min_lat"], task["min_lon"], task["max_lat"], task["max_lon"])
+    """ % (query_timeout, task["min_lat"], task["min_lon"], task["max_lat"], task["max_lon"])
+
+
+def overpass_find_buildings(task, url=OVERPASS_URL, query_timeout=25, session=None, max_attempts=1, rate_limiter=None):
+    """
+        Finds buildings within the task's bounding box. Any dict with min/max lat/lon will do,
+        including the merged bounding box of a task group.
+    """
+    r = fetching.request_with_retries("POST", url, session=session, max_attempts=max_attempts, rate_limiter=rate_limiter,
+                                      data=overpass_query(task, query_timeout), timeout=query_timeout + 30)
+    response = r.json()
+    overpass.check_remark(response.get("remark"))
+    return response
+
+
+def overpass_find_building_polygons(task, url=OVERPASS_URL, query_timeout=25, session=None, max_attempts=1, rate_limiter=None):
+    """
+        As overpass_find_buildings then convert_to_polygons, but parses the response as it streams in
+        rather than building the whole JSON tree and a dict per node.
+    """
+    r = fetching.request_with_retries("POST", url, session=session, max_attempts=max_attempts, rate_limiter=rate_limiter,
+                                      data=overpass_query(task, query_timeout), timeout=query_timeout + 30, stream=True)
+
+    return [[way_id] + coordinates.ravel().tolist()
+            for (way_id, coordinates) in overpass.iterate_way_coordinates(r.iter_content(chunk_size=65536))]
+
+
+def group_tasks(tasks, max_query_area, max_tasks_per_query):
+    """
+        Merges neighbouring tasks into groups to query together. Tasks are binned into a grid of cells
+        max_query_area square degrees in size, and each cell split into groups of at most
+        max_tasks_per_query. Returns a list of (bounding box, tasks), ordered by each group's first
+        task in the task file, so writing out in task file order holds back as few groups as possible.
+    """
+    if max_tasks_per_query <= 1:
+        return [(task, [task]) for task in tasks]
+
+    cell_size = sqrt(max_query_area)
+    cells = {}
+
+    for (position, task) in enumerate(tasks):
+        cell = (floor(float(task["min_lat"]) / cell_size), floor(float(task["min_lon"]) / cell_size))
+        cells.setdefault(cell, []).append((position, task))
+
+    groups = []
+    for cell_tasks in cells.values():
+        for i in range(0, len(cell_tasks), max_tasks_per_query):
+            (positions, members) = zip(*cell_tasks[i:i + max_tasks_per_query])
+            members = list(members)
+            bounding_box = {
+                "min_lat": min([float(t["min_lat"]) for t in members]),
+                "min_lon": min([float(t["min_lon"]) for t in members]),
+                "max_lat": max([float(t["max_lat"]) for t in members]),
+                "max_lon": max([float(t["max_lon"]) for t in members])
+            }
+            groups.append((positions[0], bounding_box, members))
+
+    return [(bounding_box, members) for (_, bounding_box, members) in sorted(groups, key=lambda group: group[0])]
+
+
+def split_polygons_by_task(building_polygons, tasks):
+    """
+        Attributes each building to the first task whose bounding box, or geometry for irregular
+        tasks, contains its centroid. Returns (a list of building polygons per task, the number of
+        buildings in none of the tasks). A lone rectangular task keeps everything its query returned,
+        as querying it alone always has.
+    """
+    if len(tasks) == 1 and tasks[0].get("geometry") is None:
+        return ([building_polygons], 0)
+
+    if len(building_polygons) == 0:
+        return ([[] for task in tasks], 0)
+
+    lengths = np.array([(len(building) - 1) // 2 for building in building_polygons])
+    coordinates = np.fromiter(chain.from_iterable(building[1:] for building in building_polygons),
+                              dtype=np.float64, count=2 * lengths.sum()).reshape(-1, 2)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    centroids = np.add.reduceat(coordinates, starts, axis=0) / lengths[:, None]
+
+    boxes = np.array([[float(t["min_lat"]), float(t["min_lon"]), float(t["max_lat"]), float(t["max_lon"])] for t in tasks])
+    inside = ((centroids[:, None, 0] >= boxes[None, :, 0]) & (centroids[:, None, 1] >= boxes[None, :, 1]) &
+              (centroids[:, None, 0] <= boxes[None, :, 2]) & (centroids[:, None, 1] <= boxes[None, :, 3]))
+
+    for (i, task) in enumerate(tasks):
+        if task.get("geometry") is not None:
+            inside[:, i] &= polygons.points_in_geometry(centroids[:, 0], centroids[:, 1], task["geometry"])
+
+    owner = np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+
+    polygons_per_task = [[] for task in tasks]
+    for (building, task_index) in zip(building_polygons, owner):
+        if task_index >= 0:
+            polygons_per_task[task_index].append(building)
+
+    return (polygons_per_task, int(np.count_nonzero(owner < 0)))
+
 
-    r = requests.post("https://overpass.kumi.systems/api/interpreter", data=data)
+def find_buildings_for_groups(groups, workers, url=OVERPASS_URL, query_timeout=25, max_attempts=5, rate_limiter=None):
+    """
+        Queries each task group concurrently. Yields (group, polygons per task, dropped, error)
+        in group order, however the queries complete. A merged query that Overpass fails with a
+        runtime error, e.g. a timeout, is split into one query per task.
+    """
+    def query(index):
+        (bounding_box, tasks) = groups[index]
+        session = fetching.thread_session(pool_size=1)
+
+        try:
+            building_polygons = overpass_find_building_polygons(bounding_box, url, query_timeout, session, max_attempts, rate_limiter)
+        except overpass.OverpassError:
+            if len(tasks) == 1:
+                raise
+
+            metrics.increment("overpass_groups_split", reason="runtime_error")
+            results = [split_polygons_by_task(overpass_find_building_polygons(task, url, query_timeout, session, max_attempts, rate_limiter), [task])
+                       for task in tasks]
+            return ([polygons_per_task[0] for (polygons_per_task, _) in results], sum([dropped for (_, dropped) in results]))
+
+        return split_polygons_by_task(building_polygons, tasks)
+
+    finished = {}
+    next_index = 0
+
+    for (index, result, error) in fetching.bounded_map(query, range(len(groups)), workers):
+        finished[index] = (result, error)
+
+        while next_index in finished:
+            (result, error) = finished.pop(next_index)
+            (polygons_per_task, dropped) = result if error is None else (None, 0)
+
+            if error is None:
+                metrics.increment("tasks_done", len(polygons_per_task))
+                metrics.increment("buildings_found", sum(len(p) for p in polygons_per_task))
+                metrics.increment("buildings_dropped", dropped, reason="outside_tasks")
+            else:
+                metrics.increment("tasks_failed", len(groups[next_index][1]))
+            yield (groups[next_index], polygons_per_task, dropped, error)
+            next_index = next_index + 1
+
+
+def in_task_order(lookups, tasks):
+    """
+        Re-yields the results of find_buildings_for_groups per task, as (task, building polygons,
+        dropped, error), in task file order, with a group's dropped buildings counted against its
+        first task. Tasks are held back until every task before them has finished, since merged
+        groups interleave across the file.
+    """
+    positions = {id(task): position for (position, task) in enumerate(tasks)}
+    finished = {}
+    next_position = 0
+
+    for ((bounding_box, group), polygons_per_task, dropped, error) in lookups:
+        for (i, task) in enumerate(group):
+            building_polygons = polygons_per_task[i] if error is None else None
+            finished[positions[id(task)]] = (task, building_polygons, dropped if i == 0 else 0, error)
+
+        while next_position in finished:
+            yield finished.pop(next_position)
+            next_position = next_position + 1
 
-    if r.status_code == requests.codes.ok:
-        return r.json()
-    else:
-        r.raise_for_status()
 
 def load_tasks_from_file(taskCsv):
+    """
+        Yields each task's row, with the geometry of irregular tasks from beside the csv.
+    """
+    geometries = polygons.load_task_geometries(taskCsv)
+
     with open(taskCsv, 'r') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
+            row["geometry"] = geometries.get(row["task_id"])
             yield row
         
 
@@ -78,8 +242,9 @@ def write_polygons_to_csv(project_id, task_id, building_polygons, out):
         out.write("\n")
 
 
-def get_output_file(project_id, output_folder):
-    filename = "%s-buildings.csv" % (project_id, )
+def get_output_file(project_id, output_folder, output_format="csv"):
+    extension = "bin" if output_format == "binary" else "csv"
+    filename = "%s-buildings.%s" % (project_id, extension)
     path = Path(output_folder)
     path.mkdir(parents=True, exist_ok=True) 
     return path / filename 
@@ -91,6 +256,24 @@ def parse_arguments():
                         help="A csv of tasks and their bounding boxes")
     parser.add_argument("-o", "--outputFolder", dest="outputFolder",
                         help="Save results into this folder", default="data/validated_buildings")
+    parser.add_argument("-f", "--format", dest="format", choices=["csv", "binary"], default="csv",
+                        help="Write buildings as csv, or as a compact binary file that any later stage can read")
+    parser.add_argument("-u", "--overpassUrl", dest="overpassUrl", default=OVERPASS_URL,
+                        help="Overpass API interpreter endpoint")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="Number of Overpass queries to run concurrently")
+    parser.add_argument("-r", "--rateLimit", dest="rateLimit", type=float, default=None,
+                        help="Maximum Overpass queries per second across all workers")
+    parser.add_argument("--maxTasksPerQuery", dest="maxTasksPerQuery", type=int, default=1,
+                        help="Merge up to this many neighbouring tasks into one Overpass query")
+    parser.add_argument("--maxQueryArea", dest="maxQueryArea", type=float, default=0.0025,
+                        help="Only merge tasks within grid cells of this many square degrees")
+    parser.add_argument("--queryTimeout", dest="queryTimeout", type=int, default=25,
+                        help="Overpass server side timeout per query, in seconds")
+    parser.add_argument("--maxAttempts", dest="maxAttempts", type=int, default=5,
+                        help="Attempts per query before giving up, with exponential backoff between them")
+    httpcache.add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -98,30 +281,66 @@ def parse_arguments():
 if __name__ == "__main__":
 
     args = parse_arguments()
+    fetching.set_default_cache(httpcache.cache_from_arguments(args))
+    exporter = metrics.metrics_from_arguments(args)
 
     output_file = None
     out = None
     building_count = 0
     task_count = 0
+    dropped_count = 0
+    failed_tasks = []
 
-    for task in load_tasks_from_file(args.taskCsv):
-        task_id = task["task_id"]
-        project_id = task["project_id"]
+    tasks = list(load_tasks_from_file(args.taskCsv))
+    groups = group_tasks(tasks, args.maxQueryArea, args.maxTasksPerQuery)
+    rate_limiter = fetching.RateLimiter(args.rateLimit)
 
-        if out is None:
-            output_file = get_output_file(project_id, args.outputFolder)
-            out = open(output_file, 'w') 
-            out.write("project_id,task_id,way_id,bbox\n")
+    print("Looking up buildings for %s tasks in %s queries" % (len(tasks), len(groups)))
+    lookups = find_buildings_for_groups(groups, args.workers, args.overpassUrl, args.queryTimeout, args.maxAttempts, rate_limiter)
 
-        print("Looking up buildings for task %s, project %s" % (task_id, project_id))
-        raw_buildings = overpass_find_buildings(task)
-        building_polygons = convert_to_polygons(raw_buildings)
-        
-        write_polygons_to_csv(project_id, task_id, building_polygons, out)
-        
-        building_count = building_count + len(building_polygons)
-        task_count = task_count + 1
+    with metrics.stage("find_buildings"):
+        try:
+            for (task, building_polygons, dropped, error) in in_task_order(lookups, tasks):
+                task_id = task["task_id"]
+                project_id = task["project_id"]
+                dropped_count = dropped_count + dropped
+
+                if error is not None:
+                    print("WARN: query for task %s failed: %s" % (task_id, error))
+                    failed_tasks.append(task)
+                    continue
+
+                if out is None:
+                    output_file = get_output_file(project_id, args.outputFolder, args.format)
+                    if args.format == "binary":
+                        out = BuildingBinaryWriter(output_file)
+                    else:
+                        out = open(output_file, 'w')
+                        out.write("project_id,task_id,way_id,bbox\n")
+
+                print("Found %s buildings for task %s, project %s" % (len(building_polygons), task_id, project_id))
+
+                if args.format == "binary":
+                    out.write_polygons(project_id, task_id, building_polygons)
+                else:
+                    write_polygons_to_csv(project_id, task_id, building_polygons, out)
+
+                building_count = building_count + len(building_polygons)
+                task_count = task_count + 1
+        finally:
+            # Binary output is only assembled on close, so close it even if the run stops early,
+            # keeping every finished task as the csv does
+            if out is not None:
+                out.close()
 
     if out is not None:
-        out.close()
         print("Written %s buildings accross %s tasks to %s" % (building_count, task_count, output_file))
+
+    if dropped_count > 0:
+        print("Dropped %s buildings whose centres fell outside every task" % dropped_count)
+
+    if len(failed_tasks) > 0:
+        print("WARN: %s tasks failed and are missing from the output: %s" % (len(failed_tasks), [t["task_id"] for t in failed_tasks]))
+
+    if exporter is not None:
+        exporter.close()
@@ -0,0 +1,29 @@
+from argparse import ArgumentParser
+from util import buildingfile
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input",
+                        help="A building csv or binary building file")
+    parser.add_argument("-o", "--output", dest="output",
+                        help="Write the converted buildings here")
+    parser.add_argument("-p", "--precision", dest="precision", type=int, default=buildingfile.DEFAULT_PRECISION,
+                        help="Decimal places kept when writing binary; conversion fails rather than round")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+
+    if buildingfile.is_binary_building_file(args.input):
+        table = buildingfile.read_buildings_binary(args.input)
+        with open(args.output, "w") as out:
+            buildingfile.write_buildings_csv(out, table)
+        print("Converted %s buildings from binary %s to csv %s" % (len(table.way_ids), args.input, args.output))
+    else:
+        table = buildingfile.load_buildings(args.input)
+        buildingfile.write_buildings_binary(args.output, table, args.precision)
+        print("Converted %s buildings from csv %s to binary %s" % (len(table.way_ids), args.input, args.output))
@@ -0,0 +1,84 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from tqdm import tqdm
+from util.tilestore import TileStore
+
+import re
+
+TILE_NAME = re.compile(r"^a([0-3]+)\.jpeg$")
+TRUTH_NAME = re.compile(r"^a([0-3]+)_truth\.jpeg$")
+KERAS_MASK_FOLDER = "mask"
+
+
+def iterate_tile_files(input_folder):
+    """
+        Yields (quadkey, path, is_truth) for every tile under input_folder, whether laid out per task
+        (project/task/zoom/), in the shared per-zoom folders, or in flat Keras train/mask folders,
+        where masks share their tile's name. Paths are sorted so conversions are repeatable.
+    """
+    input_folder = Path(input_folder)
+
+    for path in sorted(input_folder.rglob("a*.jpeg")):
+        match = TILE_NAME.match(path.name)
+        if match is not None:
+            yield (match.group(1), path, KERAS_MASK_FOLDER in path.relative_to(input_folder).parts[:-1])
+            continue
+
+        match = TRUTH_NAME.match(path.name)
+        if match is not None:
+            yield (match.group(1), path, True)
+
+
+def convert_folder_to_store(input_folder, store, truth_store=None):
+    """
+        Copies loose tiles into the store. A quadkey found in several task folders is stored once,
+        and raises a ValueError if the copies differ. Returns (stored, skipped) counts.
+    """
+    stored = 0
+    skipped = 0
+
+    for (quadkey, path, is_truth) in tqdm(iterate_tile_files(input_folder)):
+        target = truth_store if is_truth else store
+
+        if target is None:
+            skipped = skipped + 1
+            continue
+
+        data = path.read_bytes()
+        if quadkey in target:
+            if target[quadkey] != data:
+                raise ValueError("Found a different %s for quadkey %s at %s" % ("mask" if is_truth else "tile", quadkey, path))
+            skipped = skipped + 1
+            continue
+
+        target.put(quadkey, data)
+        stored = stored + 1
+
+    return (stored, skipped)
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--inputFolder", dest="inputFolder",
+                        help="Folder of loose map tiles to convert", default="data/map_tiles")
+    parser.add_argument("-s", "--store", dest="store",
+                        help="Write tiles into this tile store", default="data/map_tiles.store")
+    parser.add_argument("-t", "--truthStore", dest="truthStore", default=None,
+                        help="Write *_truth.jpeg masks, and Keras mask/ folder masks, into this tile store, otherwise they are skipped")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+
+    truth_store = TileStore(args.truthStore, writable=True) if args.truthStore is not None else None
+
+    with TileStore(args.store, writable=True) as store:
+        (stored, skipped) = convert_folder_to_store(args.inputFolder, store, truth_store)
+
+    if truth_store is not None:
+        truth_store.close()
+
+    print("Stored %s tiles from %s into %s, skipped %s" % (stored, args.inputFolder, args.store, skipped))
@@ -1,9 +1,9 @@
 
 from argparse import ArgumentParser
 from pathlib import Path
+from util import fetching, httpcache, metrics
 
 import json
-import requests
 
 LOCALE = "en"
 
@@ -27,12 +27,8 @@ def search_hot_projects(textSearch):
 def search_hot_projects_page(textSearch, page = None):
     headers = { "Accept-Language" : LOCALE }
     params = { "mapperLevel" : "ALL", "textSearch" : textSearch, "page" : page }
-    r = requests.get("https://tasks.hotosm.org/api/v1/project/search", params=params, headers=headers)
-
-    if r.status_code == requests.codes.ok:
-        return r.json()
-    else:
-        r.raise_for_status()
+    r = fetching.request_with_retries("GET", "https://tasks.hotosm.org/api/v1/project/search", params=params, headers=headers)
+    return r.json()
 
 
 def get_output_file(textSearch, outputFolder):
@@ -48,6 +44,8 @@ def parse_arguments():
                         help="Find matching projects containing this text") 
     parser.add_argument("-o", "--outputFolder", dest="outputFolder",
                         help="Save JSON results into this folder", default="data/projects")
+    httpcache.add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -55,12 +53,18 @@ def parse_arguments():
 if __name__ == "__main__":
 
     args = parse_arguments()
+    fetching.set_default_cache(httpcache.cache_from_arguments(args))
+    exporter = metrics.metrics_from_arguments(args)
 
     outputFile = get_output_file(args.textSearch, args.outputFolder)
-    results = search_hot_projects(args.textSearch)
+    with metrics.stage("enumerate_projects"):
+        results = search_hot_projects(args.textSearch)
     print("Found %s matches.  Saving output to %s" % (len(results), outputFile) )
 
     with open(outputFile, "w") as out:
         json.dump(results, out)
 
+    if exporter is not None:
+        exporter.close()
+
     
\ No newline at end of file
@@ -1,10 +1,15 @@
 from argparse import ArgumentParser
 from pathlib import Path
-from util import bingmaps
+from tqdm import tqdm
+from util import bingmaps, buildingfile, buildings, fetching, httpcache, metrics, polygons, tileindex
+from util.journal import Journal
+from util.tileindex import TileDigest, TileIndex
+from util.tilestore import TileStore
 
 import csv
+import hashlib
 import json
-import requests
+import os
 import urllib
 
 
@@ -17,37 +22,185 @@ def fetch_map_metadata(center_lat, center_lon, api_key):
     }
 
     center = str(center_lat) + "," + str(center_lon)
-    r = requests.get("https://dev.virtualearth.net/REST/V1/Imagery/Metadata/Aerial/" + center, params)
+    r = fetching.request_with_retries("GET", "https://dev.virtualearth.net/REST/V1/Imagery/Metadata/Aerial/" + center, params=params)
+    return r.json()
 
-    if r.status_code == requests.codes.ok:
-        return r.json()
-    else:
-        r.raise_for_status()
 
+def is_placeholder_response(r):
+    """
+        Bing answers requests for tiles it has no imagery of with a placeholder image, marked by this header.
+    """
+    return r.headers.get("X-VE-Tile-Info") == "no-tile"
 
-def try_to_fetch_and_save_image(url, output_folder, max_attempts=2):
-    attempts = 0
 
-    while attempts < max_attempts:
-        try:
-            return fetch_and_save_image(url, output_folder)
-        except requests.exceptions.ConnectionError:
-            print("Request failed, retrying...")
-            attempts = attempts + 1
+def index_tile(quadkey, tile, placeholder, index):
+    """
+        Returns the tile's status, recording it in index when given. A placeholder flagged by Bing
+        teaches the index its digest, so copies already saved are flagged too.
+    """
+    if placeholder and index is not None:
+        index.add_placeholder(tile.digest())
 
+    status = tileindex.PLACEHOLDER if placeholder else tile.status()
+    if index is not None:
+        status = index.record(quadkey, tile.digest(), tile.length, status)
 
-def fetch_and_save_image(url, output_folder):
-    r = requests.get(url, stream=True)
-    
-    if r.status_code == requests.codes.ok:
-        parsed = urllib.parse.urlparse(url)
-        filename = parsed.path.rpartition('/')[2]
+    return status
+
+
+def fetch_and_save_image(url, output_folder, session=None, max_attempts=1, rate_limiter=None, index=None):
+    """
+        Saves the tile, hashing it as it is written. Returns its status, and only keeps tiles that are OK.
+        A body that fails part way is fetched again, within max_attempts, and never left behind.
+    """
+    parsed = urllib.parse.urlparse(url)
+    filename = parsed.path.rpartition('/')[2]
 
-        with open(output_folder / filename, 'wb') as f:
-            for chunk in r:
+    # Write beside the final name then rename, so an interrupted write never looks like a saved tile
+    partial_path = output_folder / (filename + ".partial")
+
+    def save(r):
+        tile = TileDigest()
+        with open(partial_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=65536):
                 f.write(chunk)
-    else:
-        r.raise_for_status()
+                tile.update(chunk)
+                metrics.increment("tile_bytes", len(chunk))
+        return (tile, is_placeholder_response(r))
+
+    try:
+        (tile, placeholder) = fetching.stream_with_retries("GET", url, save, session=session, max_attempts=max_attempts,
+                                                           rate_limiter=rate_limiter, use_cache=False)
+
+        status = index_tile(filename[1:].partition(".")[0], tile, placeholder, index)
+        if status == tileindex.OK:
+            os.replace(partial_path, output_folder / filename)
+    finally:
+        if partial_path.exists():
+            partial_path.unlink()
+
+    return status
+
+
+def fetch_and_store_image(url, quadkey, store, session=None, max_attempts=1, rate_limiter=None, index=None):
+    """
+        As fetch_and_save_image, but puts an OK tile into store. A body that fails part way is
+        fetched again too, within max_attempts.
+    """
+    def read(r):
+        return (r.content, is_placeholder_response(r))
+
+    (content, placeholder) = fetching.stream_with_retries("GET", url, read, session=session, max_attempts=max_attempts,
+                                                          rate_limiter=rate_limiter, use_cache=False)
+    metrics.increment("tile_bytes", len(content))
+
+    status = index_tile(quadkey, TileDigest(content), placeholder, index)
+    if status == tileindex.OK:
+        store.put(quadkey, content)
+
+    return status
+
+
+def fetch_tiles(quadkeys, url, output_folder, workers, max_attempts=2, rate_limiter=None, store=None, index=None):
+    """
+        Fetches the tile for each quadkey into output_folder, or into store when given, on a pool of
+        workers each holding its own keep-alive session. Empty or truncated tiles are fetched again,
+        up to max_attempts, and placeholders are not kept. Both are recorded in index when given.
+        Yields (quadkey, status, error) as each tile finishes: status OK when it was saved, or
+        PLACEHOLDER when Bing has no imagery of it and nothing was saved, and error None; or error
+        set, with status None, when it failed.
+    """
+    def fetch(quadkey):
+        session = fetching.thread_session(pool_size=1)
+        image_url = image_url_for_quadkey(url, quadkey)
+
+        for attempt in range(max_attempts):
+            if store is not None:
+                status = fetch_and_store_image(image_url, quadkey, store, session, max_attempts, rate_limiter, index)
+            else:
+                status = fetch_and_save_image(image_url, output_folder, session, max_attempts, rate_limiter, index)
+
+            if status not in tileindex.REFETCH_STATUSES:
+                return status
+            metrics.increment("tiles_refetched", reason=tileindex.STATUS_NAMES[status])
+
+        raise IOError("Tile %s was %s after %s attempts" % (quadkey, tileindex.STATUS_NAMES[status], max_attempts))
+
+    for (quadkey, status, error) in fetching.bounded_map(fetch, quadkeys, workers):
+        if error is not None:
+            metrics.increment("tiles_failed")
+        elif status == tileindex.PLACEHOLDER:
+            metrics.increment("tiles_skipped", reason="placeholder")
+        else:
+            metrics.increment("tiles_fetched")
+        yield (quadkey, status if error is None else None, error)
+
+
+def enumerate_unique_quadkeys(tasks, zoom_level):
+    """
+        Quadkeys covering every task, each listed once even where neighbouring tasks share border tiles.
+        Order follows the task file. Tasks with a geometry only cover the tiles that intersect it.
+    """
+    quadkeys = {}
+
+    for task in tasks:
+        if task.get("geometry") is not None:
+            task_quadkeys = polygons.quadkeys_intersecting(task["geometry"], zoom_level)
+        else:
+            min_lat = float(task["min_lat"])
+            min_lon = float(task["min_lon"])
+            max_lat = float(task["max_lat"])
+            max_lon = float(task["max_lon"])
+            task_quadkeys = bingmaps.enumerate_quadkeys_in_box(min_lat, min_lon, max_lat, max_lon, zoom_level)
+
+        for quadkey in task_quadkeys:
+            quadkeys[quadkey] = True
+
+    return list(quadkeys.keys())
+
+
+def is_sampled(quadkey, rate, seed=0):
+    """
+        Deterministically keeps about rate of all quadkeys, by hashing them, so re-runs pick the same tiles.
+    """
+    digest = hashlib.sha1(("%s:%s" % (seed, quadkey)).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 < rate
+
+
+def select_building_quadkeys(task_quadkeys, building_quadkeys, empty_tile_rate=0, seed=0):
+    """
+        Every tile touched by a building, then a sample of the tasks' tiles without any building,
+        as negative examples. Returns (quadkeys, number of empty tiles sampled).
+    """
+    touched = set(building_quadkeys)
+    empty = [q for q in task_quadkeys if q not in touched and is_sampled(q, empty_tile_rate, seed)]
+    return (list(building_quadkeys) + empty, len(empty))
+
+
+def tile_path(output_folder, quadkey):
+    return output_folder / ("a%s.jpeg" % quadkey)
+
+
+def tile_exists(output_folder, quadkey, store=None):
+    if store is not None:
+        return quadkey in store
+
+    path = tile_path(output_folder, quadkey)
+    return path.exists() and path.stat().st_size > 0
+
+
+def needs_fetch(quadkey, output_folder, journal, store=None, index=None):
+    """
+        True for tiles not fetched yet, or indexed as empty, truncated or undecodable. Placeholders
+        are never fetched again.
+    """
+    status = index.status(quadkey) if index is not None else None
+    if status in tileindex.REFETCH_STATUSES:
+        return True
+    if status == tileindex.PLACEHOLDER:
+        return False
+
+    return not journal.is_done(quadkey) and not tile_exists(output_folder, quadkey, store)
 
 
 def get_image_url(map_metadata):
@@ -72,10 +225,33 @@ def load_api_key(location=".bing_api_key"):
 
 
 def load_tasks_from_file(taskCsv):
+    """
+        Yields each task's row, with the geometry of irregular tasks from beside the csv.
+    """
+    geometries = polygons.load_task_geometries(taskCsv)
+
     with open(taskCsv, 'r') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
+            row["geometry"] = geometries.get(row["task_id"])
             yield row
+
+
+def load_tasks_from_geometry(geometryFile):
+    """
+        A task row for each polygon or multipolygon in a GeoJSON file, such as a project's area.
+    """
+    for (i, (properties, geometry)) in enumerate(polygons.load_geometries(geometryFile)):
+        (min_lat, min_lon, max_lat, max_lon) = polygons.geometry_bounds(geometry)
+        yield {
+            "project_id" : str(properties.get("project_id", "")),
+            "task_id" : str(properties.get("task_id", i)),
+            "min_lat" : min_lat,
+            "min_lon" : min_lon,
+            "max_lat" : max_lat,
+            "max_lon" : max_lon,
+            "geometry" : geometry
+        }
     
 
 def get_output_folder(project_id, task_id, zoom_level, output_folder):
@@ -84,14 +260,50 @@ def get_output_folder(project_id, task_id, zoom_level, output_folder):
     return path
 
 
+def get_shared_output_folder(zoom_level, output_folder):
+    """
+        Tiles fetched once for all tasks live in a single folder per zoom level, rather than per task.
+    """
+    path = Path(output_folder) / Path(str(zoom_level))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def get_journal_path(zoom_level, output_folder, tile_store=None):
+    if tile_store is not None:
+        return Path(tile_store) / ("fetch-journal-%s.log" % zoom_level)
+
+    return get_shared_output_folder(zoom_level, output_folder) / "fetch-journal.log"
+
+
 def parse_arguments():    
     parser = ArgumentParser() 
-    parser.add_argument("-t", "--taskCsv", dest="taskCsv",
+    parser.add_argument("-t", "--taskCsv", dest="taskCsv", default=None,
                         help="A csv of tasks and their bounding boxes")
+    parser.add_argument("-g", "--geometry", dest="geometry", default=None,
+                        help="Fetch the tiles intersecting the polygons of this GeoJSON file instead, e.g. a project's area")
+    parser.add_argument("-b", "--buildingFile", dest="buildingFiles", action="append", default=None,
+                        help="Only fetch tiles touched by buildings in this csv or binary building file, may be repeated")
+    parser.add_argument("--emptyTileRate", dest="emptyTileRate", type=float, default=0,
+                        help="With --buildingFile, also fetch this fraction of the tasks' tiles that hold no building")
+    parser.add_argument("--emptyTileSeed", dest="emptyTileSeed", type=int, default=0,
+                        help="Seed for sampling empty tiles")
     parser.add_argument("-z", "--zoomLevel", dest="zoomLevel",
                         help="Level of zoom at which to retrieve tiles")
     parser.add_argument("-o", "--outputFolder", dest="outputFolder",
                         help="Save map tiles into this folder", default="data/map_tiles")
+    parser.add_argument("-s", "--tileStore", dest="tileStore", default=None,
+                        help="Save map tiles into this packed tile store instead of loose files")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="Number of tiles to fetch concurrently")
+    parser.add_argument("-r", "--rateLimit", dest="rateLimit", type=float, default=None,
+                        help="Maximum tile requests per second across all workers")
+    parser.add_argument("--maxAttempts", dest="maxAttempts", type=int, default=5,
+                        help="Attempts per tile before giving up, with exponential backoff between them")
+    parser.add_argument("--tileUrl", dest="tileUrl", default=None,
+                        help="Fetch tiles from this base url instead of looking it up from Bing, e.g. a local tile server")
+    httpcache.add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -99,31 +311,79 @@ def parse_arguments():
 if __name__ == "__main__":
 
     args = parse_arguments()
+    fetching.set_default_cache(httpcache.cache_from_arguments(args))
+    exporter = metrics.metrics_from_arguments(args)
 
-    output_folder = None
     url = None
     zoom_level = int(args.zoomLevel)
-    api_key = load_api_key()
-
-    for task in load_tasks_from_file(args.taskCsv):
-        project_id = task["project_id"]
-        task_id = task["task_id"]
-        min_lat = float(task["min_lat"])
-        min_lon = float(task["min_lon"])
-        max_lat = float(task["max_lat"])
-        max_lon = float(task["max_lon"])
-
-        output_folder = get_output_folder(project_id, task_id, zoom_level, args.outputFolder)
-
-        if url is None:
-            map_metadata = fetch_map_metadata(min_lat, min_lon, api_key)
-            image_url = get_image_url(map_metadata)
-            url = urllib.parse.urlparse(image_url)
-
-        quadkeys = bingmaps.enumerate_quadkeys_in_box(min_lat, min_lon, max_lat, max_lon, zoom_level)
-        for quadkey in quadkeys:
-            image_url = image_url_for_quadkey(url, quadkey)
-            try_to_fetch_and_save_image(image_url, output_folder)
-
-        print("Written %s tiles to %s" % (len(quadkeys), output_folder))
-
+    rate_limiter = fetching.RateLimiter(args.rateLimit)
+
+    with metrics.stage("enumerate_tiles"):
+        tasks = list(load_tasks_from_file(args.taskCsv)) if args.taskCsv is not None else []
+        if args.geometry is not None:
+            tasks = tasks + list(load_tasks_from_geometry(args.geometry))
+        quadkeys = enumerate_unique_quadkeys(tasks, zoom_level)
+
+        if args.buildingFiles is not None:
+            tables = [buildingfile.load_buildings(f) for f in args.buildingFiles]
+            building_quadkeys = sorted(set(q for table in tables for q in buildings.quadkeys_touched(table, zoom_level)))
+            (selected, empty) = select_building_quadkeys(quadkeys, building_quadkeys, args.emptyTileRate, args.emptyTileSeed)
+            empty_task_tiles = len(set(quadkeys) - set(building_quadkeys))
+
+            print("Selected %s tiles touched by buildings and %s of %s empty task tiles" % (len(building_quadkeys), empty, empty_task_tiles))
+            metrics.increment("tiles_skipped", empty_task_tiles - empty, reason="no_buildings")
+            quadkeys = selected
+
+    store = TileStore(args.tileStore, writable=True) if args.tileStore is not None else None
+    output_folder = Path(args.tileStore) if store is not None else get_shared_output_folder(zoom_level, args.outputFolder)
+
+    index = TileIndex(output_folder, writable=True)
+
+    with Journal(get_journal_path(zoom_level, args.outputFolder, args.tileStore)) as journal:
+        pending = [q for q in quadkeys if needs_fetch(q, output_folder, journal, store, index)]
+        metrics.increment("tiles_skipped", len(quadkeys) - len(pending), reason="already_fetched")
+        metrics.set_gauge("tiles_pending", len(pending))
+
+        print("Found %s unique tiles across %s tasks, %s still to fetch into %s" % (len(quadkeys), len(tasks), len(pending), output_folder))
+
+        # Tiles are never cached, so offline there is nothing to fetch them from
+        if len(pending) > 0 and fetching.is_offline():
+            print("Offline, so not fetching the %s pending tiles" % len(pending))
+            metrics.increment("tiles_skipped", len(pending), reason="offline")
+            pending = []
+
+        if len(pending) > 0:
+            if args.tileUrl is not None:
+                url = urllib.parse.urlparse(args.tileUrl)
+            else:
+                (center_lat, center_lon) = (float(tasks[0]["min_lat"]), float(tasks[0]["min_lon"])) if len(tasks) > 0 else \
+                    (float(tables[0].latitudes[0]), float(tables[0].longitudes[0]))
+                map_metadata = fetch_map_metadata(center_lat, center_lon, load_api_key())
+                url = urllib.parse.urlparse(get_image_url(map_metadata))
+
+        saved = 0
+        placeholders = 0
+        failed = 0
+        with metrics.stage("fetch_tiles"):
+            for (quadkey, status, error) in tqdm(fetch_tiles(pending, url, output_folder, args.workers, args.maxAttempts, rate_limiter, store, index), total=len(pending)):
+                if error is not None:
+                    journal.record_failed(quadkey, repr(error))
+                    failed = failed + 1
+                elif status == tileindex.PLACEHOLDER:
+                    # Done, as fetching it again would only return the placeholder again
+                    journal.record_done(quadkey)
+                    placeholders = placeholders + 1
+                else:
+                    journal.record_done(quadkey)
+                    saved = saved + 1
+                metrics.set_gauge("tiles_pending", len(pending) - saved - placeholders - failed)
+
+    if store is not None:
+        store.close()
+    index.close()
+
+    if exporter is not None:
+        exporter.close()
+
+    print("Written %s tiles to %s, skipped %s placeholders without imagery, %s failed and will be retried on the next run" %
+          (saved, output_folder, placeholders, failed))
@@ -0,0 +1,176 @@
+"""
+    Writes synthetic task CSVs, building CSVs and map tiles in the same layout the collection
+    scripts produce, at the scale of the Ayeyarwady Delta data set by default, so the processing
+    stages can be benchmarked offline. Tasks are laid out on a grid of tiles, a few tiles per task
+    hold buildings, and only those tiles are written, as with the real data.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tqdm import tqdm
+from util import bingmaps
+
+import cv2
+import numpy as np
+
+ORIGIN_LAT = 17.0
+ORIGIN_LON = 94.6
+TILE_VARIANTS = 64
+
+
+def task_grid(tasks, task_tiles, zoom_level):
+    """
+        Top left tile (x, y) of each task, on a roughly square grid starting at the origin.
+    """
+    columns = int(np.ceil(np.sqrt(tasks)))
+    (origin_x, origin_y) = bingmaps.lat_lon_to_tile_xy(ORIGIN_LAT, ORIGIN_LON, zoom_level)
+    index = np.arange(tasks)
+    return (origin_x + (index % columns) * task_tiles, origin_y + (index // columns) * task_tiles)
+
+
+def choose_occupied_tiles(task_x, task_y, task_tiles, tiles, rng):
+    """
+        Spreads tiles over tasks, picking distinct tiles within each task. Returns (task, tile_x, tile_y).
+    """
+    tasks = len(task_x)
+    per_task = np.full(tasks, tiles // tasks)
+    per_task[rng.choice(tasks, tiles % tasks, replace=False)] += 1
+
+    if np.any(per_task > task_tiles * task_tiles):
+        raise ValueError("Cannot fit %s tiles into %s tasks of %sx%s tiles" % (tiles, tasks, task_tiles, task_tiles))
+
+    task = np.repeat(np.arange(tasks), per_task)
+    cell = np.concatenate([rng.choice(task_tiles * task_tiles, n, replace=False) for n in per_task])
+    return (task, task_x[task] + cell % task_tiles, task_y[task] + cell // task_tiles)
+
+
+def building_polygons(tile_x, tile_y, buildings, rng):
+    """
+        Closed, axis aligned rectangles of 5 pixels to 20 pixels a side, centred anywhere in a random
+        occupied tile, so a few cross into neighbouring tiles. Returns (tile index, pixel x, pixel y),
+        with 5 vertices per building.
+    """
+    tile = rng.integers(0, len(tile_x), buildings)
+    centre_x = tile_x[tile] * bingmaps.BING_TILE_SIZE_PIXELS + rng.uniform(0, bingmaps.BING_TILE_SIZE_PIXELS, buildings)
+    centre_y = tile_y[tile] * bingmaps.BING_TILE_SIZE_PIXELS + rng.uniform(0, bingmaps.BING_TILE_SIZE_PIXELS, buildings)
+    half_width = rng.uniform(2.5, 10, buildings)
+    half_height = rng.uniform(2.5, 10, buildings)
+
+    corner_x = np.array([-1, 1, 1, -1, -1])
+    corner_y = np.array([-1, -1, 1, 1, -1])
+    pixel_x = centre_x[:, None] + half_width[:, None] * corner_x
+    pixel_y = centre_y[:, None] + half_height[:, None] * corner_y
+
+    return (tile, pixel_x, pixel_y)
+
+
+def tile_variants(rng, count=TILE_VARIANTS):
+    """
+        A few distinct JPEG tiles of smoothed noise, roughly the 13KB of real imagery tiles.
+    """
+    variants = []
+    for _ in range(count):
+        noise = rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+        image = cv2.resize(noise, (bingmaps.BING_TILE_SIZE_PIXELS, bingmaps.BING_TILE_SIZE_PIXELS), interpolation=cv2.INTER_CUBIC)
+        variants.append(cv2.imencode(".jpeg", image, [cv2.IMWRITE_JPEG_QUALITY, 75])[1].tobytes())
+    return variants
+
+
+def get_output_file(folder, filename):
+    path = Path(folder)
+    path.mkdir(parents=True, exist_ok=True)
+    return path / filename
+
+
+def write_task_csvs(output_folder, project_ids, task_ids, task_x, task_y, task_tiles, zoom_level):
+    tile_pixels = bingmaps.BING_TILE_SIZE_PIXELS
+    (max_lat, min_lon) = bingmaps.pixel_xy_to_lat_lon_batch(task_x * tile_pixels, task_y * tile_pixels, zoom_level)
+    (min_lat, max_lon) = bingmaps.pixel_xy_to_lat_lon_batch((task_x + task_tiles) * tile_pixels, (task_y + task_tiles) * tile_pixels, zoom_level)
+
+    for project_id in np.unique(project_ids):
+        with open(get_output_file(output_folder, "%s-tasks.csv" % project_id), "w") as out:
+            out.write("project_id,task_id,min_lat,min_lon,max_lat,max_lon\n")
+            for i in np.flatnonzero(project_ids == project_id):
+                bounds = [float(min_lat[i]), float(min_lon[i]), float(max_lat[i]), float(max_lon[i])]
+                out.write("%s,%s,%s,%s,%s,%s\n" % tuple([project_id, task_ids[i]] + bounds))
+
+
+def write_building_csvs(output_folder, project_ids, task_ids, building_task, latitudes, longitudes):
+    """
+        Writes buildings as collect_building_geometries.py does, each coordinate as str() of a float
+        at OpenStreetMap's 7 decimal node precision, so parsing them costs what real files do.
+    """
+    order = np.argsort(building_task, kind="stable")
+    coordinates = np.round(np.stack([latitudes, longitudes], axis=2).reshape(len(latitudes), -1), 7)
+
+    for project_id in np.unique(project_ids):
+        rows = order[project_ids[building_task[order]] == project_id]
+
+        with open(get_output_file(output_folder, "%s-buildings.csv" % project_id), "w") as out:
+            out.write("project_id,task_id,way_id,bbox\n")
+            for i in rows:
+                out.write("%s,%s,%s," % (project_id, task_ids[building_task[i]], 100000000 + i))
+                out.write(",".join([str(c) for c in coordinates[i].tolist()]))
+                out.write("\n")
+
+
+def write_tiles(output_folder, tile_x, tile_y, zoom_level, rng):
+    """
+        Writes a variant per tile, each with its quadkey in a JPEG comment right after the start
+        marker, so no two tiles share content and none is flagged as an exact duplicate.
+    """
+    variants = tile_variants(rng)
+    quadkeys = bingmaps.tile_xy_to_quadkey_batch(tile_x, tile_y, zoom_level)
+    folder = Path(output_folder) / str(zoom_level)
+    folder.mkdir(parents=True, exist_ok=True)
+
+    for (i, quadkey) in enumerate(tqdm(quadkeys, desc="tiles")):
+        variant = variants[i % len(variants)]
+        comment = quadkey.encode("ascii")
+        with open(folder / ("a%s.jpeg" % quadkey), "wb") as out:
+            out.write(variant[:2])
+            out.write(b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment)
+            out.write(variant[2:])
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-o", "--outputFolder", dest="outputFolder", default="data/synthetic",
+                        help="Write validated_tasks/, validated_buildings/ and map_tiles/ under this folder")
+    parser.add_argument("-z", "--zoomLevel", dest="zoomLevel", type=int, default=18,
+                        help="Level of zoom of the generated tiles")
+    parser.add_argument("--projects", dest="projects", type=int, default=40,
+                        help="Number of projects to spread tasks over")
+    parser.add_argument("--tasks", dest="tasks", type=int, default=14292,
+                        help="Number of validated tasks")
+    parser.add_argument("--buildings", dest="buildings", type=int, default=545139,
+                        help="Number of buildings")
+    parser.add_argument("--tiles", dest="tiles", type=int, default=121078,
+                        help="Number of map tiles holding buildings, and so written")
+    parser.add_argument("--taskTiles", dest="taskTiles", type=int, default=6,
+                        help="Width and height of each task, in tiles")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+                        help="Seed for the random layout")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    rng = np.random.default_rng(args.seed)
+
+    (task_x, task_y) = task_grid(args.tasks, args.taskTiles, args.zoomLevel)
+    project_ids = 1000 + (np.arange(args.tasks) * args.projects) // args.tasks
+    task_ids = 1 + np.arange(args.tasks) - np.searchsorted(project_ids, project_ids)
+
+    (tile_task, tile_x, tile_y) = choose_occupied_tiles(task_x, task_y, args.taskTiles, args.tiles, rng)
+    (building_tile, pixel_x, pixel_y) = building_polygons(tile_x, tile_y, args.buildings, rng)
+    (latitudes, longitudes) = bingmaps.pixel_xy_to_lat_lon_batch(pixel_x, pixel_y, args.zoomLevel)
+
+    output_folder = Path(args.outputFolder)
+    write_task_csvs(output_folder / "validated_tasks", project_ids, task_ids, task_x, task_y, args.taskTiles, args.zoomLevel)
+    write_building_csvs(output_folder / "validated_buildings", project_ids, task_ids, tile_task[building_tile], latitudes, longitudes)
+    write_tiles(output_folder / "map_tiles", tile_x, tile_y, args.zoomLevel, rng)
+
+    print("Written %s tasks, %s buildings and %s tiles under %s" % (args.tasks, args.buildings, args.tiles, output_folder))
@@ -1,11 +1,12 @@
 from argparse import ArgumentParser
 from pathlib import Path
-from shutil import copyfile
 from tqdm import tqdm
-from util import bingmaps
+from util import bingmaps, buildingfile, buildings, masks, metrics, pools, tileindex
+from util.shards import ShardedDatasetWriter
+from util.tileindex import TileIndex
+from util.tilestore import TileStore
 
 import csv
-import cv2
 import json
 import numpy as np
 import requests
@@ -74,7 +75,7 @@ def get_output_paths(project_id, task_id, zoom_level, output_folder, quadkey):
     return (output_folder / tile_name, output_folder / truth_name)
 
 
-def get_keras_output_paths(project_id, task_id, zoom_level, output_folder, quadkey):
+def get_keras_output_paths(project_id, task_id, zoom_level, output_folder, quadkey, mask_extension=".jpeg"):
     output_base = Path(output_folder)
 
     output_train = Path(output_base) / Path("train") / Path("images")
@@ -84,26 +85,178 @@ def get_keras_output_paths(project_id, task_id, zoom_level, output_folder, quadk
     output_mask.mkdir(parents=True, exist_ok=True) 
 
     file_name = "a%s.jpeg" % quadkey
+    mask_name = "a%s%s" % (quadkey, mask_extension)
 
-    return (output_train / file_name, output_mask / file_name)
+    return (output_train / file_name, output_mask / mask_name)
+
+
+def get_packed_mask_folder(output_folder):
+    return Path(output_folder) / Path("mask") / Path("packed")
 
 
 def get_maptile_path(project_id, task_id, zoom_level, maptile_folder, quadkey):
+    """
+        Tiles are found either under their task's folder, or in the shared per-zoom folder
+        that fetch_bing_tiles.py fills with each unique tile once.
+    """
     file_name = "a%s.jpeg" % quadkey
     path = Path(maptile_folder) / Path(str(project_id)) / Path(str(task_id)) / Path(str(zoom_level)) / file_name
+
+    if not path.exists():
+        shared_path = Path(maptile_folder) / Path(str(zoom_level)) / file_name
+        if shared_path.exists():
+            return shared_path
+
     return path
 
 
+def read_maptile(project_id, task_id, zoom_level, maptile_folder, quadkey, tile_store=None):
+    """
+        Returns the map tile's bytes, or None if we don't have it.
+    """
+    if tile_store is not None:
+        return tile_store.get(quadkey)
+
+    path = get_maptile_path(project_id, task_id, zoom_level, maptile_folder, quadkey)
+    return path.read_bytes() if path.exists() else None
+
+
+def load_flagged_tiles(index_folder):
+    """
+        Quadkeys fetch_bing_tiles.py indexed as placeholders, empty, truncated, undecodable or exact
+        duplicates of another tile, which would only add noise to the training set. Empty when the
+        tiles have no index.
+    """
+    if not tileindex.index_exists(index_folder):
+        return set()
+
+    with TileIndex(index_folder) as index:
+        (flagged, _) = index.flagged()
+    return set(flagged)
+
+
+def open_output_stores(output_store):
+    """
+        Training tiles and their masks go into two tile stores, mirroring the Keras train/ and mask/ folders.
+    """
+    return (TileStore(Path(output_store) / "train", writable=True), TileStore(Path(output_store) / "mask", writable=True))
+
+
+def build_training_pair(quadkey, bounding_boxes, project_id, task_id, zoom_level, map_tiles, tile_store=None,
+                        mask=None, mask_format="jpeg"):
+    """
+        Returns (map tile bytes, encoded truth mask), or None if the map tile could not be found.
+    """
+    maptile = read_maptile(project_id, task_id, zoom_level, map_tiles, quadkey, tile_store)
+    if maptile is None:
+        return None
+
+    mask = masks.draw_mask(bounding_boxes, mask)
+    return (maptile, masks.encode_mask(mask, mask_format))
+
+
+def save_training_pair(quadkey, project_id, task_id, zoom_level, output_folder, maptile, truth, output_stores=None,
+                       mask_format="jpeg", mask_writer=None, shard_writer=None):
+    if shard_writer is not None:
+        shard_writer.write(quadkey, project_id, task_id, maptile, truth)
+    elif output_stores is not None:
+        (train_store, mask_store) = output_stores
+        train_store.put(quadkey, maptile)
+        mask_store.put(quadkey, truth)
+    elif mask_format == "packed":
+        (output_tile, _) = get_keras_output_paths(project_id, task_id, zoom_level, output_folder, quadkey)
+        output_tile.write_bytes(maptile)
+        mask_writer.put(quadkey, truth)
+    else:
+        (output_tile, output_truth) = get_keras_output_paths(project_id, task_id, zoom_level, output_folder, quadkey,
+                                                             masks.mask_extension(mask_format))
+        output_truth.write_bytes(truth)
+        output_tile.write_bytes(maptile)
+
+
+# Each worker process keeps its own read handle on the tile store and a single mask buffer,
+# reused for every tile it draws.
+_worker = {}
+
+
+def init_worker(zoom_level, map_tiles, output_folder, tile_store_path, return_pairs, mask_format="jpeg"):
+    _worker["zoom_level"] = zoom_level
+    _worker["map_tiles"] = map_tiles
+    _worker["output_folder"] = output_folder
+    _worker["tile_store"] = TileStore(tile_store_path) if tile_store_path is not None else None
+    _worker["return_pairs"] = return_pairs
+    _worker["mask_format"] = mask_format
+    _worker["mask"] = np.zeros([256, 256], np.uint8)
+
+
+def process_chunk(chunk):
+    """
+        Builds the training pairs for a chunk of (quadkey, bounding_boxes, project_id, task_id) items.
+        Pairs are written straight to the output folder, or returned for the parent to put into
+        output stores or packed mask shards, which only one process may append to.
+        Returns (chunk size, results), as tiles without a map tile give no result.
+    """
+    results = []
+
+    for (quadkey, bounding_boxes, project_id, task_id) in chunk:
+        pair = build_training_pair(quadkey, bounding_boxes, project_id, task_id, _worker["zoom_level"],
+                                   _worker["map_tiles"], _worker["tile_store"], _worker["mask"], _worker["mask_format"])
+        if pair is None:
+            continue
+
+        if _worker["return_pairs"]:
+            results.append((quadkey, project_id, task_id) + pair)
+        else:
+            save_training_pair(quadkey, project_id, task_id, _worker["zoom_level"], _worker["output_folder"], *pair,
+                               mask_format=_worker["mask_format"])
+            results.append((quadkey, project_id, task_id))
+
+    return (len(chunk), results)
+
+
+def chunk_items(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+
 def parse_arguments():    
     parser = ArgumentParser() 
     parser.add_argument("-b", "--buildingCsv", dest="buildingCsv",
-                        help="A csv of verified buildings, their polygons, and their task info")
+                        help="A csv, or binary building file, of verified buildings, their polygons, and their task info")
     parser.add_argument("-z", "--zoomLevel", dest="zoomLevel",
                         help="Level of zoom at which to prepare training data")
     parser.add_argument("-m", "--mapTiles", dest="mapTiles",
                         help="Lookup map tiles in this folder structure", default="data/map_tiles")
     parser.add_argument("-o", "--outputFolder", dest="outputFolder",
                         help="Save processed map tiles into this folder", default="data/training")
+    parser.add_argument("-s", "--tileStore", dest="tileStore", default=None,
+                        help="Read map tiles from this packed tile store instead of the folder structure")
+    parser.add_argument("--outputStore", dest="outputStore", default=None,
+                        help="Save processed map tiles and masks into train/ and mask/ tile stores under this folder")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="Number of processes drawing masks and writing output")
+    parser.add_argument("--chunkSize", dest="chunkSize", type=int, default=256,
+                        help="Number of tiles handed to a worker at a time")
+    parser.add_argument("--outputShards", dest="outputShards", default=None,
+                        help="Save samples into train/validation/test shard files under this folder, split by task")
+    parser.add_argument("--shardBytes", dest="shardBytes", type=int, default=256 * 1024 * 1024,
+                        help="Start a new shard once one reaches this size")
+    parser.add_argument("--splitFractions", dest="splitFractions", default="0.8,0.1,0.1",
+                        help="Fractions of tasks in the train, validation and test splits")
+    parser.add_argument("--splitSeed", dest="splitSeed", type=int, default=0,
+                        help="Seed for assigning tasks to splits")
+    parser.add_argument("-f", "--maskFormat", dest="maskFormat", choices=masks.MASK_FORMATS, default="jpeg",
+                        help="Write truth masks as 3 channel jpeg, single channel lossless png, or bit packed shards")
+    parser.add_argument("-x", "--crossTileBuildings", dest="crossTileBuildings", action="store_true",
+                        help="Draw buildings on every tile they touch, rather than dropping those that cross a tile boundary")
+    metrics.add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -111,51 +264,66 @@ def parse_arguments():
 if __name__ == "__main__":
 
     args = parse_arguments()
+    exporter = metrics.metrics_from_arguments(args)
 
     output_folder = None
     url = None
     zoom_level = int(args.zoomLevel)
 
-    quadkey_buildings = {}
-    quadkey_meta = {}
-
-    for task in load_buildings_from_file(args.buildingCsv):
-        project_id = task["project_id"]
-        task_id = task["task_id"]
-        way_id = task["way_id"]
-        bounding_box = bounding_box_to_lat_lon_list(task["bounding_box"])
-
-        if bounding_box_entirely_in_same_tile(bounding_box, zoom_level):
-            quadkey = bingmaps.quadkey_containing_lat_lon(bounding_box[0][0], bounding_box[0][1], zoom_level)
-            bounding_box_pixel_coords = bounding_box_to_pixel_coords(bounding_box, zoom_level)
-
-            if quadkey in quadkey_buildings:
-                quadkey_buildings[quadkey].append(bounding_box_pixel_coords)
-            else:
-                quadkey_buildings[quadkey] = [bounding_box_pixel_coords]
-
-            quadkey_meta[quadkey] = {
-                "project_id" : project_id,
-                "task_id" : task_id
-            }
-        
-    print("Found %s map tiles containing complete quadkeys. Writing output under %s" % (len(quadkey_buildings.keys()), args.outputFolder))        
-            
-    for (quadkey, bounding_boxes) in tqdm(quadkey_buildings.items()):
-        project_id = quadkey_meta[quadkey]["project_id"]
-        task_id = quadkey_meta[quadkey]["task_id"]
-
-        maptile_path = get_maptile_path(project_id, task_id, zoom_level, args.mapTiles, quadkey)
-        if maptile_path.exists():
-            (output_tile, output_truth) = get_keras_output_paths(project_id, task_id, zoom_level, args.outputFolder, quadkey)
-            
-            truth = np.zeros([256, 256, 3], np.uint8)
-            
-            for bounding_box in bounding_boxes:
-                cv2.fillPoly(truth, np.array([bounding_box], dtype='int32'), (255, 255, 255))
-            
-            cv2.imwrite(str(output_truth), truth)
-
-            copyfile(str(maptile_path), str(output_tile))
-
-
+    with metrics.stage("load_buildings"):
+        table = buildingfile.load_buildings(args.buildingCsv)
+    metrics.increment("buildings_loaded", len(table.way_ids))
+
+    with metrics.stage("group_by_tile"):
+        (quadkey_buildings, quadkey_meta) = buildings.group_polygons_by_tile(table, zoom_level, not args.crossTileBuildings)
+
+    if args.crossTileBuildings:
+        print("Found %s map tiles touched by %s buildings. Writing output under %s" % (len(quadkey_buildings.keys()), len(table.way_ids), args.outputFolder))
+    else:
+        print("Found %s map tiles containing complete quadkeys. Writing output under %s" % (len(quadkey_buildings.keys()), args.outputFolder))
+
+    output_stores = open_output_stores(args.outputStore) if args.outputStore is not None else None
+    shard_writer = ShardedDatasetWriter(args.outputShards, args.maskFormat, args.shardBytes,
+                                        [float(f) for f in args.splitFractions.split(",")], args.splitSeed) \
+        if args.outputShards is not None else None
+    mask_writer = masks.PackedMaskWriter(get_packed_mask_folder(args.outputFolder)) \
+        if args.maskFormat == "packed" and output_stores is None and shard_writer is None else None
+    return_pairs = output_stores is not None or mask_writer is not None or shard_writer is not None
+    initargs = (zoom_level, args.mapTiles, args.outputFolder, args.tileStore, return_pairs, args.maskFormat)
+
+    flagged = load_flagged_tiles(Path(args.tileStore) if args.tileStore is not None else Path(args.mapTiles) / str(zoom_level))
+    flagged = flagged.intersection(quadkey_buildings)
+    if len(flagged) > 0:
+        print("Skipping %s tiles flagged by the tile index" % len(flagged))
+        metrics.increment("tiles_skipped", len(flagged), reason="flagged_tile")
+
+    items = ((quadkey, bounding_boxes, quadkey_meta[quadkey]["project_id"], quadkey_meta[quadkey]["task_id"])
+             for (quadkey, bounding_boxes) in quadkey_buildings.items() if quadkey not in flagged)
+    chunks = chunk_items(items, args.chunkSize)
+
+    written = 0
+    with metrics.stage("write_training_pairs"), tqdm(total=len(quadkey_buildings) - len(flagged)) as progress:
+        for (chunk_size, results) in pools.process_chunks(chunks, args.workers, init_worker, initargs, process_chunk):
+            if return_pairs:
+                for (quadkey, project_id, task_id, maptile, truth) in results:
+                    save_training_pair(quadkey, project_id, task_id, zoom_level, args.outputFolder, maptile, truth,
+                                       output_stores, args.maskFormat, mask_writer, shard_writer)
+
+            written = written + len(results)
+            metrics.increment("training_pairs_written", len(results))
+            metrics.increment("tiles_skipped", chunk_size - len(results), reason="missing_tile")
+            progress.update(chunk_size)
+
+    for store in output_stores or []:
+        store.close()
+
+    if mask_writer is not None:
+        mask_writer.close()
+
+    if shard_writer is not None:
+        shard_writer.close()
+
+    print("Written %s training pairs" % written)
+
+    if exporter is not None:
+        exporter.close()
@@ -1,16 +1,12 @@
 from argparse import ArgumentParser
 from pathlib import Path
+from util import fetching, httpcache, metrics
 
 import json
-import requests
 
-def get_region_information(textSearch, page = None):
-    r = requests.get("https://tasks.hotosm.org/api/v1/project/" + str(projectId))
-
-    if r.status_code == requests.codes.ok:
-        return r.json()
-    else:
-        r.raise_for_status()
+def get_region_information(projectId):
+    r = fetching.request_with_retries("GET", "https://tasks.hotosm.org/api/v1/project/" + str(projectId))
+    return r.json()
 
 
 def iterate_project_ids(projectJson):
@@ -36,6 +32,8 @@ def parse_arguments():
                         help="Path to JSON file containing project list")
     parser.add_argument("-o", "--outputFolder", dest="outputFolder",
                         help="Save JSON results into this folder", default="data/regions")
+    httpcache.add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -43,12 +41,19 @@ def parse_arguments():
 if __name__ == "__main__":
 
     args = parse_arguments()
+    fetching.set_default_cache(httpcache.cache_from_arguments(args))
+    exporter = metrics.metrics_from_arguments(args)
+
+    with metrics.stage("project_regions"):
+        for projectId in iterate_project_ids(args.projectJson):
+            outputFile = get_output_file(projectId, args.outputFolder)
+
+            print("Looking up information for region %s, saving to %s" % (str(projectId), outputFile))
+            region = get_region_information(projectId)
+            metrics.increment("regions_fetched")
 
-    for projectId in iterate_project_ids(args.projectJson):
-        outputFile = get_output_file(projectId, args.outputFolder)
+            with open(outputFile, "w") as out:
+                json.dump(region, out)
 
-        print("Looking up information for region %s, saving to %s" % (str(projectId), outputFile))
-        region = get_region_information(projectId)
-        
-        with open(outputFile, "w") as out:
-            json.dump(region, out)
\ No newline at end of file
+    if exporter is not None:
+        exporter.close()
\ No newline at end of file
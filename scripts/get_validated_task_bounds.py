@@ -1,5 +1,6 @@
 from argparse import ArgumentParser
 from pathlib import Path
+from util import metrics, polygons
 
 import json
 
@@ -9,65 +10,65 @@ def load_region_tasks(regionJson):
         return json.load(f)
 
 
-def is_perpendicular(bounding_box):
+def convert_task_to_row(task, project_id):
     """
-    Assuming boxes are 'perpendicuar' to the equator. 
-    Check each coordinate pair contains one item in common with its previous pair.
+        Returns the task's CSV row of its bounding box, and its geometry when that is not an axis
+        aligned rectangle, so tiles can be enumerated from the real area rather than the box.
     """
-
-    prev_coord = bounding_box[0]
-    for coord in bounding_box[1:]:
-        if coord[0] != prev_coord[0] and coord[1] != prev_coord[1]:
-            return False
-
-        prev_coord = coord
-    
-    return True
-
-
-def convert_task_to_row(task, project_id):
-    coordinates = task["geometry"]["coordinates"]
-    bounding_box = coordinates[0][0]
+    geometry = task["geometry"]
     task_id = task["properties"]["taskId"]
 
-    if len(bounding_box) != 5:
-        print("WARN: skipping (taskId %s): expected 5 coordinates in bounding box but found %s" % (task_id, bounding_box))
-        return None
-
-    if not is_perpendicular(bounding_box):
-        print("WARN: skipping (taskId %s): expected a bounding box perpendicular to the equator, %s" % (task_id, bounding_box))
-        return None
-    
-    assert bounding_box[0] == bounding_box[4], "(taskId %s): expected the first and last coordinates to match: %s - %s" % (task_id, bounding_box[0], bounding_box[4])
+    (min_lat, min_lon, max_lat, max_lon) = polygons.geometry_bounds(geometry)
+    row = (project_id, task_id, min_lat, min_lon, max_lat, max_lon)
 
-    min_lat = min([coord[1] for coord in bounding_box])
-    min_lon = min([coord[0] for coord in bounding_box])
-    max_lat = max([coord[1] for coord in bounding_box])
-    max_lon = max([coord[0] for coord in bounding_box])
+    if polygons.is_axis_aligned_rectangle(geometry):
+        return (row, None)
 
-    return (project_id, task_id, min_lat, min_lon, max_lat, max_lon)
+    metrics.increment("tasks_irregular")
+    return (row, geometry)
 
 
 def write_tasks_to_csv(out, region, project_id):
-
+    """
+        Writes a row per validated task. Returns (project_id, task_id, geometry) of the irregular ones.
+    """
     validated_tasks = 0
     total_tasks = 0
+    irregular_tasks = []
 
     out.write("project_id,task_id,min_lat,min_lon,max_lat,max_lon\n")
 
     for task in region["tasks"]["features"]:
         if task["properties"]["taskStatus"] == "VALIDATED":
-            row = convert_task_to_row(task, project_id)
+            (row, geometry) = convert_task_to_row(task, project_id)
 
-            if row is not None:
-                out.write(",".join([str(r) for r in row]))
-                out.write("\n")
+            out.write(",".join([str(r) for r in row]))
+            out.write("\n")
+            validated_tasks = validated_tasks + 1
 
-                validated_tasks = validated_tasks + 1
+            if geometry is not None:
+                irregular_tasks.append((project_id, row[1], geometry))
         
         total_tasks = total_tasks + 1
 
-    print("Written %s validated tasks out of %s total, to %s" % (validated_tasks, total_tasks, out.name))
+    metrics.increment("tasks_validated", validated_tasks)
+    print("Written %s validated tasks out of %s total, %s of them irregular, to %s" % (validated_tasks, total_tasks, len(irregular_tasks), out.name))
+    return irregular_tasks
+
+
+def write_task_geometries(task_csv, irregular_tasks):
+    """
+        Saves irregular task geometries beside the task csv, removing any left from an earlier run.
+    """
+    path = polygons.geometry_path(task_csv)
+
+    if len(irregular_tasks) == 0:
+        if path.exists():
+            path.unlink()
+        return
+
+    with open(path, "w") as out:
+        polygons.write_task_geometries(out, irregular_tasks)
 
 
 def get_output_file(projectId, outputFolder):
@@ -83,6 +84,7 @@ def parse_arguments():
                         help="Path to JSON file containing a region's task information")
     parser.add_argument("-o", "--outputFolder", dest="outputFolder",
                         help="Save results into this folder", default="data/validated_tasks")
+    metrics.add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -90,6 +92,7 @@ def parse_arguments():
 if __name__ == "__main__":
 
     args = parse_arguments()
+    exporter = metrics.metrics_from_arguments(args)
 
     region = load_region_tasks(args.regionJson)
 
@@ -97,4 +100,9 @@ if __name__ == "__main__":
     outputFile = get_output_file(project_id, args.outputFolder)
 
     with open(outputFile, 'w') as out:
-        write_tasks_to_csv(out, region, project_id)
+        irregular_tasks = write_tasks_to_csv(out, region, project_id)
+
+    write_task_geometries(outputFile, irregular_tasks)
+
+    if exporter is not None:
+        exporter.close()
@@ -0,0 +1,89 @@
+"""
+    Answers density queries from a pyramid saved by build_density_pyramid.py: building count and
+    footprint area in a box, the densest tiles as candidate population centres, and a heatmap image
+    of a box at any level, with a JSON sidecar georeferencing it.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from util.density import DensityPyramid, tile_size_metres
+from util.mosaic import mercator_geotransform
+
+import json
+
+import cv2
+import numpy as np
+
+
+def heatmap_image(grid, cell_pixels):
+    """
+        A colour image of a grid, log scaled so sparse areas stay visible, tiles without buildings black.
+    """
+    scaled = np.log1p(grid.astype(np.float64))
+    if scaled.max() > 0:
+        scaled = scaled / scaled.max()
+
+    image = cv2.applyColorMap((scaled * 255).astype(np.uint8), cv2.COLORMAP_INFERNO)
+    image[grid == 0] = 0
+    return cv2.resize(image, (grid.shape[1] * cell_pixels, grid.shape[0] * cell_pixels), interpolation=cv2.INTER_NEAREST)
+
+
+def write_heatmap(path, grid, min_tile_x, min_tile_y, level, value, cell_pixels):
+    cv2.imwrite(str(path), heatmap_image(grid, cell_pixels))
+
+    # Each tile at level is cell_pixels wide in the image, rather than 256
+    geotransform = mercator_geotransform(min_tile_x * 256, min_tile_y * 256, level)
+    scale = 256 / cell_pixels
+    sidecar = {
+        "level" : level,
+        "tile_x" : min_tile_x,
+        "tile_y" : min_tile_y,
+        "value" : value,
+        "max" : float(grid.max()) if grid.size else 0,
+        "total" : float(grid.sum()),
+        "crs" : "EPSG:3857",
+        "geotransform" : [geotransform[0], geotransform[1] * scale, 0, geotransform[3], 0, geotransform[5] * scale]
+    }
+    with open(Path(str(path) + ".json"), "w") as out:
+        json.dump(sidecar, out, indent=2)
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--pyramid", dest="pyramid", default="data/density/pyramid.npz",
+                        help="A pyramid saved by build_density_pyramid.py")
+    parser.add_argument("--box", dest="box", type=float, nargs=4, default=None, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"),
+                        help="Query this lat/lon box, all of the pyramid's buildings by default")
+    parser.add_argument("-z", "--zoomLevel", dest="zoomLevel", type=int, default=None,
+                        help="Level of the tiles to query, the pyramid's finest level by default")
+    parser.add_argument("--top", dest="top", type=int, default=10,
+                        help="List this many of the densest tiles in the box")
+    parser.add_argument("--heatmap", dest="heatmap", default=None,
+                        help="Save a heatmap of the box into this image file")
+    parser.add_argument("--value", dest="value", choices=["count", "area"], default="count",
+                        help="Map building count or footprint area per tile")
+    parser.add_argument("--cellPixels", dest="cellPixels", type=int, default=1,
+                        help="Width of each tile in the heatmap, in pixels")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    pyramid = DensityPyramid.load(args.pyramid)
+    level = pyramid.base_level if args.zoomLevel is None else args.zoomLevel
+    box = args.box if args.box is not None else pyramid.bounds()
+
+    (buildings, area) = pyramid.totals(*box, level)
+    print("%s buildings covering %.0f square metres in the box at zoom %s" % (buildings, area, level))
+
+    for tile in pyramid.densest(level, args.top, box):
+        width = tile_size_metres(tile["lat"], level)
+        print("%s  %.5f,%.5f  %s buildings  %.0f m2  %.1f buildings per km2" %
+              (tile["quadkey"], tile["lat"], tile["lon"], tile["buildings"], tile["area"], tile["buildings"] / (width * width) * 1e6))
+
+    if args.heatmap is not None:
+        (min_tile_x, min_tile_y, grid) = pyramid.grid(*box, level, args.value)
+        write_heatmap(args.heatmap, grid, min_tile_x, min_tile_y, level, args.value, args.cellPixels)
+        print("Saved a %sx%s tile heatmap into %s" % (grid.shape[1], grid.shape[0], args.heatmap))
@@ -0,0 +1,391 @@
+"""
+    Runs the whole data collection pipeline, from a project text search to training pairs:
+
+        enumerate -> regions -> tasks -> buildings -> tiles -> training
+
+    Each stage writes the same files its standalone script does, under --dataFolder. Finished stages
+    leave a marker under <dataFolder>/checkpoints and per item stages keep a journal there, so a
+    re-run skips whatever is already done. Building lookups and tile fetches run together: tiles for
+    a task are fetched as soon as its buildings are written, while later tasks are still queried.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from queue import Queue
+from tqdm import tqdm
+from util import fetching, httpcache, metrics, tileindex
+from util.journal import Journal
+from util.tileindex import TileIndex
+
+import collect_building_geometries
+import enumerate_projects
+import fetch_bing_tiles
+import get_project_regions
+import get_validated_task_bounds
+import json
+import subprocess
+import sys
+import threading
+import urllib
+
+STAGES = ["enumerate", "regions", "tasks", "buildings", "tiles", "training"]
+_FINISHED = object()
+
+
+def get_checkpoint_folder(data_folder):
+    path = Path(data_folder) / "checkpoints"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def is_stage_done(data_folder, stage):
+    return (get_checkpoint_folder(data_folder) / ("%s.done" % stage)).exists()
+
+
+def mark_stage_done(data_folder, stage):
+    (get_checkpoint_folder(data_folder) / ("%s.done" % stage)).touch()
+
+
+def open_stage_journal(data_folder, stage):
+    return Journal(get_checkpoint_folder(data_folder) / ("%s.journal" % stage))
+
+
+def run_enumerate(args):
+    output_file = enumerate_projects.get_output_file(args.textSearch, Path(args.dataFolder) / "projects")
+
+    if not is_stage_done(args.dataFolder, "enumerate"):
+        results = enumerate_projects.search_hot_projects(args.textSearch)
+        with open(output_file, "w") as out:
+            json.dump(results, out)
+
+        print("Found %s projects matching '%s'" % (len(results), args.textSearch))
+        mark_stage_done(args.dataFolder, "enumerate")
+
+    return [str(project_id) for project_id in get_project_regions.iterate_project_ids(output_file)]
+
+
+def run_regions(args, project_ids):
+    output_folder = Path(args.dataFolder) / "regions"
+
+    if is_stage_done(args.dataFolder, "regions"):
+        return
+
+    def fetch_region(project_id):
+        region = get_project_regions.get_region_information(project_id)
+        with open(get_project_regions.get_output_file(project_id, output_folder), "w") as out:
+            json.dump(region, out)
+
+    with open_stage_journal(args.dataFolder, "regions") as journal:
+        pending = [p for p in project_ids if not journal.is_done(p)]
+
+        for (project_id, _, error) in tqdm(fetching.bounded_map(fetch_region, pending, args.regionWorkers), total=len(pending), desc="regions"):
+            if error is None:
+                journal.record_done(project_id)
+            else:
+                print("WARN: region lookup for project %s failed: %s" % (project_id, error))
+                journal.record_failed(project_id, repr(error))
+
+        if len(journal.failed) == 0:
+            mark_stage_done(args.dataFolder, "regions")
+
+
+def run_tasks(args, project_ids):
+    """
+        Returns the task CSV of every project whose region we have.
+    """
+    region_folder = Path(args.dataFolder) / "regions"
+    output_folder = Path(args.dataFolder) / "validated_tasks"
+    task_files = []
+
+    for project_id in project_ids:
+        region_file = region_folder / ("%s.json" % project_id)
+        output_file = get_validated_task_bounds.get_output_file(project_id, output_folder)
+
+        if not output_file.exists() and region_file.exists():
+            region = get_validated_task_bounds.load_region_tasks(region_file)
+            partial_file = output_file.with_name(output_file.name + ".partial")
+            with open(partial_file, "w") as out:
+                irregular_tasks = get_validated_task_bounds.write_tasks_to_csv(out, region, region["projectId"])
+            get_validated_task_bounds.write_task_geometries(output_file, irregular_tasks)
+            partial_file.replace(output_file)
+
+        if output_file.exists():
+            task_files.append(output_file)
+
+    mark_stage_done(args.dataFolder, "tasks")
+    return task_files
+
+
+def task_key(task):
+    return "%s/%s" % (task["project_id"], task["task_id"])
+
+
+def drop_unfinished_rows(building_file, journal):
+    """
+        Removes rows for tasks that were being written when a previous run stopped, so they can be
+        written again in full without duplicates.
+    """
+    if not building_file.exists():
+        return
+
+    # Rows are streamed into a partial file, which only replaces the original if anything was dropped
+    partial_file = building_file.with_name(building_file.name + ".partial")
+    dropped = 0
+
+    with open(building_file, "r") as f, open(partial_file, "w") as out:
+        out.write(f.readline())
+        for line in f:
+            if journal.is_done("/".join(line.split(",", 2)[:2])):
+                out.write(line)
+            else:
+                dropped = dropped + 1
+
+    if dropped > 0:
+        partial_file.replace(building_file)
+    else:
+        partial_file.unlink()
+
+
+def run_buildings(args, task_files, finished_tasks):
+    """
+        Looks up buildings for every task not yet done, appending to each project's building CSV.
+        Every task whose buildings are on disk, from this run or an earlier one, is put on
+        finished_tasks for the tile stage, followed by _FINISHED.
+    """
+    output_folder = Path(args.dataFolder) / "validated_buildings"
+    rate_limiter = fetching.RateLimiter(args.overpassRateLimit)
+
+    try:
+        with open_stage_journal(args.dataFolder, "buildings") as journal:
+            for task_file in task_files:
+                tasks = list(collect_building_geometries.load_tasks_from_file(task_file))
+                if len(tasks) == 0:
+                    continue
+
+                building_file = collect_building_geometries.get_output_file(tasks[0]["project_id"], output_folder)
+                drop_unfinished_rows(building_file, journal)
+
+                for task in tasks:
+                    if journal.is_done(task_key(task)):
+                        finished_tasks.put(task)
+
+                pending = [t for t in tasks if not journal.is_done(task_key(t))]
+                if len(pending) == 0:
+                    continue
+
+                with open(building_file, "a") as out:
+                    if out.tell() == 0:
+                        out.write("project_id,task_id,way_id,bbox\n")
+
+                    groups = collect_building_geometries.group_tasks(pending, args.maxQueryArea, args.maxTasksPerQuery)
+                    for ((_, group), polygons_per_task, _, error) in collect_building_geometries.find_buildings_for_groups(
+                            groups, args.overpassWorkers, args.overpassUrl, rate_limiter=rate_limiter):
+
+                        if error is not None:
+                            print("WARN: building lookup for tasks %s failed: %s" % ([task_key(t) for t in group], error))
+                            for task in group:
+                                journal.record_failed(task_key(task), repr(error))
+                            continue
+
+                        for (task, building_polygons) in zip(group, polygons_per_task):
+                            collect_building_geometries.write_polygons_to_csv(task["project_id"], task["task_id"], building_polygons, out)
+                            out.flush()
+                            journal.record_done(task_key(task))
+                            finished_tasks.put(task)
+
+            if len(journal.failed) == 0:
+                mark_stage_done(args.dataFolder, "buildings")
+    finally:
+        finished_tasks.put(_FINISHED)
+
+
+def iterate_new_quadkeys(finished_tasks, zoom_level, output_folder, journal, index=None):
+    """
+        Quadkeys of tasks as they arrive on finished_tasks, each once, skipping tiles already fetched.
+    """
+    seen = set()
+
+    while True:
+        task = finished_tasks.get()
+        if task is _FINISHED:
+            return
+
+        for quadkey in fetch_bing_tiles.enumerate_unique_quadkeys([task], zoom_level):
+            if quadkey in seen:
+                continue
+            seen.add(quadkey)
+
+            if fetch_bing_tiles.needs_fetch(quadkey, output_folder, journal, index=index):
+                yield quadkey
+
+
+def get_tile_url(args, task_files):
+    if args.tileUrl is not None:
+        return urllib.parse.urlparse(args.tileUrl)
+
+    for task_file in task_files:
+        for task in fetch_bing_tiles.load_tasks_from_file(task_file):
+            map_metadata = fetch_bing_tiles.fetch_map_metadata(float(task["min_lat"]), float(task["min_lon"]), fetch_bing_tiles.load_api_key())
+            return urllib.parse.urlparse(fetch_bing_tiles.get_image_url(map_metadata))
+
+    return None
+
+
+def run_buildings_and_tiles(args, task_files):
+    """
+        Runs the building stage on a background thread, fetching tiles for each task it finishes.
+    """
+    zoom_level = args.zoomLevel
+    map_tiles = Path(args.dataFolder) / "map_tiles"
+    output_folder = fetch_bing_tiles.get_shared_output_folder(zoom_level, map_tiles)
+    finished_tasks = Queue(maxsize=10000)
+
+    if is_stage_done(args.dataFolder, "buildings") and is_stage_done(args.dataFolder, "tiles"):
+        return
+
+    # An exception on the building thread is re-raised here once it has been joined
+    errors = []
+
+    def run():
+        try:
+            run_buildings(args, task_files, finished_tasks)
+        except Exception as e:
+            errors.append(e)
+
+    buildings = threading.Thread(target=run, daemon=True)
+    buildings.start()
+
+    offline = fetching.is_offline()
+    url = get_tile_url(args, task_files) if not offline else None
+    rate_limiter = fetching.RateLimiter(args.tileRateLimit)
+    saved = 0
+    placeholders = 0
+
+    with Journal(fetch_bing_tiles.get_journal_path(zoom_level, map_tiles)) as journal, TileIndex(output_folder, writable=True) as index:
+        quadkeys = iterate_new_quadkeys(finished_tasks, zoom_level, output_folder, journal, index)
+
+        # Tiles are never cached, so offline the building stage runs alone and the tile stage stays unfinished
+        if offline:
+            skipped = sum(1 for _ in quadkeys)
+            buildings.join()
+            if len(errors) > 0:
+                raise errors[0]
+            print("Offline, so not fetching the %s tiles still needed" % skipped)
+            metrics.increment("tiles_skipped", skipped, reason="offline")
+            return
+
+        for (quadkey, status, error) in tqdm(fetch_bing_tiles.fetch_tiles(quadkeys, url, output_folder, args.tileWorkers, args.tileMaxAttempts, rate_limiter, index=index), desc="tiles"):
+            if error is not None:
+                journal.record_failed(quadkey, repr(error))
+            elif status == tileindex.PLACEHOLDER:
+                journal.record_done(quadkey)
+                placeholders = placeholders + 1
+            else:
+                journal.record_done(quadkey)
+                saved = saved + 1
+
+        buildings.join()
+        if len(errors) > 0:
+            raise errors[0]
+        print("Written %s tiles to %s, skipped %s placeholders, %s failed" % (saved, output_folder, placeholders, len(journal.failed)))
+
+        if is_stage_done(args.dataFolder, "buildings") and len(journal.failed) == 0:
+            mark_stage_done(args.dataFolder, "tiles")
+
+
+def run_training(args, task_files):
+    """
+        Runs generate_training_and_truth.py for each project's buildings, in its own process pool,
+        once every building and tile is in. Projects are journaled by file name and size, so one
+        whose buildings changed since its pairs were made is made again.
+    """
+    building_folder = Path(args.dataFolder) / "validated_buildings"
+    script = Path(__file__).parent / "generate_training_and_truth.py"
+
+    if not (is_stage_done(args.dataFolder, "buildings") and is_stage_done(args.dataFolder, "tiles")):
+        print("Buildings or tiles are still unfinished, so not making training pairs yet")
+        return
+
+    with open_stage_journal(args.dataFolder, "training") as journal:
+        for building_file in sorted(building_folder.glob("*-buildings.csv")):
+            key = "%s:%s" % (building_file.name, building_file.stat().st_size)
+            if journal.is_done(key):
+                continue
+
+            subprocess.run([sys.executable, str(script), "-b", str(building_file), "-z", str(args.zoomLevel),
+                            "-m", str(Path(args.dataFolder) / "map_tiles"), "-o", str(Path(args.dataFolder) / "training"),
+                            "-w", str(args.trainingWorkers)], check=True)
+            journal.record_done(key)
+
+    mark_stage_done(args.dataFolder, "training")
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-t", "--textSearch", dest="textSearch",
+                        help="Find matching projects containing this text")
+    parser.add_argument("-z", "--zoomLevel", dest="zoomLevel", type=int,
+                        help="Level of zoom at which to retrieve tiles and prepare training data")
+    parser.add_argument("-d", "--dataFolder", dest="dataFolder", default="data",
+                        help="Root folder for every stage's output and checkpoints")
+    parser.add_argument("--stopAfter", dest="stopAfter", choices=STAGES, default="training",
+                        help="Stop once this stage is done")
+    parser.add_argument("--regionWorkers", dest="regionWorkers", type=int, default=4,
+                        help="Number of region lookups to run concurrently")
+    parser.add_argument("--overpassWorkers", dest="overpassWorkers", type=int, default=2,
+                        help="Number of Overpass queries to run concurrently")
+    parser.add_argument("--overpassRateLimit", dest="overpassRateLimit", type=float, default=1,
+                        help="Maximum Overpass queries per second")
+    parser.add_argument("--overpassUrl", dest="overpassUrl", default=collect_building_geometries.OVERPASS_URL,
+                        help="Overpass API interpreter endpoint")
+    parser.add_argument("--maxTasksPerQuery", dest="maxTasksPerQuery", type=int, default=1,
+                        help="Merge up to this many neighbouring tasks into one Overpass query")
+    parser.add_argument("--maxQueryArea", dest="maxQueryArea", type=float, default=0.0025,
+                        help="Only merge tasks within grid cells of this many square degrees")
+    parser.add_argument("--tileWorkers", dest="tileWorkers", type=int, default=8,
+                        help="Number of tiles to fetch concurrently")
+    parser.add_argument("--tileRateLimit", dest="tileRateLimit", type=float, default=None,
+                        help="Maximum tile requests per second")
+    parser.add_argument("--tileMaxAttempts", dest="tileMaxAttempts", type=int, default=5,
+                        help="Attempts per tile before giving up, with exponential backoff between them")
+    parser.add_argument("--tileUrl", dest="tileUrl", default=None,
+                        help="Fetch tiles from this base url instead of looking it up from Bing")
+    parser.add_argument("--trainingWorkers", dest="trainingWorkers", type=int, default=1,
+                        help="Number of processes drawing masks and writing training pairs")
+    httpcache.add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    fetching.set_default_cache(httpcache.cache_from_arguments(args))
+    exporter = metrics.metrics_from_arguments(args)
+    last_stage = STAGES.index(args.stopAfter)
+
+    with metrics.stage("enumerate"):
+        project_ids = run_enumerate(args)
+
+    if last_stage >= STAGES.index("regions"):
+        with metrics.stage("regions"):
+            run_regions(args, project_ids)
+
+    if last_stage >= STAGES.index("tasks"):
+        with metrics.stage("tasks"):
+            task_files = run_tasks(args, project_ids)
+
+    if last_stage == STAGES.index("buildings"):
+        with metrics.stage("buildings"):
+            run_buildings(args, task_files, Queue())
+    elif last_stage >= STAGES.index("tiles"):
+        with metrics.stage("buildings_and_tiles"):
+            run_buildings_and_tiles(args, task_files)
+
+    if last_stage >= STAGES.index("training"):
+        with metrics.stage("training"):
+            run_training(args, task_files)
+
+    if exporter is not None:
+        exporter.close()
@@ -3,7 +3,9 @@
     Based on documentation at: https://msdn.microsoft.com/en-us/library/bb259689.aspx?f=255&MSPPError=-2147217396
 """
 
-from math import floor, log, pi, pow, sin
+from math import atan, exp, floor, log, pi, pow, sin
+
+import numpy as np
 
 EARTH_RADIUS = 6378137;
 MIN_LATITUDE = -85.05112878;
@@ -42,6 +44,21 @@ def pixel_xy_to_tile_xy(pixel_x, pixel_y):
     return (tile_x, tile_y)
 
 
+def pixel_xy_to_lat_lon(pixel_x, pixel_y, level_of_detail):
+    """
+        Inverse of lat_lon_to_pixel_xy, giving the lat/lon of a pixel's top left corner.
+    """
+    pixel_size = BING_TILE_SIZE_PIXELS * map_size(level_of_detail)
+
+    x = (clip(pixel_x, 0, pixel_size - 1) / pixel_size) - 0.5
+    y = 0.5 - (clip(pixel_y, 0, pixel_size - 1) / pixel_size)
+
+    latitude = 90 - 360 * atan(exp(-y * 2 * pi)) / pi
+    longitude = 360 * x
+
+    return (latitude, longitude)
+
+
 def lat_lon_to_tile_xy(latitude, longitude, level_of_detail):
     (pixel_x, pixel_y) = lat_lon_to_pixel_xy(latitude, longitude, level_of_detail)
     return pixel_xy_to_tile_xy(pixel_x, pixel_y) 
@@ -64,6 +81,31 @@ def tile_xy_to_quadkey(tile_x, tile_y, level_of_detail):
     return quadkey
 
 
+def quadkey_to_tile_xy(quadkey):
+    """
+        Inverse of tile_xy_to_quadkey, returns (tile_x, tile_y, level_of_detail).
+    """
+    tile_x = 0
+    tile_y = 0
+    level_of_detail = len(quadkey)
+
+    for i in reversed(range(level_of_detail)):
+        mask = 1 << i
+        digit = quadkey[level_of_detail - i - 1]
+
+        if digit == "1":
+            tile_x = tile_x | mask
+        elif digit == "2":
+            tile_y = tile_y | mask
+        elif digit == "3":
+            tile_x = tile_x | mask
+            tile_y = tile_y | mask
+        elif digit != "0":
+            raise ValueError("Invalid quadkey digit sequence: %s" % quadkey)
+
+    return (tile_x, tile_y, level_of_detail)
+
+
 def quadkey_containing_lat_lon(latitude, longitude, level_of_detail):
     (pixel_x, pixel_y) = lat_lon_to_pixel_xy(latitude, longitude, level_of_detail)
     (tile_x, tile_y) = pixel_xy_to_tile_xy(pixel_x, pixel_y)
@@ -100,3 +142,97 @@ def pixel_xy_relative_to_tile(lat, lon, level_of_detail):
     relative_pixel_y = pixel_y - tile_pixel_y
     return (relative_pixel_x, relative_pixel_y)
 
+
+
+
+# Batch versions of the above, operating on whole NumPy columns of lat/lons at once.
+# These follow the scalar functions step for step so that results agree exactly.
+
+def lat_lon_to_pixel_xy_batch(latitudes, longitudes, level_of_detail):
+    latitudes = np.clip(np.asarray(latitudes, dtype=np.float64), MIN_LATITUDE, MAX_LATITUDE)
+    longitudes = np.clip(np.asarray(longitudes, dtype=np.float64), MIN_LONGITUDE, MAX_LONGITUDE)
+
+    pixel_size = BING_TILE_SIZE_PIXELS * map_size(level_of_detail)
+
+    x = (longitudes + 180) / 360 * pixel_size
+    sin_latitudes = np.sin(latitudes * pi / 180)
+    y = (0.5 - np.log((1 + sin_latitudes) / (1 - sin_latitudes)) / (4 * pi)) * pixel_size
+
+    pixel_x = np.clip(x + 0.5, 0, pixel_size - 1).astype(np.int64)
+    pixel_y = np.clip(y + 0.5, 0, pixel_size - 1).astype(np.int64)
+
+    return (pixel_x, pixel_y)
+
+
+def lat_lon_to_world_xy_batch(latitudes, longitudes):
+    """
+        Unrounded Web Mercator coordinates in [0, 1), scaled by 2^level giving fractional tiles,
+        or by 256 * 2^level giving fractional pixels.
+    """
+    latitudes = np.clip(np.asarray(latitudes, dtype=np.float64), MIN_LATITUDE, MAX_LATITUDE)
+    longitudes = np.clip(np.asarray(longitudes, dtype=np.float64), MIN_LONGITUDE, MAX_LONGITUDE)
+
+    x = (longitudes + 180) / 360
+    sin_latitudes = np.sin(latitudes * pi / 180)
+    y = 0.5 - np.log((1 + sin_latitudes) / (1 - sin_latitudes)) / (4 * pi)
+
+    return (x, y)
+
+
+def pixel_xy_to_lat_lon_batch(pixel_x, pixel_y, level_of_detail):
+    pixel_size = BING_TILE_SIZE_PIXELS * map_size(level_of_detail)
+
+    x = (np.clip(np.asarray(pixel_x, dtype=np.float64), 0, pixel_size - 1) / pixel_size) - 0.5
+    y = 0.5 - (np.clip(np.asarray(pixel_y, dtype=np.float64), 0, pixel_size - 1) / pixel_size)
+
+    latitudes = 90 - 360 * np.arctan(np.exp(-y * 2 * pi)) / pi
+    longitudes = 360 * x
+
+    return (latitudes, longitudes)
+
+
+def pixel_xy_to_tile_xy_batch(pixel_x, pixel_y):
+    tile_x = np.floor_divide(pixel_x, BING_TILE_SIZE_PIXELS)
+    tile_y = np.floor_divide(pixel_y, BING_TILE_SIZE_PIXELS)
+    return (tile_x, tile_y)
+
+
+def lat_lon_to_tile_xy_batch(latitudes, longitudes, level_of_detail):
+    (pixel_x, pixel_y) = lat_lon_to_pixel_xy_batch(latitudes, longitudes, level_of_detail)
+    return pixel_xy_to_tile_xy_batch(pixel_x, pixel_y)
+
+
+def tile_xy_to_quadkey_batch(tile_x, tile_y, level_of_detail):
+    """
+        Returns an array of quadkey strings, built from one column of digits per level
+        rather than one character at a time.
+    """
+    tile_x = np.asarray(tile_x, dtype=np.int64)
+    tile_y = np.asarray(tile_y, dtype=np.int64)
+
+    if level_of_detail == 0:
+        return np.full(tile_x.shape, "", dtype="U1")
+
+    shifts = np.arange(level_of_detail - 1, -1, -1, dtype=np.int64)
+    digits = ((tile_x[..., None] >> shifts) & 1) + 2 * ((tile_y[..., None] >> shifts) & 1)
+    characters = np.ascontiguousarray((digits + ord("0")).astype(np.uint8))
+
+    return characters.view("S%s" % level_of_detail)[..., 0].astype("U%s" % level_of_detail)
+
+
+def quadkey_containing_lat_lon_batch(latitudes, longitudes, level_of_detail):
+    (tile_x, tile_y) = lat_lon_to_tile_xy_batch(latitudes, longitudes, level_of_detail)
+    return tile_xy_to_quadkey_batch(tile_x, tile_y, level_of_detail)
+
+
+def pixel_xy_relative_to_tile_batch(latitudes, longitudes, level_of_detail):
+    """
+        Returns (pixel_x, pixel_y, tile_x, tile_y, relative_pixel_x, relative_pixel_y) arrays
+        for the given lat/lon columns, so callers get all of them from a single pass.
+    """
+    (pixel_x, pixel_y) = lat_lon_to_pixel_xy_batch(latitudes, longitudes, level_of_detail)
+    (tile_x, tile_y) = pixel_xy_to_tile_xy_batch(pixel_x, pixel_y)
+
+    relative_pixel_x = pixel_x - tile_x * BING_TILE_SIZE_PIXELS
+    relative_pixel_y = pixel_y - tile_y * BING_TILE_SIZE_PIXELS
+    return (pixel_x, pixel_y, tile_x, tile_y, relative_pixel_x, relative_pixel_y)
@@ -0,0 +1,262 @@
+"""
+    Compact binary building geometry files.
+
+    Layout, all little-endian, with every section starting on an 8 byte boundary:
+
+        header      64 bytes: magic "MTSGBLDG", uint32 version, uint32 precision (decimal places),
+                    uint64 building count, uint64 vertex count, zero padding
+        project_ids int64[buildings]
+        task_ids    int64[buildings]
+        way_ids     int64[buildings]
+        offsets     int64[buildings + 1], polygon i is vertices offsets[i]:offsets[i + 1]
+        latitudes   int32[vertices]
+        longitudes  int32[vertices]
+
+    Coordinates are fixed point, round(degrees * 10^precision). Within each polygon the first vertex
+    is stored as is and the rest as deltas from the previous vertex. OSM stores coordinates to 7
+    decimal places, so the default precision round trips Overpass output exactly.
+"""
+
+from itertools import chain
+from pathlib import Path
+
+import mmap
+import shutil
+
+import numpy as np
+
+from util.buildings import BuildingTable, load_buildings_columnar
+
+MAGIC = b"MTSGBLDG"
+VERSION = 1
+DEFAULT_PRECISION = 7
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("precision", "<u4"),
+                         ("buildings", "<u8"), ("vertices", "<u8")])
+HEADER_SIZE = 64
+CSV_HEADER = "project_id,task_id,way_id,bbox\n"
+
+# BuildingBinaryWriter spills these per task, deriving offsets from the lengths on close
+SPILLED_SECTIONS = [("project_ids", "<i8"), ("task_ids", "<i8"), ("way_ids", "<i8"), ("lengths", "<i8"),
+                    ("latitudes", "<i4"), ("longitudes", "<i4")]
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+def _section_layout(buildings, vertices):
+    """
+        (name, dtype, count, offset) of each section after the header.
+    """
+    sections = [("project_ids", "<i8", buildings), ("task_ids", "<i8", buildings), ("way_ids", "<i8", buildings),
+                ("offsets", "<i8", buildings + 1), ("latitudes", "<i4", vertices), ("longitudes", "<i4", vertices)]
+
+    layout = []
+    position = HEADER_SIZE
+    for (name, dtype, count) in sections:
+        layout.append((name, np.dtype(dtype), count, position))
+        position = _aligned(position + np.dtype(dtype).itemsize * count)
+
+    return layout
+
+
+def to_fixed_point(degrees, precision):
+    """
+        Raises ValueError if any coordinate carries more decimal places than precision.
+    """
+    scale = 10 ** precision
+    fixed = np.round(np.asarray(degrees, dtype=np.float64) * scale)
+
+    if np.any(fixed / scale != degrees):
+        raise ValueError("Coordinates are not representable at %s decimal places" % precision)
+    if np.any(np.abs(fixed) > np.iinfo(np.int32).max):
+        raise ValueError("Coordinates overflow int32 at %s decimal places" % precision)
+
+    return fixed.astype(np.int64)
+
+
+def delta_encode(values, offsets):
+    deltas = np.diff(values, prepend=0)
+    starts = offsets[:-1][offsets[:-1] < offsets[1:]]
+    deltas[starts] = values[starts]
+    return deltas
+
+
+def delta_decode(deltas, offsets):
+    """
+        Undoes delta_encode with a single cumulative sum, restarting at each polygon's first vertex.
+    """
+    totals = np.cumsum(deltas, dtype=np.int64)
+    before_polygon = np.concatenate([[0], totals])[offsets[:-1]]
+    return totals - np.repeat(before_polygon, np.diff(offsets))
+
+
+def write_buildings_binary(path, table, precision=DEFAULT_PRECISION):
+    buildings = len(table.way_ids)
+    vertices = int(table.offsets[-1])
+    offsets = np.asarray(table.offsets, dtype=np.int64)
+
+    columns = {
+        "project_ids": table.project_ids,
+        "task_ids": table.task_ids,
+        "way_ids": table.way_ids,
+        "offsets": offsets,
+        "latitudes": delta_encode(to_fixed_point(table.latitudes, precision), offsets),
+        "longitudes": delta_encode(to_fixed_point(table.longitudes, precision), offsets)
+    }
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header[0] = (MAGIC, VERSION, precision, buildings, vertices)
+
+    with open(path, "wb") as out:
+        out.write(header.tobytes().ljust(HEADER_SIZE, b"\0"))
+
+        for (name, dtype, count, position) in _section_layout(buildings, vertices):
+            out.write(b"\0" * (position - out.tell()))
+            out.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+
+
+def map_buildings_binary(path):
+    """
+        Memory maps a binary building file. Returns (precision, columns) where columns are read only
+        arrays backed by the file, with coordinates still delta encoded.
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header = np.frombuffer(data, dtype=HEADER_DTYPE, count=1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError("%s is not a binary building file" % path)
+    if header["version"] != VERSION:
+        raise ValueError("%s has unsupported version %s, expected %s" % (path, header["version"], VERSION))
+
+    columns = {}
+    for (name, dtype, count, position) in _section_layout(int(header["buildings"]), int(header["vertices"])):
+        columns[name] = np.frombuffer(data, dtype=dtype, count=count, offset=position)
+
+    return (int(header["precision"]), columns)
+
+
+def read_buildings_binary(path):
+    (precision, columns) = map_buildings_binary(path)
+    scale = 10 ** precision
+    offsets = columns["offsets"]
+
+    return BuildingTable(columns["project_ids"], columns["task_ids"], columns["way_ids"],
+                         delta_decode(columns["latitudes"], offsets) / scale,
+                         delta_decode(columns["longitudes"], offsets) / scale, offsets)
+
+
+def read_polygon(mapped, i):
+    """
+        Random access to polygon i's (latitudes, longitudes) from map_buildings_binary output.
+    """
+    (precision, columns) = mapped
+    (start, end) = columns["offsets"][i], columns["offsets"][i + 1]
+    scale = 10 ** precision
+    return (np.cumsum(columns["latitudes"][start:end], dtype=np.int64) / scale,
+            np.cumsum(columns["longitudes"][start:end], dtype=np.int64) / scale)
+
+
+def is_binary_building_file(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_buildings(path):
+    """
+        Loads a BuildingTable from either a binary building file or a building CSV.
+    """
+    if is_binary_building_file(path):
+        return read_buildings_binary(path)
+    return load_buildings_columnar(path)
+
+
+def write_buildings_csv(out, table):
+    """
+        Writes rows the way collect_building_geometries.write_polygons_to_csv does.
+    """
+    out.write(CSV_HEADER)
+    latitudes = table.latitudes.tolist()
+    longitudes = table.longitudes.tolist()
+    offsets = table.offsets.tolist()
+
+    for i in range(len(table.way_ids)):
+        row = [table.project_ids[i], table.task_ids[i], table.way_ids[i]]
+        for j in range(offsets[i], offsets[i + 1]):
+            row.append(latitudes[j])
+            row.append(longitudes[j])
+        out.write(",".join([str(r) for r in row]))
+        out.write("\n")
+
+
+class BuildingBinaryWriter:
+    """
+        Collects polygons task by task, in the shape convert_to_polygons returns them, and writes
+        one binary building file on close. Each task is converted to fixed point as it arrives and
+        appended to a spill file per section beside the output, so memory stays bounded by a task.
+    """
+
+    def __init__(self, path, precision=DEFAULT_PRECISION):
+        self.path = Path(path)
+        self.precision = precision
+        self.buildings = 0
+        self.vertices = 0
+        self.spills = dict((name, open(self._spill_path(name), "w+b")) for (name, _) in SPILLED_SECTIONS)
+
+    def _spill_path(self, name):
+        return self.path.with_name("%s.%s.partial" % (self.path.name, name))
+
+    def write_polygons(self, project_id, task_id, building_polygons):
+        if len(building_polygons) == 0:
+            return
+
+        lengths = np.array([(len(building) - 1) // 2 for building in building_polygons], dtype=np.int64)
+        coordinates = np.fromiter(chain.from_iterable(building[1:] for building in building_polygons),
+                                  dtype=np.float64, count=2 * lengths.sum()).reshape(-1, 2)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        columns = {
+            "project_ids": np.full(len(lengths), int(project_id)),
+            "task_ids": np.full(len(lengths), int(task_id)),
+            "way_ids": np.array([building[0] for building in building_polygons], dtype=np.int64),
+            "lengths": lengths,
+            "latitudes": delta_encode(to_fixed_point(coordinates[:, 0], self.precision), offsets),
+            "longitudes": delta_encode(to_fixed_point(coordinates[:, 1], self.precision), offsets)
+        }
+
+        for (name, dtype) in SPILLED_SECTIONS:
+            self.spills[name].write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+
+        self.buildings = self.buildings + len(lengths)
+        self.vertices = self.vertices + int(offsets[-1])
+
+    def close(self):
+        for spill in self.spills.values():
+            spill.flush()
+            spill.seek(0)
+
+        lengths = np.fromfile(self.spills["lengths"], dtype="<i8")
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header[0] = (MAGIC, VERSION, self.precision, self.buildings, self.vertices)
+        partial_path = self.path.with_name(self.path.name + ".partial")
+
+        with open(partial_path, "wb") as out:
+            out.write(header.tobytes().ljust(HEADER_SIZE, b"\0"))
+
+            for (name, dtype, count, position) in _section_layout(self.buildings, self.vertices):
+                out.write(b"\0" * (position - out.tell()))
+                if name == "offsets":
+                    out.write(offsets.astype(dtype).tobytes())
+                else:
+                    shutil.copyfileobj(self.spills[name], out)
+
+        partial_path.replace(self.path)
+
+        for (name, spill) in self.spills.items():
+            spill.close()
+            self._spill_path(name).unlink()
@@ -0,0 +1,206 @@
+"""
+    Columnar building geometry, and vectorized passes over it.
+
+    Buildings are held as a BuildingTable of parallel columns rather than one object per building:
+    polygon i's vertices are latitudes[offsets[i]:offsets[i + 1]] and longitudes[offsets[i]:offsets[i + 1]].
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from util import bingmaps, metrics, polygons, quadkeys
+
+BuildingTable = namedtuple("BuildingTable", ["project_ids", "task_ids", "way_ids", "latitudes", "longitudes", "offsets"])
+
+
+def concatenate_tables(tables):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for table in tables:
+        offsets.append(table.offsets[1:] + offsets[-1][-1])
+
+    return BuildingTable(*[np.concatenate([getattr(t, column) for t in tables]) for column in BuildingTable._fields[:-1]],
+                         np.concatenate(offsets))
+
+
+def take_buildings(table, indices):
+    """
+        A table of just the buildings at indices, in that order, gathering their vertices in one pass.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    lengths = np.diff(table.offsets)[indices]
+    offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    vertices = np.repeat(table.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return BuildingTable(table.project_ids[indices], table.task_ids[indices], table.way_ids[indices],
+                         table.latitudes[vertices], table.longitudes[vertices], offsets)
+
+
+def _parse_chunk(text):
+    """
+        Parses building CSV rows into id columns, a flat coordinate array and per row vertex counts.
+        Every number in the chunk is parsed by one np.fromstring call, and each row's field count
+        comes from where its newline falls among the chunk's commas, so no row is split in Python.
+    """
+    text = text.replace("\r", "").strip("\n")
+    while "\n\n" in text:
+        text = text.replace("\n\n", "\n")
+    if text == "":
+        return (np.zeros((0, 3), dtype=np.int64), np.zeros((0, 2)), np.zeros(0, dtype=np.int64))
+
+    raw = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    commas = np.flatnonzero(raw == ord(","))
+    row_ends = np.append(np.flatnonzero(raw == ord("\n")), len(raw))
+    fields = np.diff(np.searchsorted(commas, row_ends), prepend=0) + 1
+
+    if np.any(fields < 5) or np.any((fields - 3) % 2 != 0):
+        raise ValueError("Expected an even number of coordinates on every building row")
+
+    numbers = np.fromstring(text.replace("\n", ","), dtype=np.float64, sep=",")
+    if len(numbers) != fields.sum():
+        raise ValueError("Found a value that is not a number in a building row")
+
+    row_starts = np.cumsum(fields) - fields
+    ids = numbers[row_starts[:, None] + np.arange(3)].astype(np.int64)
+    is_coordinate = np.ones(len(numbers), dtype=bool)
+    is_coordinate[row_starts[:, None] + np.arange(3)] = False
+
+    return (ids, numbers[is_coordinate].reshape(-1, 2), (fields - 3) // 2)
+
+
+def load_buildings_columnar(building_csv, chunk_bytes=1024 * 1024):
+    """
+        Streams a project_id,task_id,way_id,bbox building CSV about chunk_bytes at a time into a
+        BuildingTable, without creating a Python object per row or per coordinate.
+    """
+    id_chunks = []
+    coordinate_chunks = []
+    length_chunks = []
+
+    with open(building_csv, "r") as f:
+        f.readline()
+        remainder = ""
+        finished = False
+
+        while not finished:
+            text = f.read(chunk_bytes)
+            finished = len(text) < chunk_bytes
+
+            # Hold back a partial last row for the next chunk
+            text = remainder + text
+            cut = len(text) if finished else text.rfind("\n") + 1
+            (text, remainder) = (text[:cut], text[cut:])
+
+            (ids, coordinates, lengths) = _parse_chunk(text)
+            id_chunks.append(ids)
+            coordinate_chunks.append(coordinates)
+            length_chunks.append(lengths)
+
+    ids = np.concatenate(id_chunks) if id_chunks else np.zeros((0, 3), dtype=np.int64)
+    coordinates = np.concatenate(coordinate_chunks) if coordinate_chunks else np.zeros((0, 2))
+    lengths = np.concatenate(length_chunks) if length_chunks else np.zeros(0, dtype=np.int64)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    return BuildingTable(ids[:, 0].copy(), ids[:, 1].copy(), ids[:, 2].copy(),
+                         coordinates[:, 0].copy(), coordinates[:, 1].copy(), offsets)
+
+
+def polygon_lengths(offsets):
+    return np.diff(offsets)
+
+
+def polygon_tile_ranges(pixel_x, pixel_y, offsets):
+    """
+        Per polygon (min_tile_x, min_tile_y, max_tile_x, max_tile_y), from global pixel coordinates.
+        Every polygon must have at least one vertex.
+    """
+    starts = offsets[:-1]
+    tile_x = pixel_x // bingmaps.BING_TILE_SIZE_PIXELS
+    tile_y = pixel_y // bingmaps.BING_TILE_SIZE_PIXELS
+
+    return (np.minimum.reduceat(tile_x, starts), np.minimum.reduceat(tile_y, starts),
+            np.maximum.reduceat(tile_x, starts), np.maximum.reduceat(tile_y, starts))
+
+
+def assign_polygons_to_tiles(pixel_x, pixel_y, offsets, single_tile_only=False):
+    """
+        Returns (polygon_index, tile_x, tile_y) with one entry for every tile each polygon's outline
+        or inside touches, so a diagonal building leaves out the corners of its bounding box's tile
+        range. With single_tile_only, polygons spanning more than one tile are dropped instead, as
+        bounding_box_entirely_in_same_tile does.
+    """
+    if single_tile_only:
+        (min_x, min_y, max_x, max_y) = polygon_tile_ranges(pixel_x, pixel_y, offsets)
+        polygon_index = np.flatnonzero((min_x == max_x) & (min_y == max_y))
+        return (polygon_index, min_x[polygon_index], min_y[polygon_index])
+
+    return polygons.polygon_tile_pairs(pixel_x / bingmaps.BING_TILE_SIZE_PIXELS,
+                                       pixel_y / bingmaps.BING_TILE_SIZE_PIXELS, offsets)
+
+
+def quadkeys_touched(table, zoom_level):
+    """
+        Quadkeys of every tile any building touches, each once, in quadkey order.
+    """
+    if len(table.way_ids) == 0:
+        return []
+
+    (pixel_x, pixel_y) = bingmaps.lat_lon_to_pixel_xy_batch(table.latitudes, table.longitudes, zoom_level)
+    (_, tile_x, tile_y) = assign_polygons_to_tiles(pixel_x, pixel_y, table.offsets)
+    return quadkeys.to_quadkeys(np.unique(quadkeys.encode(tile_x, tile_y, zoom_level))).tolist()
+
+
+def group_polygons_by_tile(table, zoom_level, single_tile_only=False):
+    """
+        Assigns every building to each tile it touches in one vectorized pass.
+        Returns (quadkey_buildings, quadkey_meta): per quadkey, a list of (n, 2) int32 arrays of
+        polygon pixel coordinates relative to that tile (clipped later when drawn), and the project
+        and task of the last building in the file touching it. Tiles are in quadkey order.
+    """
+    lengths = polygon_lengths(table.offsets)
+    if np.any(lengths == 0):
+        raise ValueError("Found %s buildings without any coordinates" % np.count_nonzero(lengths == 0))
+
+    if len(lengths) == 0:
+        return ({}, {})
+
+    (pixel_x, pixel_y) = bingmaps.lat_lon_to_pixel_xy_batch(table.latitudes, table.longitudes, zoom_level)
+    (polygon_index, tile_x, tile_y) = assign_polygons_to_tiles(pixel_x, pixel_y, table.offsets, single_tile_only)
+
+    metrics.increment("buildings_grouped", len(lengths))
+    if single_tile_only:
+        metrics.increment("buildings_dropped", len(lengths) - len(polygon_index), reason="crosses_tile")
+
+    keys = quadkeys.encode(tile_x, tile_y, zoom_level)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    polygon_index = polygon_index[order]
+    tile_x = tile_x[order]
+    tile_y = tile_y[order]
+
+    (unique_keys, group_starts) = np.unique(keys, return_index=True)
+    group_ends = np.append(group_starts[1:], len(keys))
+    tile_quadkeys = quadkeys.to_quadkeys(unique_keys).tolist() if len(unique_keys) > 0 else []
+
+    pixels = np.stack([pixel_x, pixel_y], axis=1)
+    quadkey_buildings = {}
+    quadkey_meta = {}
+
+    for (quadkey, start, end) in zip(tile_quadkeys, group_starts, group_ends):
+        origin = np.array([tile_x[start], tile_y[start]]) * bingmaps.BING_TILE_SIZE_PIXELS
+        polygons = []
+
+        for i in polygon_index[start:end]:
+            polygons.append((pixels[table.offsets[i]:table.offsets[i + 1]] - origin).astype(np.int32))
+
+        last = polygon_index[end - 1]
+        quadkey_buildings[quadkey] = polygons
+        quadkey_meta[quadkey] = {
+            "project_id" : str(table.project_ids[last]),
+            "task_id" : str(table.task_ids[last])
+        }
+
+    return (quadkey_buildings, quadkey_meta)
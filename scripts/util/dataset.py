@@ -0,0 +1,181 @@
+"""
+    Streams training batches straight from map tiles and the building index, drawing each mask on the
+    fly, so that no train/ and mask/ image folders need to be written before training.
+
+    TileMaskSequence follows the Keras Sequence protocol, and is a keras Sequence when TensorFlow is
+    installed, so it can be passed to model.fit directly. Tiles come back as RGB, as Keras' own image
+    loaders return them, and masks as a single 0/1 channel.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import math
+
+import cv2
+import numpy as np
+
+from util import buildingfile, buildings
+from util.masks import draw_mask
+from util.tilestore import TileStore
+
+try:
+    from tensorflow.keras.utils import Sequence
+except ImportError:
+    Sequence = object
+
+
+def find_tile_path(quadkey, project_id, task_id, zoom_level, map_tiles):
+    """
+        The tile's path under either the per task or the shared folder layout, or None if missing.
+    """
+    file_name = "a%s.jpeg" % quadkey
+    for path in [Path(map_tiles) / str(project_id) / str(task_id) / str(zoom_level) / file_name,
+                 Path(map_tiles) / str(zoom_level) / file_name]:
+        if path.exists():
+            return path
+
+    return None
+
+
+def read_tile_bytes(quadkey, project_id, task_id, zoom_level, map_tiles=None, tile_store=None):
+    """
+        The tile's bytes from a tile store, or from the folders under map_tiles. None if missing.
+    """
+    if tile_store is not None:
+        return tile_store.get(quadkey)
+
+    path = find_tile_path(quadkey, project_id, task_id, zoom_level, map_tiles)
+    return path.read_bytes() if path is not None else None
+
+
+def augment_pair(tile, mask, rng):
+    """
+        The same random flips and quarter turn applied to a tile and its mask.
+    """
+    if rng.random() < 0.5:
+        (tile, mask) = (tile[:, ::-1], mask[:, ::-1])
+    if rng.random() < 0.5:
+        (tile, mask) = (tile[::-1], mask[::-1])
+
+    turns = int(rng.integers(4))
+    return (np.rot90(tile, turns), np.rot90(mask, turns))
+
+
+class TileMaskSequence(Sequence):
+
+    def __init__(self, quadkey_buildings, quadkey_meta, zoom_level, batch_size=16, map_tiles=None, tile_store=None,
+                 shuffle=False, augment=False, rescale=1. / 255, workers=4, prefetch=2, seed=None):
+        """
+            quadkey_buildings and quadkey_meta are as buildings.group_polygons_by_tile returns them.
+            Give either a map_tiles folder or an open TileStore to read tiles from.
+        """
+        if map_tiles is None and tile_store is None:
+            raise ValueError("Need either a map tile folder or a tile store to read tiles from")
+
+        super().__init__()
+        self.quadkey_buildings = quadkey_buildings
+        self.quadkey_meta = quadkey_meta
+        self.zoom_level = zoom_level
+        self.batch_size = batch_size
+        self.map_tiles = map_tiles
+        self.tile_store = tile_store
+        self.shuffle = shuffle
+        self.augment = augment
+        self.rescale = rescale
+        self.prefetch = prefetch
+        self.rng = np.random.default_rng(seed)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.quadkeys = [q for q in quadkey_buildings.keys() if self._available(q)]
+        self.order = np.arange(len(self.quadkeys))
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def _available(self, quadkey):
+        if self.tile_store is not None:
+            return quadkey in self.tile_store
+
+        meta = self.quadkey_meta[quadkey]
+        return find_tile_path(quadkey, meta["project_id"], meta["task_id"], self.zoom_level, self.map_tiles) is not None
+
+    def _read(self, quadkey):
+        meta = self.quadkey_meta[quadkey]
+        return read_tile_bytes(quadkey, meta["project_id"], meta["task_id"], self.zoom_level, self.map_tiles, self.tile_store)
+
+    def _load(self, quadkey):
+        """
+            Decodes one tile and draws its mask, run on the thread pool; OpenCV releases the GIL while it works.
+        """
+        data = self._read(quadkey)
+        tile = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if tile is None:
+            raise ValueError("Could not decode map tile %s" % quadkey)
+
+        tile = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
+        mask = draw_mask(self.quadkey_buildings[quadkey])
+        return (tile, mask)
+
+    def __len__(self):
+        return math.ceil(len(self.quadkeys) / self.batch_size)
+
+    def batch_quadkeys(self, index):
+        positions = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        return [self.quadkeys[p] for p in positions]
+
+    def _assemble(self, pairs):
+        tiles = np.stack([tile for (tile, mask) in pairs])
+        masks = np.stack([mask for (tile, mask) in pairs])[..., None]
+
+        if self.rescale is not None:
+            return (tiles.astype(np.float32) * self.rescale, masks.astype(np.float32))
+        return (tiles, masks)
+
+    def _submit(self, index):
+        return [self.executor.submit(self._load, quadkey) for quadkey in self.batch_quadkeys(index)]
+
+    def _collect(self, futures):
+        pairs = [future.result() for future in futures]
+        if self.augment:
+            pairs = [augment_pair(tile, mask, self.rng) for (tile, mask) in pairs]
+        return self._assemble(pairs)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError("Batch %s out of range for %s batches" % (index, len(self)))
+        return self._collect(self._submit(index))
+
+    def __iter__(self):
+        """
+            Yields every batch in order, decoding the next prefetch batches while the current one is used.
+        """
+        pending = deque()
+        for index in range(len(self)):
+            pending.append(self._submit(index))
+            if len(pending) > self.prefetch:
+                yield self._collect(pending.popleft())
+
+        while pending:
+            yield self._collect(pending.popleft())
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def sequence_from_building_file(building_file, zoom_level, map_tiles=None, tile_store=None, cross_tile_buildings=False, **kwargs):
+    """
+        A TileMaskSequence over every tile with buildings in a building CSV or binary building file.
+        tile_store may be a path or an open TileStore.
+    """
+    table = buildingfile.load_buildings(building_file)
+    (quadkey_buildings, quadkey_meta) = buildings.group_polygons_by_tile(table, zoom_level, not cross_tile_buildings)
+
+    if tile_store is not None and not isinstance(tile_store, TileStore):
+        tile_store = TileStore(tile_store)
+
+    return TileMaskSequence(quadkey_buildings, quadkey_meta, zoom_level, map_tiles=map_tiles, tile_store=tile_store, **kwargs)
@@ -0,0 +1,228 @@
+"""
+    Building density pyramid: building counts and footprint area per tile, at a base zoom level and
+    every coarser level up to min_level, for quick density queries over any area.
+
+    Buildings are binned by the centroid of their footprint, so each is counted once at every level
+    and a parent tile's totals are exactly the sums of its children's. Each level is three columns
+    sorted by the tile's Morton code (the quadkey read as a base-4 number):
+
+        code_<level>    uint64 codes of tiles holding at least one building
+        count_<level>   uint32 number of buildings
+        area_<level>    float64 footprint area in square metres
+
+    Sorted by Morton code, the tiles under any coarser tile form one contiguous run, so a bounding
+    box query is a few binary searches over its covering coarse tiles rather than a scan. The whole
+    pyramid is saved as one .npz file.
+"""
+
+from math import cos, pi
+
+import numpy as np
+
+from util import bingmaps, quadkeys
+
+# Coarse tiles covering a query box, per side, before it is split into code ranges
+MAX_COVER_TILES = 8
+
+
+def footprints(table):
+    """
+        Per building (world_x, world_y, area) of its footprint's centroid and its area in square
+        metres, treating each polygon as a closed ring. Degenerate footprints use the mean vertex.
+    """
+    (x, y) = bingmaps.lat_lon_to_world_xy_batch(table.latitudes, table.longitudes)
+    starts = table.offsets[:-1]
+    lengths = np.diff(table.offsets)
+    polygon = np.repeat(np.arange(len(lengths)), lengths)
+
+    # Relative to each polygon's first vertex, so the cross products keep their precision
+    x = x - x[starts][polygon]
+    y = y - y[starts][polygon]
+    following = np.arange(len(x)) + 1
+    following[table.offsets[1:] - 1] = starts
+
+    cross = x * y[following] - x[following] * y
+    area = np.add.reduceat(cross, starts) / 2
+    centroid_x = np.add.reduceat((x + x[following]) * cross, starts)
+    centroid_y = np.add.reduceat((y + y[following]) * cross, starts)
+
+    degenerate = np.abs(area) < 1e-20
+    safe_area = np.where(degenerate, 1, area)
+    centroid_x = np.where(degenerate, np.add.reduceat(x, starts) / lengths, centroid_x / (6 * safe_area))
+    centroid_y = np.where(degenerate, np.add.reduceat(y, starts) / lengths, centroid_y / (6 * safe_area))
+
+    (origin_x, origin_y) = bingmaps.lat_lon_to_world_xy_batch(table.latitudes[starts], table.longitudes[starts])
+    latitudes = np.radians(table.latitudes[starts])
+
+    # Mercator stretches lengths by 1 / cos(latitude), so areas by its square
+    world_metres = 2 * pi * bingmaps.EARTH_RADIUS
+    square_metres = np.abs(area) * world_metres * world_metres * np.cos(latitudes) ** 2
+
+    return (origin_x + centroid_x, origin_y + centroid_y, square_metres)
+
+
+def _aggregate(codes, counts, areas):
+    """
+        Sums counts and areas over equal codes, given codes in sorted order.
+    """
+    (unique_codes, starts) = np.unique(codes, return_index=True)
+    if len(unique_codes) == 0:
+        return (unique_codes, counts[:0], areas[:0])
+    return (unique_codes, np.add.reduceat(counts, starts), np.add.reduceat(areas, starts))
+
+
+class DensityPyramid:
+
+    def __init__(self, base_level, min_level, levels):
+        self.base_level = base_level
+        self.min_level = min_level
+        self.levels = levels
+
+    @staticmethod
+    def build(tables, base_level, min_level=0):
+        """
+            Bins the buildings of every table at base_level and rolls them up to min_level.
+        """
+        codes = []
+        areas = []
+        size = 1 << base_level
+
+        for table in tables:
+            if len(table.way_ids) == 0:
+                continue
+            (x, y, area) = footprints(table)
+            tile_x = np.clip(np.floor(x * size), 0, size - 1).astype(np.int64)
+            tile_y = np.clip(np.floor(y * size), 0, size - 1).astype(np.int64)
+            codes.append(quadkeys.tile_xy_to_code(tile_x, tile_y))
+            areas.append(area)
+
+        codes = np.concatenate(codes) if codes else np.zeros(0, np.uint64)
+        areas = np.concatenate(areas) if areas else np.zeros(0, np.float64)
+        order = np.argsort(codes, kind="stable")
+
+        level = _aggregate(codes[order], np.ones(len(codes), np.uint32), areas[order])
+        levels = {base_level: level}
+
+        # Shifting off the last digit keeps Morton codes sorted, so each parent level is one more pass
+        for parent_level in range(base_level - 1, min_level - 1, -1):
+            (codes, counts, areas) = level
+            level = _aggregate(codes >> np.uint64(2), counts, areas)
+            levels[parent_level] = level
+
+        return DensityPyramid(base_level, min_level, levels)
+
+    def save(self, path):
+        arrays = {"base_level": self.base_level, "min_level": self.min_level}
+        for (level, (codes, counts, areas)) in self.levels.items():
+            arrays["code_%s" % level] = codes
+            arrays["count_%s" % level] = counts
+            arrays["area_%s" % level] = areas
+
+        with open(path, "wb") as out:
+            np.savez(out, **arrays)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as arrays:
+            base_level = int(arrays["base_level"])
+            min_level = int(arrays["min_level"])
+            levels = {level: (arrays["code_%s" % level], arrays["count_%s" % level], arrays["area_%s" % level])
+                      for level in range(min_level, base_level + 1)}
+        return DensityPyramid(base_level, min_level, levels)
+
+    def _check_level(self, level):
+        if level not in self.levels:
+            raise ValueError("Level %s is not in the pyramid, which holds levels %s to %s" % (level, self.min_level, self.base_level))
+
+    def bounds(self):
+        """
+            (min_lat, min_lon, max_lat, max_lon) of the base level tiles holding buildings.
+        """
+        (tile_x, tile_y) = quadkeys.code_to_tile_xy(self.levels[self.base_level][0])
+        if len(tile_x) == 0:
+            raise ValueError("The pyramid holds no buildings")
+
+        size = bingmaps.BING_TILE_SIZE_PIXELS
+        (max_lat, min_lon) = bingmaps.pixel_xy_to_lat_lon(tile_x.min() * size, tile_y.min() * size, self.base_level)
+        (min_lat, max_lon) = bingmaps.pixel_xy_to_lat_lon((tile_x.max() + 1) * size - 1, (tile_y.max() + 1) * size - 1, self.base_level)
+        return (min_lat, min_lon, max_lat, max_lon)
+
+    def tile_range(self, min_lat, min_lon, max_lat, max_lon, level):
+        """
+            Inclusive (min_tile_x, min_tile_y, max_tile_x, max_tile_y) of a box, as enumerate_quadkeys_in_box.
+        """
+        (min_tile_x, min_tile_y) = bingmaps.lat_lon_to_tile_xy(max_lat, min_lon, level)
+        (max_tile_x, max_tile_y) = bingmaps.lat_lon_to_tile_xy(min_lat, max_lon, level)
+        return (min_tile_x, min_tile_y, max_tile_x, max_tile_y)
+
+    def tiles_in_box(self, min_lat, min_lon, max_lat, max_lon, level):
+        """
+            (tile_x, tile_y, counts, areas) of every tile at level in the box holding any building.
+        """
+        self._check_level(level)
+        (codes, counts, areas) = self.levels[level]
+        (min_x, min_y, max_x, max_y) = self.tile_range(min_lat, min_lon, max_lat, max_lon, level)
+
+        # Cover the box with at most MAX_COVER_TILES^2 coarser tiles, each a contiguous run of codes
+        shift = 0
+        while max((max_x >> shift) - (min_x >> shift), (max_y >> shift) - (min_y >> shift)) >= MAX_COVER_TILES:
+            shift = shift + 1
+        coarse_level = level - shift
+
+        (cover_x, cover_y) = np.meshgrid(np.arange(min_x >> shift, (max_x >> shift) + 1), np.arange(min_y >> shift, (max_y >> shift) + 1))
+        (low, high) = quadkeys.code_range_at_level(quadkeys.tile_xy_to_code(cover_x.ravel(), cover_y.ravel()), coarse_level, level)
+        (starts, ends) = (np.searchsorted(codes, low), np.searchsorted(codes, high))
+
+        index = np.concatenate([np.arange(start, end) for (start, end) in zip(starts, ends)] + [np.zeros(0, np.int64)])
+        (tile_x, tile_y) = quadkeys.code_to_tile_xy(codes[index])
+        inside = (tile_x >= min_x) & (tile_x <= max_x) & (tile_y >= min_y) & (tile_y <= max_y)
+        index = index[inside]
+
+        return (tile_x[inside], tile_y[inside], counts[index], areas[index])
+
+    def totals(self, min_lat, min_lon, max_lat, max_lon, level=None):
+        """
+            (buildings, square metres) with centroids in the tiles at level covering the box, the
+            base level by default for the tightest fit.
+        """
+        level = self.base_level if level is None else level
+        (_, _, counts, areas) = self.tiles_in_box(min_lat, min_lon, max_lat, max_lon, level)
+        return (int(counts.sum()), float(areas.sum()))
+
+    def grid(self, min_lat, min_lon, max_lat, max_lon, level, value="count"):
+        """
+            Dense (min_tile_x, min_tile_y, array) of count or area per tile over the box, rows being tile_y.
+        """
+        (min_x, min_y, max_x, max_y) = self.tile_range(min_lat, min_lon, max_lat, max_lon, level)
+        (tile_x, tile_y, counts, areas) = self.tiles_in_box(min_lat, min_lon, max_lat, max_lon, level)
+
+        grid = np.zeros((max_y - min_y + 1, max_x - min_x + 1), np.uint32 if value == "count" else np.float64)
+        grid[tile_y - min_y, tile_x - min_x] = counts if value == "count" else areas
+        return (min_x, min_y, grid)
+
+    def densest(self, level, limit=10, box=None):
+        """
+            The limit tiles at level with the most buildings, in the box if given, as dictionaries
+            of quadkey, centre lat/lon, buildings and area. Densest first.
+        """
+        if box is None:
+            self._check_level(level)
+            (codes, counts, areas) = self.levels[level]
+            (tile_x, tile_y) = quadkeys.code_to_tile_xy(codes)
+        else:
+            (tile_x, tile_y, counts, areas) = self.tiles_in_box(*box, level)
+
+        top = np.argsort(-counts.astype(np.int64), kind="stable")[:limit]
+        quadkey_strings = quadkeys.to_quadkeys(quadkeys.encode(tile_x[top], tile_y[top], level)) if len(top) > 0 else []
+        centres = bingmaps.pixel_xy_to_lat_lon_batch((tile_x[top] + 0.5) * bingmaps.BING_TILE_SIZE_PIXELS,
+                                                     (tile_y[top] + 0.5) * bingmaps.BING_TILE_SIZE_PIXELS, level)
+
+        return [{"quadkey": str(quadkey_strings[i]), "lat": float(centres[0][i]), "lon": float(centres[1][i]),
+                 "buildings": int(counts[top[i]]), "area": float(areas[top[i]])} for i in range(len(top))]
+
+
+def tile_size_metres(latitude, level):
+    """
+        Ground width of a tile at level and latitude, for turning counts into densities.
+    """
+    return 2 * pi * bingmaps.EARTH_RADIUS * cos(latitude * pi / 180) / (1 << level)
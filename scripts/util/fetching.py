@@ -0,0 +1,221 @@
+"""
+    Shared HTTP helpers: pooled keep-alive sessions, a request rate limiter, retries with
+    exponential backoff, an optional response cache, and a bounded concurrent map for running
+    many requests at once.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from util import httpcache, metrics
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_TIMEOUT_SECONDS = 30
+
+
+class RateLimiter:
+    """
+        Spaces out calls to wait() so that no more than requests_per_second pass, across all threads.
+        A rate of None or 0 means unlimited.
+    """
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            scheduled = max(self.next_time, now)
+            self.next_time = scheduled + self.interval
+
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+def create_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_thread_sessions = threading.local()
+_default_cache = None
+
+
+def set_default_cache(cache):
+    """
+        Use this util.httpcache.HttpCache for every request_with_retries call, None to disable.
+    """
+    global _default_cache
+    _default_cache = cache
+
+
+def is_offline():
+    """
+        True when the default cache is in offline mode, so nothing may go to the network.
+    """
+    return _default_cache is not None and _default_cache.offline
+
+
+def thread_session(pool_size=10):
+    """
+        A keep-alive session private to the calling thread, created on first use.
+    """
+    session = getattr(_thread_sessions, "session", None)
+    if session is None:
+        session = create_session(pool_size)
+        _thread_sessions.session = session
+    return session
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=60):
+    """
+        Exponential backoff with full jitter for the given (zero based) attempt.
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def retry_after_delay(response):
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def request_with_retries(method, url, session=None, max_attempts=5, rate_limiter=None,
+                         base_delay=0.5, max_delay=60, timeout=DEFAULT_TIMEOUT_SECONDS, use_cache=True, **kwargs):
+    """
+        Makes a request, retrying connection errors, timeouts, 429 and 5xx responses with exponential backoff.
+        Returns the successful response, or raises the last error once max_attempts is used up.
+        Other 4xx responses raise immediately as retrying will not help.
+        Successful responses are served from and saved to the default cache, if one is set and use_cache.
+        Offline, requests that skip the cache raise httpcache.CacheMiss rather than use the network.
+        Streamed responses are written to the cache as their body is read, so they stay streamed.
+        Every attempt is counted in util.metrics by host and status, with its latency and response size.
+    """
+    host = urlparse(url).netloc
+    if not use_cache and is_offline():
+        raise httpcache.CacheMiss("Offline and %s %s is never cached" % (method, url))
+
+    cache = _default_cache if use_cache else None
+    if cache is not None:
+        cached = cache.get(method, url, kwargs.get("params"), kwargs.get("data"))
+        if cached is not None:
+            metrics.increment("http_cache_hits", host=host)
+            return cached
+
+    session = session or thread_session()
+    attempt = 0
+
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.wait()
+
+        delay = None
+        start = time.monotonic()
+        try:
+            r = session.request(method, url, timeout=timeout, **kwargs)
+
+            metrics.observe("http_request_seconds", time.monotonic() - start, host=host)
+            metrics.increment("http_requests", host=host, status=r.status_code)
+            if r.headers.get("Content-Length", "").isdigit():
+                metrics.increment("http_response_bytes", int(r.headers["Content-Length"]), host=host)
+
+            if r.status_code == requests.codes.ok:
+                if cache is not None and kwargs.get("stream"):
+                    cache.tee(method, url, r, kwargs.get("params"), kwargs.get("data"))
+                elif cache is not None:
+                    cache.put(method, url, r, kwargs.get("params"), kwargs.get("data"))
+                return r
+
+            if r.status_code not in RETRYABLE_STATUS_CODES or attempt + 1 >= max_attempts:
+                r.raise_for_status()
+                return r
+
+            delay = retry_after_delay(r)
+            r.close()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.observe("http_request_seconds", time.monotonic() - start, host=host)
+            metrics.increment("http_requests", host=host, status=type(e).__name__)
+            if attempt + 1 >= max_attempts:
+                raise
+
+        if delay is None:
+            delay = backoff_delay(attempt, base_delay, max_delay)
+
+        metrics.increment("http_retries", host=host)
+        attempt = attempt + 1
+        time.sleep(min(delay, max_delay))
+
+
+def stream_with_retries(method, url, consume, session=None, max_attempts=5, rate_limiter=None,
+                        base_delay=0.5, max_delay=60, **kwargs):
+    """
+        Makes a streamed request_with_retries and returns consume(response). Connection errors and
+        timeouts while consume reads the body are retried too, with a fresh request and the same
+        backoff, within one budget of max_attempts.
+    """
+    host = urlparse(url).netloc
+    attempt = 0
+
+    while True:
+        r = request_with_retries(method, url, session=session, max_attempts=max_attempts - attempt, rate_limiter=rate_limiter,
+                                 base_delay=base_delay, max_delay=max_delay, stream=True, **kwargs)
+        try:
+            return consume(r)
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.increment("http_body_errors", host=host, error=type(e).__name__)
+            if attempt + 1 >= max_attempts:
+                raise
+        finally:
+            r.close()
+
+        metrics.increment("http_retries", host=host)
+        time.sleep(backoff_delay(attempt, base_delay, max_delay))
+        attempt = attempt + 1
+
+
+def bounded_map(function, items, workers, max_pending=None):
+    """
+        Applies function to items on a thread pool, yielding (item, result, error) as each completes.
+        At most max_pending items (default 2 * workers) are in flight, so items may be a lazy generator.
+    """
+    max_pending = max_pending or 2 * workers
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit_next():
+            for item in items:
+                pending[executor.submit(function, item)] = item
+                return True
+            return False
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        while pending:
+            (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield (item, None if error else future.result(), error)
+
+                submit_next()
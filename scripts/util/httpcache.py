@@ -0,0 +1,217 @@
+"""
+    On-disk HTTP response cache shared by the collection scripts.
+
+    Responses are stored content addressed: objects/<sha256 of body> holds each distinct body once,
+    and entries/<sha256 of request>.json records the request's status, headers, body hash and when it
+    was stored. Entries expire after a per endpoint TTL. Once the objects exceed a size cap, the least
+    recently used entries are evicted. In offline mode only the cache is consulted, expired or not.
+"""
+
+from pathlib import Path
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+# (url prefix, seconds) pairs, first match wins. None means entries never expire.
+DEFAULT_TTLS = [
+    ("https://tasks.hotosm.org/api/v1/project/search", 24 * 3600),
+    ("https://tasks.hotosm.org/api/v1/project/", 7 * 24 * 3600),
+    ("https://dev.virtualearth.net/REST/V1/Imagery/Metadata/", 24 * 3600),
+    ("https://overpass.kumi.systems/", 7 * 24 * 3600),
+]
+DEFAULT_TTL = 24 * 3600
+
+
+class CacheMiss(requests.exceptions.RequestException):
+    """
+        Raised in offline mode for a request that is not in the cache.
+    """
+
+
+def request_key(method, url, params=None, data=None):
+    canonical = json.dumps([method.upper(), url, sorted((params or {}).items()), data], sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _write_atomically(path, data):
+    partial_path = path.with_name(path.name + ".%s.partial" % os.getpid())
+    with open(partial_path, "wb") as f:
+        f.write(data)
+    os.replace(partial_path, path)
+
+
+class HttpCache:
+
+    def __init__(self, folder, max_bytes=None, ttls=None, default_ttl=DEFAULT_TTL, offline=False):
+        self.folder = Path(folder)
+        self.entries = self.folder / "entries"
+        self.objects = self.folder / "objects"
+        self.max_bytes = max_bytes
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.default_ttl = default_ttl
+        self.offline = offline
+        self.lock = threading.Lock()
+
+        self.entries.mkdir(parents=True, exist_ok=True)
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.total_bytes = sum(p.stat().st_size for p in self.objects.iterdir() if not p.name.endswith(".partial"))
+
+    def ttl_for(self, url):
+        for (prefix, seconds) in self.ttls:
+            if url.startswith(prefix):
+                return seconds
+        return self.default_ttl
+
+    def get(self, method, url, params=None, data=None):
+        """
+            Returns a cached requests.Response, or None on a miss (CacheMiss when offline).
+        """
+        entry_path = self.entries / (request_key(method, url, params, data) + ".json")
+
+        try:
+            entry = json.loads(entry_path.read_text())
+            content = (self.objects / entry["content"]).read_bytes()
+        except (OSError, ValueError, KeyError):
+            if self.offline:
+                raise CacheMiss("Offline and %s %s is not cached" % (method, url))
+            return None
+
+        ttl = self.ttl_for(url)
+        if not self.offline and ttl is not None and time.time() - entry["stored_at"] > ttl:
+            return None
+
+        # Touch the entry, its modification time is our LRU clock
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+        return self._to_response(entry, content)
+
+    def put(self, method, url, response, params=None, data=None):
+        content = response.content
+
+        def write_object(object_path):
+            _write_atomically(object_path, content)
+
+        self._store(method, url, response, params, data, hashlib.sha256(content).hexdigest(), len(content), write_object)
+
+    def tee(self, method, url, response, params=None, data=None):
+        """
+            Caches a streamed response as it is read, rather than buffering its body: iter_content
+            also writes each chunk to a partial object, stored once the body has been read to the end.
+            A body read only in part is discarded.
+        """
+        iter_content = response.iter_content
+
+        def iter_and_store(chunk_size=1):
+            partial_path = self.objects / ("stream.%s.%s.partial" % (os.getpid(), threading.get_ident()))
+            digest = hashlib.sha256()
+            length = 0
+            complete = False
+
+            try:
+                with open(partial_path, "wb") as f:
+                    for chunk in iter_content(chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        length = length + len(chunk)
+                        yield chunk
+                complete = True
+            finally:
+                if complete:
+                    self._store(method, url, response, params, data, digest.hexdigest(), length,
+                                lambda object_path: os.replace(partial_path, object_path))
+                if partial_path.exists():
+                    partial_path.unlink()
+
+        response.iter_content = iter_and_store
+        return response
+
+    def _store(self, method, url, response, params, data, content_hash, length, write_object):
+        entry = {
+            "method": method.upper(),
+            "url": url,
+            "status_code": response.status_code,
+            "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+            "encoding": response.encoding,
+            "content": content_hash,
+            "stored_at": time.time()
+        }
+
+        with self.lock:
+            object_path = self.objects / content_hash
+            if not object_path.exists():
+                write_object(object_path)
+                self.total_bytes = self.total_bytes + length
+
+            entry_path = self.entries / (request_key(method, url, params, data) + ".json")
+            _write_atomically(entry_path, json.dumps(entry).encode("utf-8"))
+
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+            Drops least recently used entries until the objects fit the size cap again.
+            An object is only removed once no remaining entry refers to it.
+        """
+        entries = []
+        for path in self.entries.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path, json.loads(path.read_text())["content"]))
+            except (OSError, ValueError, KeyError):
+                continue
+
+        entries.sort(key=lambda e: e[0])
+        references = {}
+        for (_, _, content_hash) in entries:
+            references[content_hash] = references.get(content_hash, 0) + 1
+
+        for (_, path, content_hash) in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+
+            path.unlink()
+            references[content_hash] = references[content_hash] - 1
+
+            if references[content_hash] == 0:
+                object_path = self.objects / content_hash
+                try:
+                    self.total_bytes = self.total_bytes - object_path.stat().st_size
+                    object_path.unlink()
+                except OSError:
+                    pass
+
+    def _to_response(self, entry, content):
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.headers.update(entry["headers"])
+        response.encoding = entry.get("encoding")
+        response.url = entry["url"]
+        response._content = content
+        response._content_consumed = True
+        return response
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cacheFolder", dest="cacheFolder", default="data/http_cache",
+                        help="Cache HTTP responses in this folder, pass an empty string to disable")
+    parser.add_argument("--cacheMaxBytes", dest="cacheMaxBytes", type=int, default=None,
+                        help="Evict least recently used responses once the cache grows beyond this size")
+    parser.add_argument("--offline", dest="offline", action="store_true",
+                        help="Serve every request from the cache and fail on anything not cached")
+
+
+def cache_from_arguments(args):
+    if not args.cacheFolder:
+        if args.offline:
+            raise ValueError("--offline needs a --cacheFolder to serve from")
+        return None
+
+    return HttpCache(args.cacheFolder, max_bytes=args.cacheMaxBytes, offline=args.offline)
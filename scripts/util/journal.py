@@ -0,0 +1,64 @@
+"""
+    Append-only journal of completed and failed work items, so an interrupted run can resume.
+    Each line is tab separated: status, key, then an optional free text reason.
+"""
+
+from pathlib import Path
+
+DONE = "done"
+FAILED = "failed"
+
+
+class Journal:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.completed = set()
+        self.failed = {}
+
+        if self.path.exists():
+            self._replay()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.out = open(self.path, "a")
+
+    def _replay(self):
+        with open(self.path, "r") as f:
+            for line in f:
+                tokens = line.rstrip("\n").split("\t", 2)
+
+                # A crash can leave a partial last line, which we simply ignore
+                if len(tokens) < 2:
+                    continue
+
+                (status, key) = tokens[0], tokens[1]
+                if status == DONE:
+                    self.completed.add(key)
+                    self.failed.pop(key, None)
+                elif status == FAILED:
+                    self.failed[key] = tokens[2] if len(tokens) > 2 else ""
+
+    def _append(self, *tokens):
+        self.out.write("\t".join(tokens).replace("\n", " ") + "\n")
+        self.out.flush()
+
+    def record_done(self, key):
+        self.completed.add(key)
+        self.failed.pop(key, None)
+        self._append(DONE, key)
+
+    def record_failed(self, key, reason=""):
+        self.failed[key] = reason
+        self._append(FAILED, key, str(reason))
+
+    def is_done(self, key):
+        return key in self.completed
+
+    def close(self):
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
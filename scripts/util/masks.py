@@ -0,0 +1,169 @@
+"""
+    Truth mask drawing and output formats.
+
+    Masks are drawn as single channel arrays of exact 0/1 labels, then written as one of:
+
+        jpeg    256x256x3 JPEG of 0/255, as the training folders have always held (lossy at edges)
+        png     single channel lossless PNG of 0/255, so rescaling by 1/255 gives exact 0/1
+        packed  np.packbits of the 0/1 mask, 8192 bytes a tile, appended into fixed size shard files
+"""
+
+from pathlib import Path
+
+import mmap
+
+import cv2
+import numpy as np
+
+from util import quadkeys
+
+TILE_SIZE = 256
+MASK_FORMATS = ["jpeg", "png", "packed"]
+PACKED_MASK_BYTES = TILE_SIZE * TILE_SIZE // 8
+MASKS_PER_SHARD = 4096
+SHARD_INDEX_FILE = "masks.idx"
+SHARD_INDEX_DTYPE = np.dtype([("key", "<u8"), ("shard", "<u4"), ("slot", "<u4")])
+
+
+def draw_mask(polygons, mask=None):
+    """
+        Rasterizes tile relative polygons as a 256x256 mask of 0/1. Pass mask to reuse a buffer.
+    """
+    if mask is None:
+        mask = np.zeros([TILE_SIZE, TILE_SIZE], np.uint8)
+    else:
+        mask.fill(0)
+
+    for polygon in polygons:
+        cv2.fillPoly(mask, np.array([polygon], dtype='int32'), 1)
+
+    return mask
+
+
+def mask_extension(mask_format):
+    return {"jpeg": ".jpeg", "png": ".png"}.get(mask_format)
+
+
+def encode_mask(mask, mask_format):
+    if mask_format == "jpeg":
+        return cv2.imencode(".jpeg", cv2.cvtColor(mask * 255, cv2.COLOR_GRAY2BGR))[1].tobytes()
+    if mask_format == "png":
+        return cv2.imencode(".png", mask * 255)[1].tobytes()
+    if mask_format == "packed":
+        return np.packbits(mask.astype(bool)).tobytes()
+
+    raise ValueError("Unknown mask format %s, expected one of %s" % (mask_format, MASK_FORMATS))
+
+
+def decode_mask(data, mask_format):
+    """
+        Returns a 256x256 uint8 mask of 0/1. JPEG masks are thresholded, as compression blurs their edges.
+    """
+    if mask_format == "packed":
+        return np.unpackbits(np.frombuffer(data, np.uint8), count=TILE_SIZE * TILE_SIZE).reshape(TILE_SIZE, TILE_SIZE)
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Could not decode %s mask" % mask_format)
+    return (image >= 128).astype(np.uint8)
+
+
+def _shard_path(folder, shard):
+    return Path(folder) / ("masks-%05d.bin" % shard)
+
+
+class PackedMaskWriter:
+    """
+        Appends packed masks into shard files of masks_per_shard masks each, and records every
+        (packed quadkey, shard, slot) in an index. Reopening a folder carries on after its last mask.
+    """
+
+    def __init__(self, folder, masks_per_shard=MASKS_PER_SHARD):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.masks_per_shard = masks_per_shard
+
+        index_path = self.folder / SHARD_INDEX_FILE
+        raw = index_path.read_bytes() if index_path.exists() else b""
+        count = len(raw) // SHARD_INDEX_DTYPE.itemsize
+        self.index = open(index_path, "r+b" if index_path.exists() else "wb")
+        self.index.truncate(count * SHARD_INDEX_DTYPE.itemsize)
+        self.index.seek(0, 2)
+
+        (self.shard, self.slot) = divmod(count, masks_per_shard)
+        self.out = None
+
+    def put(self, quadkey, packed_mask):
+        if len(packed_mask) != PACKED_MASK_BYTES:
+            raise ValueError("Packed masks are %s bytes, got %s" % (PACKED_MASK_BYTES, len(packed_mask)))
+
+        if self.out is None:
+            self.out = open(_shard_path(self.folder, self.shard), "r+b" if _shard_path(self.folder, self.shard).exists() else "wb")
+            self.out.seek(self.slot * PACKED_MASK_BYTES)
+
+        self.out.write(packed_mask)
+        self.out.flush()
+        self.index.write(np.array([(quadkeys.from_quadkey(quadkey), self.shard, self.slot)], dtype=SHARD_INDEX_DTYPE).tobytes())
+        self.index.flush()
+
+        self.slot = self.slot + 1
+        if self.slot == self.masks_per_shard:
+            self.out.close()
+            self.out = None
+            (self.shard, self.slot) = (self.shard + 1, 0)
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+        self.index.close()
+
+
+class PackedMaskReader:
+    """
+        Random access to packed mask shards by quadkey, through memory maps of the shard files.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        raw = (self.folder / SHARD_INDEX_FILE).read_bytes()
+        records = np.frombuffer(raw[:len(raw) - len(raw) % SHARD_INDEX_DTYPE.itemsize], dtype=SHARD_INDEX_DTYPE)
+
+        # Keep the latest record per quadkey
+        (self.keys, first_in_reversed) = np.unique(records["key"][::-1], return_index=True)
+        latest = records[::-1][first_in_reversed]
+        self.shards = latest["shard"]
+        self.slots = latest["slot"]
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def quadkeys(self):
+        return quadkeys.to_quadkeys(self.keys).tolist() if len(self.keys) > 0 else []
+
+    def _map(self, shard):
+        if shard not in self.maps:
+            with open(_shard_path(self.folder, shard), "rb") as f:
+                self.maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def get_packed(self, quadkey):
+        key = quadkeys.from_quadkey(quadkey)
+        i = np.searchsorted(self.keys, key)
+        if i >= len(self.keys) or self.keys[i] != key:
+            return None
+
+        offset = int(self.slots[i]) * PACKED_MASK_BYTES
+        return self._map(int(self.shards[i]))[offset:offset + PACKED_MASK_BYTES]
+
+    def get(self, quadkey):
+        """
+            The 256x256 0/1 mask for quadkey, or None.
+        """
+        packed = self.get_packed(quadkey)
+        return decode_mask(packed, "packed") if packed is not None else None
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
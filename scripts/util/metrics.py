@@ -0,0 +1,250 @@
+"""
+    Process wide counters, gauges and histograms for long running scripts, with periodic export as
+    JSON lines and as a Prometheus textfile (for node_exporter's textfile collector), plus stage
+    timing with an optional cProfile dump per stage.
+
+    Library code records into the default registry through the module level functions, which cost
+    a dictionary update under a lock, so they are left on whether or not anything is exported.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+
+import bisect
+import cProfile
+import json
+import os
+import threading
+import time
+
+METRIC_PREFIX = "maptime_"
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_key(key):
+    (name, labels) = key
+    if len(labels) == 0:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for (k, v) in labels))
+
+
+class Histogram:
+    """
+        Counts of observations at or below each bucket bound, with their count and sum.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total = total + count
+            yield total
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def increment(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(self):
+        """
+            A JSON friendly copy of every metric, keyed by name{labels}.
+        """
+        with self.lock:
+            return {
+                "timestamp": time.time(),
+                "elapsed": time.time() - self.started,
+                "counters": {_format_key(k): v for (k, v) in self.counters.items()},
+                "gauges": {_format_key(k): v for (k, v) in self.gauges.items()},
+                "histograms": {_format_key(k): {"count": h.count, "sum": h.sum,
+                                                "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.cumulative_counts()))}
+                               for (k, h) in self.histograms.items()},
+            }
+
+    def prometheus_text(self):
+        """
+            The Prometheus text exposition format, with counters named <name>_total.
+        """
+        lines = []
+
+        with self.lock:
+            for (kind, suffix, metrics) in (("counter", "_total", self.counters), ("gauge", "", self.gauges)):
+                for name in sorted(set(k[0] for k in metrics)):
+                    lines.append("# TYPE %s%s%s %s" % (METRIC_PREFIX, name, suffix, kind))
+                    for key in sorted((k for k in metrics if k[0] == name), key=str):
+                        lines.append("%s%s %s" % (METRIC_PREFIX, _format_key((name + suffix, key[1])), metrics[key]))
+
+            for name in sorted(set(k[0] for k in self.histograms)):
+                lines.append("# TYPE %s%s histogram" % (METRIC_PREFIX, name))
+                for key in sorted((k for k in self.histograms if k[0] == name), key=str):
+                    histogram = self.histograms[key]
+                    bounds = [str(b) for b in histogram.buckets] + ["+Inf"]
+                    for (bound, count) in zip(bounds, histogram.cumulative_counts()):
+                        lines.append("%s%s %s" % (METRIC_PREFIX, _format_key((name + "_bucket", key[1] + (("le", bound),))), count))
+                    lines.append("%s%s %s" % (METRIC_PREFIX, _format_key((name + "_sum", key[1])), histogram.sum))
+                    lines.append("%s%s %s" % (METRIC_PREFIX, _format_key((name + "_count", key[1])), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+_profile_folder = None
+
+
+def increment(name, value=1, **labels):
+    REGISTRY.increment(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    REGISTRY.observe(name, value, buckets, **labels)
+
+
+def set_profile_folder(folder):
+    """
+        Write a cProfile dump of every stage() into this folder, None to disable.
+    """
+    global _profile_folder
+    _profile_folder = folder
+
+
+@contextmanager
+def stage(name):
+    """
+        Times the enclosed block as stage_seconds{stage=name}, profiling it if a profile folder is set.
+    """
+    profiler = cProfile.Profile() if _profile_folder is not None else None
+    start = time.monotonic()
+    set_gauge("stage_running", 1, stage=name)
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            path = Path(_profile_folder)
+            path.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(path / ("%s.prof" % name))
+
+        increment("stage_seconds", time.monotonic() - start, stage=name)
+        set_gauge("stage_running", 0, stage=name)
+
+
+def _write_atomically(path, text):
+    partial = Path(str(path) + ".partial")
+    with open(partial, "w") as out:
+        out.write(text)
+    os.replace(partial, path)
+
+
+class Exporter:
+    """
+        Every interval seconds, and on close, appends a snapshot of the registry to a JSON lines file
+        and rewrites a Prometheus textfile. Each JSON line also holds per second rates of every
+        counter since the previous line, such as tiles or buildings a second.
+    """
+
+    def __init__(self, json_path=None, prometheus_path=None, interval=30, registry=REGISTRY):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.registry = registry
+        self.previous = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def export(self):
+        snapshot = self.registry.snapshot()
+
+        if self.previous is not None:
+            seconds = snapshot["timestamp"] - self.previous["timestamp"]
+            snapshot["rates"] = {k: (v - self.previous["counters"].get(k, 0)) / seconds
+                                 for (k, v) in snapshot["counters"].items()} if seconds > 0 else {}
+        else:
+            snapshot["rates"] = {k: v / snapshot["elapsed"] for (k, v) in snapshot["counters"].items()} if snapshot["elapsed"] > 0 else {}
+        self.previous = snapshot
+
+        if self.json_path is not None:
+            with open(self.json_path, "a") as out:
+                out.write(json.dumps(snapshot) + "\n")
+
+        if self.prometheus_path is not None:
+            _write_atomically(self.prometheus_path, self.registry.prometheus_text())
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.export()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metricsJson", dest="metricsJson", default=None,
+                        help="Append a JSON line of metrics to this file every --metricsInterval seconds")
+    parser.add_argument("--metricsProm", dest="metricsProm", default=None,
+                        help="Keep this Prometheus textfile up to date with the same metrics")
+    parser.add_argument("--metricsInterval", dest="metricsInterval", type=float, default=30,
+                        help="Seconds between metric exports")
+    parser.add_argument("--profileFolder", dest="profileFolder", default=None,
+                        help="Write a cProfile dump of each stage into this folder")
+
+
+def metrics_from_arguments(args):
+    """
+        Sets up profiling and returns an Exporter for the parsed arguments, or None if not exporting.
+    """
+    set_profile_folder(args.profileFolder)
+
+    if args.metricsJson is None and args.metricsProm is None:
+        return None
+    return Exporter(args.metricsJson, args.metricsProm, args.metricsInterval)
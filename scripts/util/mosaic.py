@@ -0,0 +1,207 @@
+"""
+    A region mosaic: every map tile of a rectangle of tiles placed into one raster, with a truth
+    mask layer of the same size, both as raw uint8 files read and written through memory maps so
+    regions far larger than RAM only ever hold the pages being touched.
+
+    A mosaic is a folder holding:
+
+        image.u8      BGR pixels, as cv2 decodes tiles
+        mask.u8       0/1 building mask
+        filled.u8     one byte per tile, 1 once that tile has been written
+        georef.json   zoom level, top left tile and pixel, size, bounds and an EPSG:3857 geotransform
+
+    The image and mask are stored tile by tile, as tiles_high x tiles_wide x 256 x 256 (x 3), like a
+    tiled GeoTIFF, so writing a tile touches one contiguous run of the file and unfilled tiles take
+    no disk space. read_window assembles any pixel window of the whole raster from them.
+
+    Pixel (0, 0) of the mosaic is the top left pixel of tile (tile_x, tile_y) at the zoom level, so
+    any global Bing pixel maps onto the mosaic by subtracting the top left pixel.
+"""
+
+from math import pi
+from pathlib import Path
+
+import json
+
+import numpy as np
+
+from util import bingmaps
+
+IMAGE_FILE = "image.u8"
+MASK_FILE = "mask.u8"
+FILLED_FILE = "filled.u8"
+GEOREF_FILE = "georef.json"
+TILE_SIZE = bingmaps.BING_TILE_SIZE_PIXELS
+
+
+def mercator_geotransform(pixel_x, pixel_y, zoom_level):
+    """
+        GDAL style (origin x, pixel width, 0, origin y, 0, -pixel height) in EPSG:3857 metres,
+        for a raster whose top left is the given global pixel.
+    """
+    pixel_size = TILE_SIZE * bingmaps.map_size(zoom_level)
+    metres = 2 * pi * bingmaps.EARTH_RADIUS / pixel_size
+    half_world = pi * bingmaps.EARTH_RADIUS
+    return [pixel_x * metres - half_world, metres, 0, half_world - pixel_y * metres, 0, -metres]
+
+
+def _create_file(path, size):
+    # Truncating rather than writing zeros leaves the file sparse until tiles land in it
+    with open(path, "wb") as out:
+        out.truncate(size)
+
+
+class Mosaic:
+    """
+        Opens an existing mosaic folder, read only unless writable. Use Mosaic.create for a new one.
+    """
+
+    def __init__(self, folder, writable=False):
+        self.folder = Path(folder)
+        with open(self.folder / GEOREF_FILE) as georef_file:
+            self.georef = json.load(georef_file)
+
+        self.zoom_level = self.georef["zoom_level"]
+        self.tile_x = self.georef["tile_x"]
+        self.tile_y = self.georef["tile_y"]
+        self.tiles_wide = self.georef["tiles_wide"]
+        self.tiles_high = self.georef["tiles_high"]
+        self.width = self.tiles_wide * TILE_SIZE
+        self.height = self.tiles_high * TILE_SIZE
+
+        tiles = (self.tiles_high, self.tiles_wide, TILE_SIZE, TILE_SIZE)
+        mode = "r+" if writable else "r"
+        self.image = np.memmap(self.folder / IMAGE_FILE, np.uint8, mode, shape=tiles + (3,))
+        self.mask = np.memmap(self.folder / MASK_FILE, np.uint8, mode, shape=tiles)
+        self.filled = np.memmap(self.folder / FILLED_FILE, np.uint8, mode, shape=(self.tiles_high, self.tiles_wide))
+
+    @staticmethod
+    def create(folder, tile_x, tile_y, tiles_wide, tiles_high, zoom_level):
+        """
+            Lays out an empty mosaic of tiles_wide x tiles_high tiles from top left tile (tile_x, tile_y).
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+
+        (width, height) = (tiles_wide * TILE_SIZE, tiles_high * TILE_SIZE)
+        (pixel_x, pixel_y) = (tile_x * TILE_SIZE, tile_y * TILE_SIZE)
+        (max_lat, min_lon) = bingmaps.pixel_xy_to_lat_lon(pixel_x, pixel_y, zoom_level)
+        (min_lat, max_lon) = bingmaps.pixel_xy_to_lat_lon(pixel_x + width, pixel_y + height, zoom_level)
+
+        _create_file(folder / IMAGE_FILE, width * height * 3)
+        _create_file(folder / MASK_FILE, width * height)
+        _create_file(folder / FILLED_FILE, tiles_wide * tiles_high)
+
+        georef = {
+            "zoom_level" : zoom_level,
+            "tile_x" : tile_x,
+            "tile_y" : tile_y,
+            "tiles_wide" : tiles_wide,
+            "tiles_high" : tiles_high,
+            "pixel_x" : pixel_x,
+            "pixel_y" : pixel_y,
+            "width" : width,
+            "height" : height,
+            "bounds" : {"min_lat" : min_lat, "min_lon" : min_lon, "max_lat" : max_lat, "max_lon" : max_lon},
+            "crs" : "EPSG:3857",
+            "geotransform" : mercator_geotransform(pixel_x, pixel_y, zoom_level),
+            "image" : {"file" : IMAGE_FILE, "dtype" : "uint8", "shape" : [tiles_high, tiles_wide, TILE_SIZE, TILE_SIZE, 3], "channels" : "BGR"},
+            "mask" : {"file" : MASK_FILE, "dtype" : "uint8", "shape" : [tiles_high, tiles_wide, TILE_SIZE, TILE_SIZE], "values" : "0/1"}
+        }
+        with open(folder / GEOREF_FILE, "w") as georef_file:
+            json.dump(georef, georef_file, indent=2)
+
+        return Mosaic(folder, writable=True)
+
+    def contains_tile(self, tile_x, tile_y):
+        return 0 <= tile_x - self.tile_x < self.tiles_wide and 0 <= tile_y - self.tile_y < self.tiles_high
+
+    def is_filled(self, tile_x, tile_y):
+        return self.filled[tile_y - self.tile_y, tile_x - self.tile_x] != 0
+
+    def put_tile(self, tile_x, tile_y, image, mask=None):
+        """
+            Writes a 256x256x3 tile image, and its 256x256 mask when given, then marks the tile filled.
+        """
+        (row, column) = (tile_y - self.tile_y, tile_x - self.tile_x)
+
+        self.image[row, column] = image
+        if mask is not None:
+            self.mask[row, column] = mask
+        self.filled[row, column] = 1
+
+    def pixel_of(self, latitude, longitude):
+        """
+            Mosaic (x, y) of a lat/lon, which may fall outside the mosaic.
+        """
+        (pixel_x, pixel_y) = bingmaps.lat_lon_to_pixel_xy(latitude, longitude, self.zoom_level)
+        return (pixel_x - self.georef["pixel_x"], pixel_y - self.georef["pixel_y"])
+
+    def lat_lon_of(self, x, y):
+        return bingmaps.pixel_xy_to_lat_lon(x + self.georef["pixel_x"], y + self.georef["pixel_y"], self.zoom_level)
+
+    def _read_pixels(self, layer, left, top, right, bottom):
+        """
+            Pixels [top:bottom, left:right] of a tiled layer, from the tiles the window overlaps.
+        """
+        (first_row, first_column) = (top // TILE_SIZE, left // TILE_SIZE)
+        (last_row, last_column) = ((bottom - 1) // TILE_SIZE, (right - 1) // TILE_SIZE)
+
+        tiles = layer[first_row:last_row + 1, first_column:last_column + 1]
+        shape = ((last_row - first_row + 1) * TILE_SIZE, (last_column - first_column + 1) * TILE_SIZE) + layer.shape[4:]
+        pixels = tiles.swapaxes(1, 2).reshape(shape)
+
+        (row, column) = (top - first_row * TILE_SIZE, left - first_column * TILE_SIZE)
+        return pixels[row:row + bottom - top, column:column + right - left]
+
+    def read_window(self, x, y, width, height):
+        """
+            Copies of the image and mask from (x, y) for width x height pixels. Parts of the window
+            outside the mosaic are returned as zeros, so windows may overhang its edges.
+        """
+        image = np.zeros((height, width, 3), np.uint8)
+        mask = np.zeros((height, width), np.uint8)
+
+        (left, top) = (max(x, 0), max(y, 0))
+        (right, bottom) = (min(x + width, self.width), min(y + height, self.height))
+
+        if left < right and top < bottom:
+            image[top - y:bottom - y, left - x:right - x] = self._read_pixels(self.image, left, top, right, bottom)
+            mask[top - y:bottom - y, left - x:right - x] = self._read_pixels(self.mask, left, top, right, bottom)
+
+        return (image, mask)
+
+    def read_box(self, min_lat, min_lon, max_lat, max_lon):
+        """
+            The window covering a lat/lon box, as (x, y, image, mask). The max lat/lon edges are
+            exclusive, so a box of tile corners, such as a task's, reads exactly its tiles.
+        """
+        (left, top) = self.pixel_of(max_lat, min_lon)
+        (right, bottom) = self.pixel_of(min_lat, max_lon)
+        return (left, top) + self.read_window(left, top, right - left, bottom - top)
+
+    def iterate_windows(self, size, stride=None):
+        """
+            Yields (x, y, image, mask) for size x size windows from the top left, row by row, every
+            stride pixels (size by default), as a model would be run over the region.
+        """
+        stride = size if stride is None else stride
+        for y in range(0, self.height, stride):
+            for x in range(0, self.width, stride):
+                yield (x, y) + self.read_window(x, y, size, size)
+
+    def flush(self):
+        self.image.flush()
+        self.mask.flush()
+        self.filled.flush()
+
+    def close(self):
+        if self.image.mode != "r":
+            self.flush()
+        del self.image, self.mask, self.filled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
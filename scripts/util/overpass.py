@@ -0,0 +1,239 @@
+"""
+    Incremental parsing of Overpass API JSON responses.
+
+    Rather than parsing a whole response into one dict, elements are decoded one at a time as text
+    arrives. Nodes go into a compact table of parallel arrays, and each way's node references are
+    resolved into a coordinate array as soon as it is read, so memory is bounded by the node table
+    rather than by the JSON tree.
+"""
+
+from array import array
+
+import codecs
+import json
+import re
+
+import numpy as np
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",]}"
+_SKIP_WHITESPACE = re.compile(r"[ \t\n\r]*")
+WAY_BATCH_SIZE = 4096
+
+
+class OverpassError(Exception):
+    """
+        Raised for a response whose remark reports a runtime error, such as a query timing out or
+        running out of memory. Overpass still answers those with HTTP 200 and only some elements.
+    """
+
+
+def check_remark(remark):
+    if remark is not None and "runtime error" in remark:
+        raise OverpassError("Overpass query failed: %s" % remark)
+
+
+class _TextStream:
+    """
+        A growable text buffer over an iterable of str or bytes chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def read_more(self):
+        if self.finished:
+            return False
+
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.utf8.decode(chunk)
+            if chunk:
+                # Drop what we have consumed so the buffer only ever holds a chunk or so
+                self.buffer = self.buffer[self.position:] + chunk
+                self.position = 0
+                return True
+
+        self.finished = True
+        return False
+
+    def skip_whitespace(self):
+        while True:
+            self.position = _SKIP_WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or not self.read_more():
+                return
+
+    def peek(self):
+        self.skip_whitespace()
+        if self.position >= len(self.buffer):
+            raise ValueError("Unexpected end of Overpass response")
+        return self.buffer[self.position]
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected '%s' in Overpass response but found '%s'" % (character, self.buffer[self.position]))
+        self.position = self.position + 1
+
+    def expect_end(self):
+        """
+            Reads to the end of the response, which leaves a streamed body complete, e.g. for the cache.
+        """
+        self.skip_whitespace()
+        if self.position < len(self.buffer):
+            raise ValueError("Unexpected '%s' after the end of the Overpass response" % self.buffer[self.position])
+
+    def decode_value(self):
+        """
+            Decodes the next complete JSON value, reading more text until it is all buffered.
+        """
+        self.skip_whitespace()
+
+        # Numbers and literals have no closing bracket or quote, so wait until whatever follows them arrives
+        if self.position < len(self.buffer) and self.buffer[self.position] not in "{[\"":
+            while not any(c in self.buffer[self.position:] for c in _DELIMITERS) and self.read_more():
+                pass
+
+        while True:
+            try:
+                (value, end) = _decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+
+            self.position = end
+            return value
+
+
+def iterate_elements(chunks):
+    """
+        Yields each object of the top level "elements" array, decoding one element at a time.
+        Raises OverpassError, before the response is read to its end, if its remark reports a
+        runtime error, so a streamed body is not cached.
+    """
+    stream = _TextStream(chunks)
+    stream.expect("{")
+
+    if stream.peek() == "}":
+        stream.position = stream.position + 1
+        stream.expect_end()
+        return
+
+    while True:
+        key = stream.decode_value()
+        stream.expect(":")
+
+        if key == "elements":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.position = stream.position + 1
+            else:
+                while True:
+                    yield stream.decode_value()
+                    if stream.peek() == ",":
+                        stream.position = stream.position + 1
+                    else:
+                        stream.expect("]")
+                        break
+        elif key == "remark":
+            check_remark(stream.decode_value())
+        else:
+            stream.decode_value()
+
+        if stream.peek() == ",":
+            stream.position = stream.position + 1
+        else:
+            stream.expect("}")
+            stream.expect_end()
+            return
+
+
+class NodeTable:
+    """
+        Node coordinates in parallel arrays, looked up through a sorted copy of the ids that is
+        rebuilt only when nodes were added since the last lookup.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+        self.sorted_ids = None
+        self.order = None
+
+    def add(self, node_id, latitude, longitude):
+        self.ids.append(node_id)
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+        self.sorted_ids = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, node_id_lists):
+        """
+            Resolves many ways at once. Returns a list holding, per list of node ids, an (n, 2) array
+            of lat/lon, or None where any of its nodes is unknown.
+        """
+        if self.sorted_ids is None:
+            ids = np.frombuffer(self.ids, dtype=np.int64) if len(self.ids) > 0 else np.zeros(0, dtype=np.int64)
+            self.order = np.argsort(ids, kind="stable")
+            self.sorted_ids = ids[self.order]
+
+        if len(self.sorted_ids) == 0:
+            return [None for node_ids in node_id_lists]
+
+        lengths = [len(node_ids) for node_ids in node_id_lists]
+        node_ids = np.fromiter((n for node_ids in node_id_lists for n in node_ids), dtype=np.int64, count=sum(lengths))
+
+        positions = np.minimum(np.searchsorted(self.sorted_ids, node_ids), len(self.sorted_ids) - 1)
+        found = self.sorted_ids[positions] == node_ids
+        indices = self.order[positions]
+
+        coordinates = np.empty((len(indices), 2), dtype=np.float64)
+        coordinates[:, 0] = np.frombuffer(self.latitudes, dtype=np.float64)[indices]
+        coordinates[:, 1] = np.frombuffer(self.longitudes, dtype=np.float64)[indices]
+
+        splits = np.cumsum(lengths)[:-1]
+        return [way_coordinates if way_found.all() else None
+                for (way_coordinates, way_found) in zip(np.split(coordinates, splits), np.split(found, splits))]
+
+
+def iterate_way_coordinates(chunks, batch_size=WAY_BATCH_SIZE):
+    """
+        Yields (way_id, (n, 2) lat/lon array) for every way in a streamed Overpass response.
+        Overpass lists nodes before ways, so ways resolve in batches as they are read; any way that
+        refers to a node not yet seen is held back until the end of the response.
+    """
+    nodes = NodeTable()
+    batch = []
+    deferred = []
+
+    def resolve(ways, final):
+        for ((way_id, node_ids), coordinates) in zip(ways, nodes.lookup([node_ids for (_, node_ids) in ways])):
+            if coordinates is not None:
+                yield (way_id, coordinates)
+            elif final:
+                raise KeyError("Way %s refers to nodes missing from the Overpass response" % way_id)
+            else:
+                deferred.append((way_id, node_ids))
+
+    for element in iterate_elements(chunks):
+        element_type = element.get("type")
+
+        if element_type == "node":
+            nodes.add(element["id"], element["lat"], element["lon"])
+        elif element_type == "way":
+            batch.append((element["id"], element["nodes"]))
+
+            if len(batch) >= batch_size:
+                yield from resolve(batch, False)
+                batch = []
+
+    yield from resolve(batch, False)
+    yield from resolve(deferred, True)
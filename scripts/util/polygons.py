@@ -0,0 +1,250 @@
+"""
+    Task and project areas as GeoJSON polygons and multipolygons, and the tiles they cover.
+
+    Rings are (n, 2) arrays of [longitude, latitude], as GeoJSON orders them. Every ring of a
+    geometry is treated alike under the even-odd rule, so holes and the separate parts of a
+    multipolygon need no special casing.
+
+    Tiles are found exactly, in Mercator tile space, as the union of:
+
+        tiles an edge passes through, from each edge's span of x within each tile row it crosses
+        tiles whose centre is inside, from the sorted crossings of each row's centre line
+
+    Both are built as spans of tiles per row, so the cost follows the perimeter and the number of
+    tiles returned rather than the area of the bounding box.
+"""
+
+from pathlib import Path
+
+import json
+
+import numpy as np
+
+from util import bingmaps, quadkeys
+
+GEOMETRY_SUFFIX = ".geojson"
+
+
+def geometry_rings(geometry):
+    """
+        Every ring of a GeoJSON Polygon or MultiPolygon, each closed.
+    """
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        raise ValueError("Expected a Polygon or MultiPolygon, found %s" % geometry["type"])
+
+    rings = []
+    for polygon in polygons:
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            if len(ring) > 0 and not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            if len(ring) >= 4:
+                rings.append(ring)
+
+    return rings
+
+
+def geometry_bounds(geometry):
+    """
+        (min_lat, min_lon, max_lat, max_lon) of a geometry.
+    """
+    points = np.vstack(geometry_rings(geometry))
+    return (float(points[:, 1].min()), float(points[:, 0].min()), float(points[:, 1].max()), float(points[:, 0].max()))
+
+
+def is_axis_aligned_rectangle(geometry):
+    """
+        True for a single four sided ring whose edges each run along a meridian or a parallel,
+        which the task CSV's bounding box describes exactly.
+    """
+    rings = geometry_rings(geometry)
+    if len(rings) != 1 or len(rings[0]) != 5:
+        return False
+
+    edges = np.diff(rings[0], axis=0)
+    return bool(np.all((edges[:, 0] == 0) | (edges[:, 1] == 0)))
+
+
+def _edges(rings, scale):
+    """
+        (ax, ay, bx, by) of every ring edge in fractional tile coordinates at the given 2^level.
+    """
+    starts = []
+    ends = []
+    for ring in rings:
+        (x, y) = bingmaps.lat_lon_to_world_xy_batch(ring[:, 1], ring[:, 0])
+        points = np.stack([x * scale, y * scale], axis=1)
+        starts.append(points[:-1])
+        ends.append(points[1:])
+
+    (starts, ends) = (np.concatenate(starts), np.concatenate(ends))
+    return (starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1])
+
+
+def _expand_spans(rows, first, last, groups):
+    """
+        (tile_x, tile_y, group) of every tile in the inclusive spans first..last of each row.
+    """
+    counts = np.maximum(last - first + 1, 0)
+    span = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(len(span)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return (first[span] + position, rows[span], groups[span])
+
+
+def _edge_tiles(ax, ay, bx, by, groups):
+    """
+        Tiles each edge passes through or touches, from its x extent within each row it spans.
+    """
+    (low_y, high_y) = (np.minimum(ay, by), np.maximum(ay, by))
+    first_row = np.floor(low_y).astype(np.int64)
+    rows_spanned = np.floor(high_y).astype(np.int64) - first_row + 1
+
+    edge = np.repeat(np.arange(len(ax)), rows_spanned)
+    rows = first_row[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(rows_spanned) - rows_spanned, rows_spanned)
+
+    # Clip each edge to the band of its row, and take x at both ends of the clipped piece
+    top = np.maximum(rows, low_y[edge])
+    bottom = np.minimum(rows + 1, high_y[edge])
+    (ax, ay, bx, by) = (ax[edge], ay[edge], bx[edge], by[edge])
+    flat = ay == by
+    slope = np.where(flat, 0, (bx - ax) / np.where(flat, 1, by - ay))
+    x_top = np.where(flat, np.minimum(ax, bx), ax + (top - ay) * slope)
+    x_bottom = np.where(flat, np.maximum(ax, bx), ax + (bottom - ay) * slope)
+
+    first = np.floor(np.minimum(x_top, x_bottom)).astype(np.int64)
+    last = np.floor(np.maximum(x_top, x_bottom)).astype(np.int64)
+    return _expand_spans(rows, first, last, groups[edge])
+
+
+def _interior_tiles(ax, ay, bx, by, groups):
+    """
+        Tiles whose centre is inside under the even-odd rule, from the sorted crossings of each
+        row within each group of rings.
+    """
+    # Rows whose centre line y = row + 0.5 an edge crosses, counting its lower end but not its upper
+    (low_y, high_y) = (np.minimum(ay, by), np.maximum(ay, by))
+    first_row = np.ceil(low_y - 0.5).astype(np.int64)
+    rows_crossed = np.maximum(np.ceil(high_y - 0.5).astype(np.int64) - first_row, 0)
+
+    edge = np.repeat(np.arange(len(ax)), rows_crossed)
+    rows = first_row[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(rows_crossed) - rows_crossed, rows_crossed)
+    crossings = ax[edge] + (rows + 0.5 - ay[edge]) * (bx[edge] - ax[edge]) / (by[edge] - ay[edge])
+
+    # Every row of a group has an even number of crossings, and each pair bounds a run inside
+    groups = groups[edge]
+    order = np.lexsort((crossings, rows, groups))
+    (rows, crossings, groups) = (rows[order], crossings[order], groups[order])
+    (enter, leave) = (crossings[0::2], crossings[1::2])
+
+    first = np.ceil(enter - 0.5).astype(np.int64)
+    last = np.ceil(leave - 0.5).astype(np.int64) - 1
+    return _expand_spans(rows[0::2], first, last, groups[0::2])
+
+
+def tiles_intersecting(geometry, level_of_detail):
+    """
+        (tile_x, tile_y) of every tile that intersects the geometry, each once, in quadkey order.
+    """
+    scale = 1 << level_of_detail
+    (ax, ay, bx, by) = _edges(geometry_rings(geometry), scale)
+    groups = np.zeros(len(ax), dtype=np.int64)
+
+    (edge_x, edge_y, _) = _edge_tiles(ax, ay, bx, by, groups)
+    (inside_x, inside_y, _) = _interior_tiles(ax, ay, bx, by, groups)
+    tile_x = np.clip(np.concatenate([edge_x, inside_x]), 0, scale - 1)
+    tile_y = np.clip(np.concatenate([edge_y, inside_y]), 0, scale - 1)
+
+    codes = np.unique(quadkeys.tile_xy_to_code(tile_x, tile_y))
+    return quadkeys.code_to_tile_xy(codes)
+
+
+def polygon_tile_pairs(x, y, offsets):
+    """
+        (polygon_index, tile_x, tile_y) of every tile each of many polygons intersects, each pair
+        once, sorted by polygon. Vertices are in fractional tile coordinates, polygon i's ring at
+        offsets[i]:offsets[i + 1], closed or not.
+    """
+    lengths = np.diff(offsets)
+    following = np.arange(1, len(x) + 1)
+    following[offsets[1:][lengths > 0] - 1] = offsets[:-1][lengths > 0]
+    groups = np.repeat(np.arange(len(lengths)), lengths)
+
+    (ax, ay, bx, by) = (x, y, x[following], y[following])
+    (edge_x, edge_y, edge_group) = _edge_tiles(ax, ay, bx, by, groups)
+    (inside_x, inside_y, inside_group) = _interior_tiles(ax, ay, bx, by, groups)
+
+    pairs = np.unique(np.stack([np.concatenate([edge_group, inside_group]), np.concatenate([edge_y, inside_y]),
+                                np.concatenate([edge_x, inside_x])], axis=1), axis=0)
+    return (pairs[:, 0], pairs[:, 2], pairs[:, 1])
+
+
+def quadkeys_intersecting(geometry, level_of_detail):
+    """
+        Quadkeys of every tile that intersects the geometry, in quadkey order.
+    """
+    (tile_x, tile_y) = tiles_intersecting(geometry, level_of_detail)
+    return bingmaps.tile_xy_to_quadkey_batch(tile_x, tile_y, level_of_detail).tolist()
+
+
+def points_in_geometry(latitudes, longitudes, geometry):
+    """
+        For each point, True when it is inside the geometry under the even-odd rule.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    inside = np.zeros(latitudes.shape, dtype=bool)
+
+    for ring in geometry_rings(geometry):
+        for ((lon_a, lat_a), (lon_b, lat_b)) in zip(ring[:-1], ring[1:]):
+            if lat_a == lat_b:
+                continue
+            crosses = (lat_a > latitudes) != (lat_b > latitudes)
+            crossing_lon = lon_a + (latitudes - lat_a) * (lon_b - lon_a) / (lat_b - lat_a)
+            inside ^= crosses & (longitudes < crossing_lon)
+
+    return inside
+
+
+def geometry_path(task_csv):
+    """
+        Where the geometries of a task csv's irregular tasks are kept, beside it.
+    """
+    return Path(task_csv).with_suffix(GEOMETRY_SUFFIX)
+
+
+def load_geometries(path):
+    """
+        Every geometry in a GeoJSON FeatureCollection, Feature or bare geometry, with each feature's
+        properties, as a list of (properties, geometry).
+    """
+    with open(path) as f:
+        data = json.load(f)
+
+    if data["type"] == "FeatureCollection":
+        return [(feature.get("properties") or {}, feature["geometry"]) for feature in data["features"]]
+    if data["type"] == "Feature":
+        return [(data.get("properties") or {}, data["geometry"])]
+    return [({}, data)]
+
+
+def load_task_geometries(task_csv):
+    """
+        Geometries of a task csv's irregular tasks by task id, empty when it has none.
+    """
+    path = geometry_path(task_csv)
+    if not path.exists():
+        return {}
+    return {str(properties["task_id"]): geometry for (properties, geometry) in load_geometries(path)}
+
+
+def write_task_geometries(out, tasks):
+    """
+        Writes (project_id, task_id, geometry) of each task as a GeoJSON FeatureCollection.
+    """
+    features = [{"type": "Feature", "properties": {"project_id": project_id, "task_id": task_id}, "geometry": geometry}
+                for (project_id, task_id, geometry) in tasks]
+    json.dump({"type": "FeatureCollection", "features": features}, out)
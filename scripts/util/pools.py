@@ -0,0 +1,25 @@
+"""
+    Runs a function over chunks of work on a process pool, in chunk order, with per process state
+    set up once by an initializer, as the tile drawing and pyramid scripts do.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+def chunk_list(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def process_chunks(chunks, workers, initializer, initargs, function):
+    """
+        Yields function(chunk) for each chunk, in chunk order so that output is the same for any
+        worker count. With one worker everything runs in this process, initializer included.
+    """
+    if workers <= 1:
+        initializer(*initargs)
+        for chunk in chunks:
+            yield function(chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            for processed in executor.map(function, chunks):
+                yield processed
@@ -0,0 +1,63 @@
+"""
+    Building a lower zoom level from the one above it: a parent tile covers its four children,
+    quadkey digits 0 to 3 being top left, top right, bottom left and bottom right, so the parent
+    is the 512x512 stitch of the children halved back to 256x256.
+
+    Imagery is averaged over each 2x2 block. Masks are reduced either by majority, a parent pixel
+    being set when at least 2 of its 4 child pixels are, which is close to rasterizing the
+    polygons at the lower zoom, or by any, which keeps buildings smaller than a pixel.
+"""
+
+import cv2
+import numpy as np
+
+TILE_SIZE = 256
+MASK_REDUCTIONS = ["majority", "any"]
+
+
+def parent_quadkeys(quadkeys):
+    """
+        The distinct parents of the given quadkeys, sorted.
+    """
+    return sorted(set(quadkey[:-1] for quadkey in quadkeys if len(quadkey) > 0))
+
+
+def child_quadkeys(quadkey):
+    return [quadkey + digit for digit in "0123"]
+
+
+def stitch(children, fill_shape, dtype=np.uint8):
+    """
+        Places four child arrays, in quadkey digit order, into one array twice their size.
+        Missing children, given as None, are left as zeros.
+    """
+    stitched = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE) + tuple(fill_shape), dtype)
+
+    for (digit, child) in enumerate(children):
+        if child is not None:
+            (row, column) = divmod(digit, 2)
+            stitched[row * TILE_SIZE:(row + 1) * TILE_SIZE, column * TILE_SIZE:(column + 1) * TILE_SIZE] = child
+
+    return stitched
+
+
+def downsample_tile(children):
+    """
+        A 256x256x3 parent image from up to four 256x256x3 child images.
+    """
+    return cv2.resize(stitch(children, (3,)), (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def downsample_mask(children, reduction="majority"):
+    """
+        A 256x256 0/1 parent mask from up to four 256x256 0/1 child masks.
+    """
+    stitched = stitch(children, ())
+    counts = stitched[0::2, 0::2] + stitched[0::2, 1::2] + stitched[1::2, 0::2] + stitched[1::2, 1::2]
+
+    if reduction == "majority":
+        return (counts >= 2).astype(np.uint8)
+    if reduction == "any":
+        return (counts >= 1).astype(np.uint8)
+
+    raise ValueError("Unknown mask reduction %s, expected one of %s" % (reduction, MASK_REDUCTIONS))
@@ -0,0 +1,212 @@
+"""
+    Integer quadkeys.
+
+    A quadkey string is a base-4 number whose digits interleave the bits of tile_x and tile_y,
+    so the same information fits in a Morton-interleaved integer: int(quadkey, 4) == code.
+    To keep several levels in one sortable column we pack the code left-aligned to MAX_LEVEL
+    with the level in the low bits:
+
+        packed = (code << 2 * (MAX_LEVEL - level) << LEVEL_BITS) | level
+
+    Sorting packed keys gives depth-first quadtree order (a parent sorts directly before its
+    descendants), and every descendant of a key falls in a contiguous packed range.
+    All functions accept scalars or NumPy arrays.
+"""
+
+import numpy as np
+
+MAX_LEVEL = 29
+LEVEL_BITS = 5
+LEVEL_MASK = (1 << LEVEL_BITS) - 1
+
+
+def _spread_bits(values):
+    """
+        Moves bit i of each 32-bit value to bit 2i.
+    """
+    v = np.asarray(values).astype(np.uint64) & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _compact_bits(values):
+    """
+        Inverse of _spread_bits, gathers the even bits back into the low 32 bits.
+    """
+    v = np.asarray(values).astype(np.uint64) & np.uint64(0x5555555555555555)
+    v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+    return v
+
+
+def _check_level(level):
+    if np.any(np.asarray(level) < 0) or np.any(np.asarray(level) > MAX_LEVEL):
+        raise ValueError("Level of detail must be between 0 and %s, got %s" % (MAX_LEVEL, level))
+
+
+def tile_xy_to_code(tile_x, tile_y):
+    """
+        Morton code of a tile, equal to the quadkey read as a base-4 number.
+    """
+    return _spread_bits(tile_x) | (_spread_bits(tile_y) << np.uint64(1))
+
+
+def code_to_tile_xy(codes):
+    codes = np.asarray(codes, dtype=np.uint64)
+    tile_x = _compact_bits(codes).astype(np.int64)
+    tile_y = _compact_bits(codes >> np.uint64(1)).astype(np.int64)
+    return (tile_x, tile_y)
+
+
+def pack(codes, level):
+    _check_level(level)
+    shift = (2 * (MAX_LEVEL - np.asarray(level, dtype=np.uint64)) + LEVEL_BITS).astype(np.uint64)
+    return (np.asarray(codes, dtype=np.uint64) << shift) | np.asarray(level, dtype=np.uint64)
+
+
+def unpack(packed):
+    """
+        Returns (codes, levels) for packed keys.
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    levels = packed & np.uint64(LEVEL_MASK)
+    shift = (2 * (MAX_LEVEL - levels) + LEVEL_BITS).astype(np.uint64)
+    return (packed >> shift, levels.astype(np.int64))
+
+
+def encode(tile_x, tile_y, level_of_detail):
+    return pack(tile_xy_to_code(tile_x, tile_y), level_of_detail)
+
+
+def decode(packed):
+    """
+        Returns (tile_x, tile_y, level_of_detail) for packed keys.
+    """
+    (codes, levels) = unpack(packed)
+    (tile_x, tile_y) = code_to_tile_xy(codes)
+    return (tile_x, tile_y, levels)
+
+
+def level_of(packed):
+    return (np.asarray(packed, dtype=np.uint64) & np.uint64(LEVEL_MASK)).astype(np.int64)
+
+
+def from_quadkey(quadkey):
+    """
+        Packed key for a single quadkey string.
+    """
+    if len(quadkey) > MAX_LEVEL or quadkey.strip("0123") != "":
+        raise ValueError("Invalid quadkey digit sequence: %s" % quadkey)
+
+    code = int(quadkey, 4) if quadkey else 0
+    return pack(code, len(quadkey))[()]
+
+
+def to_quadkey(packed):
+    """
+        Quadkey string for a single packed key.
+    """
+    (code, level) = unpack(packed)
+    level = int(level)
+    if level == 0:
+        return ""
+    return np.base_repr(int(code), 4).zfill(level)
+
+
+def from_quadkeys(quadkeys):
+    """
+        Packed keys for an array of quadkey strings, which may be of different lengths.
+    """
+    quadkeys = np.asarray(quadkeys, dtype="S")
+    if quadkeys.size == 0:
+        return np.zeros(quadkeys.shape, dtype=np.uint64)
+
+    width = quadkeys.dtype.itemsize
+    characters = np.frombuffer(quadkeys.tobytes(), dtype=np.uint8).reshape(quadkeys.shape + (width,))
+    present = characters != 0
+    digits = characters.astype(np.int64) - ord("0")
+
+    if np.any(present & ((digits < 0) | (digits > 3))):
+        raise ValueError("Invalid quadkey digit sequence in input")
+
+    levels = present.sum(axis=-1)
+    _check_level(levels)
+
+    codes = np.zeros(quadkeys.shape, dtype=np.uint64)
+    for i in range(width):
+        column = present[..., i]
+        codes = np.where(column, (codes << np.uint64(2)) | digits[..., i].astype(np.uint64), codes)
+
+    return pack(codes, levels)
+
+
+def to_quadkeys(packed):
+    """
+        Quadkey strings for an array of packed keys.
+    """
+    (codes, levels) = unpack(packed)
+    width = max(int(levels.max()) if levels.size else 0, 1)
+
+    shifts = 2 * (levels[..., None] - 1 - np.arange(width)).astype(np.int64)
+    valid = shifts >= 0
+    digits = (codes[..., None] >> np.where(valid, shifts, 0).astype(np.uint64)) & np.uint64(3)
+    characters = np.where(valid, digits + ord("0"), 0).astype(np.uint8)
+
+    return np.ascontiguousarray(characters).view("S%s" % width)[..., 0].astype("U%s" % width)
+
+
+def parent(packed, levels_up=1):
+    (codes, levels) = unpack(packed)
+    if np.any(levels < levels_up):
+        raise ValueError("Cannot take the parent of a level %s quadkey" % levels.min())
+    return pack(codes >> np.uint64(2 * levels_up), levels - levels_up)
+
+
+def children(packed):
+    """
+        Returns the four children of each key, in quadkey digit order, along a new last axis.
+    """
+    (codes, levels) = unpack(packed)
+    if np.any(levels >= MAX_LEVEL):
+        raise ValueError("Cannot take children below level %s" % MAX_LEVEL)
+    child_codes = (codes[..., None] << np.uint64(2)) | np.arange(4, dtype=np.uint64)
+    return pack(child_codes, levels[..., None] + 1)
+
+
+def descendant_range(packed):
+    """
+        Half open range [low, high) of packed keys holding the key itself and all of its descendants,
+        at any level. Use with np.searchsorted over a sorted packed column for prefix queries.
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    levels = level_of(packed)
+    span = (np.uint64(1) << (2 * (MAX_LEVEL - levels) + LEVEL_BITS).astype(np.uint64))
+    low = packed & ~np.uint64(LEVEL_MASK)
+    return (low, low + span)
+
+
+def code_range_at_level(codes, level, target_level):
+    """
+        Half open range of unpacked codes at target_level that descend from codes at level.
+    """
+    if target_level < level:
+        raise ValueError("Target level %s is above level %s" % (target_level, level))
+    shift = np.uint64(2 * (target_level - level))
+    codes = np.asarray(codes, dtype=np.uint64)
+    return (codes << shift, (codes + np.uint64(1)) << shift)
+
+
+def is_ancestor(ancestor, packed):
+    """
+        True where ancestor is packed itself or one of its ancestors.
+    """
+    (low, high) = descendant_range(ancestor)
+    packed = np.asarray(packed, dtype=np.uint64)
+    return (packed >= low) & (packed < high)
@@ -0,0 +1,205 @@
+"""
+    Sharded sequential training datasets.
+
+    Each sample is one record holding its quadkey, project and task, the map tile's bytes and the
+    encoded mask. Records are appended into shard files of about shard_bytes each, so training reads
+    a few large files front to back rather than two small files per sample. An index of
+    (packed quadkey, project, task, shard, offset, length) per split gives random access by quadkey.
+
+    Samples are split into train, validation and test by task, so that neighbouring tiles from one
+    task never land on both sides of a split:
+
+        <folder>/dataset.json
+        <folder>/<split>/shard-00000.bin ...
+        <folder>/<split>/index.bin
+"""
+
+from pathlib import Path
+
+import hashlib
+import json
+import mmap
+
+import numpy as np
+
+from util import quadkeys
+
+SPLITS = ["train", "validation", "test"]
+DEFAULT_SPLIT_FRACTIONS = (0.8, 0.1, 0.1)
+DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+RECORD_HEADER_DTYPE = np.dtype([("key", "<u8"), ("project_id", "<i8"), ("task_id", "<i8"),
+                                ("tile_length", "<u4"), ("mask_length", "<u4")])
+INDEX_DTYPE = np.dtype([("key", "<u8"), ("project_id", "<i8"), ("task_id", "<i8"),
+                        ("shard", "<u4"), ("offset", "<u8"), ("length", "<u4")])
+INDEX_FILE = "index.bin"
+METADATA_FILE = "dataset.json"
+
+
+def split_for_task(project_id, task_id, fractions=DEFAULT_SPLIT_FRACTIONS, seed=0):
+    """
+        Deterministically assigns a task to a split by hashing its ids, so a task's samples all
+        share one split whatever order they are written in.
+    """
+    digest = hashlib.sha1(("%s:%s:%s" % (seed, project_id, task_id)).encode("utf-8")).digest()
+    position = int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    cumulative = 0
+    for (split, fraction) in zip(SPLITS, fractions):
+        cumulative = cumulative + fraction
+        if position < cumulative:
+            return split
+
+    return SPLITS[-1]
+
+
+def _shard_path(folder, shard):
+    return Path(folder) / ("shard-%05d.bin" % shard)
+
+
+class _SplitWriter:
+
+    def __init__(self, folder, shard_bytes):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.shard_bytes = shard_bytes
+        self.index = open(self.folder / INDEX_FILE, "wb")
+        self.shard = 0
+        self.out = open(_shard_path(self.folder, self.shard), "wb")
+        self.count = 0
+
+    def write(self, key, project_id, task_id, tile, mask):
+        if self.out.tell() > 0 and self.out.tell() + RECORD_HEADER_DTYPE.itemsize + len(tile) + len(mask) > self.shard_bytes:
+            self.out.close()
+            self.shard = self.shard + 1
+            self.out = open(_shard_path(self.folder, self.shard), "wb")
+
+        offset = self.out.tell()
+        header = np.array([(key, project_id, task_id, len(tile), len(mask))], dtype=RECORD_HEADER_DTYPE)
+        self.out.write(header.tobytes())
+        self.out.write(tile)
+        self.out.write(mask)
+
+        length = self.out.tell() - offset
+        self.index.write(np.array([(key, project_id, task_id, self.shard, offset, length)], dtype=INDEX_DTYPE).tobytes())
+        self.count = self.count + 1
+
+    def close(self):
+        self.out.close()
+        self.index.close()
+
+
+class ShardedDatasetWriter:
+
+    def __init__(self, folder, mask_format, shard_bytes=DEFAULT_SHARD_BYTES, fractions=DEFAULT_SPLIT_FRACTIONS, seed=0):
+        if abs(sum(fractions) - 1) > 1e-9 or len(fractions) != len(SPLITS):
+            raise ValueError("Expected %s split fractions summing to 1, got %s" % (len(SPLITS), fractions))
+
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.mask_format = mask_format
+        self.fractions = tuple(fractions)
+        self.seed = seed
+        self.writers = dict((split, _SplitWriter(self.folder / split, shard_bytes)) for split in SPLITS)
+
+    def write(self, quadkey, project_id, task_id, tile, mask):
+        split = split_for_task(project_id, task_id, self.fractions, self.seed)
+        self.writers[split].write(quadkeys.from_quadkey(quadkey), int(project_id), int(task_id), tile, mask)
+        return split
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+        metadata = {
+            "mask_format": self.mask_format,
+            "fractions": self.fractions,
+            "seed": self.seed,
+            "counts": dict((split, writer.count) for (split, writer) in self.writers.items())
+        }
+        with open(self.folder / METADATA_FILE, "w") as out:
+            json.dump(metadata, out)
+
+
+class ShardedDatasetReader:
+    """
+        Reads one split. Iterating streams records shard by shard in write order, reading one
+        record at a time; get() looks a quadkey up through the index and a memory map of its shard.
+        Records come back as (quadkey, project_id, task_id, tile bytes, mask bytes).
+    """
+
+    def __init__(self, folder, split="train"):
+        self.folder = Path(folder) / split
+        with open(Path(folder) / METADATA_FILE) as f:
+            self.metadata = json.load(f)
+        self.mask_format = self.metadata["mask_format"]
+
+        index = np.fromfile(self.folder / INDEX_FILE, dtype=INDEX_DTYPE)
+        order = np.argsort(index["key"], kind="stable")
+        self.index = index[order]
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def quadkeys(self):
+        return quadkeys.to_quadkeys(self.index["key"]).tolist() if len(self.index) > 0 else []
+
+    def _map(self, shard):
+        if shard not in self.maps:
+            with open(_shard_path(self.folder, shard), "rb") as f:
+                self.maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def _parse(self, data, offset):
+        header = np.frombuffer(data, dtype=RECORD_HEADER_DTYPE, count=1, offset=offset)[0]
+        tile_start = offset + RECORD_HEADER_DTYPE.itemsize
+        mask_start = tile_start + int(header["tile_length"])
+        end = mask_start + int(header["mask_length"])
+
+        record = (quadkeys.to_quadkey(header["key"]), int(header["project_id"]), int(header["task_id"]),
+                  bytes(data[tile_start:mask_start]), bytes(data[mask_start:end]))
+        return (record, end)
+
+    def get(self, quadkey):
+        key = quadkeys.from_quadkey(quadkey)
+        i = np.searchsorted(self.index["key"], key)
+        if i >= len(self.index) or self.index["key"][i] != key:
+            return None
+
+        entry = self.index[i]
+        (record, _) = self._parse(self._map(int(entry["shard"])), int(entry["offset"]))
+        return record
+
+    def _read(self, f, path):
+        """
+            The next record from an open shard, or None at its end.
+        """
+        header = f.read(RECORD_HEADER_DTYPE.itemsize)
+        if len(header) == 0:
+            return None
+        if len(header) < RECORD_HEADER_DTYPE.itemsize:
+            raise ValueError("Found a truncated record in %s" % path)
+
+        header = np.frombuffer(header, dtype=RECORD_HEADER_DTYPE)[0]
+        tile = f.read(int(header["tile_length"]))
+        mask = f.read(int(header["mask_length"]))
+        if len(tile) != header["tile_length"] or len(mask) != header["mask_length"]:
+            raise ValueError("Found a truncated record in %s" % path)
+
+        return (quadkeys.to_quadkey(header["key"]), int(header["project_id"]), int(header["task_id"]), tile, mask)
+
+    def __iter__(self):
+        shard = 0
+        while _shard_path(self.folder, shard).exists():
+            path = _shard_path(self.folder, shard)
+            with open(path, "rb") as f:
+                record = self._read(f, path)
+                while record is not None:
+                    yield record
+                    record = self._read(f, path)
+            shard = shard + 1
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
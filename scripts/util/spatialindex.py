@@ -0,0 +1,221 @@
+"""
+    A persistent spatial index over building footprints: a packed R-tree of lat/lon bounding boxes,
+    built once from the collector output and memory mapped for queries.
+
+    An index is a folder holding:
+
+        buildings.bin   every building as a binary building file, sorted along a Z-order curve of
+                        its bounding box centre so neighbouring buildings sit together on disk
+        boxes.npy       float64 (min_lat, min_lon, max_lat, max_lon) of each building, in file order
+        nodes.npy       bounding boxes of the tree's nodes, each covering node_size entries of the
+                        level below, lowest level first
+        index.json      node size, building count and the (offset, count) of each level in nodes.npy
+
+    Queries walk the tree one level at a time, testing every surviving node of a level in one
+    vectorized pass, so only the pages of boxes and polygons near the query are ever read.
+"""
+
+from math import cos, pi
+from pathlib import Path
+
+import heapq
+import json
+
+import numpy as np
+
+from util import bingmaps, buildingfile, quadkeys
+from util.buildings import BuildingTable, take_buildings
+
+BUILDINGS_FILE = "buildings.bin"
+BOXES_FILE = "boxes.npy"
+NODES_FILE = "nodes.npy"
+INDEX_FILE = "index.json"
+DEFAULT_NODE_SIZE = 16
+SORT_LEVEL = 24
+METRES_PER_DEGREE = pi * bingmaps.EARTH_RADIUS / 180
+
+
+def building_boxes(table):
+    starts = table.offsets[:-1]
+    return np.stack([np.minimum.reduceat(table.latitudes, starts), np.minimum.reduceat(table.longitudes, starts),
+                     np.maximum.reduceat(table.latitudes, starts), np.maximum.reduceat(table.longitudes, starts)], axis=1)
+
+
+def pack_nodes(boxes, node_size):
+    """
+        Bounding boxes of every tree level above boxes, lowest first, until one root node remains.
+    """
+    levels = []
+    current = boxes
+
+    while len(current) > 1:
+        starts = np.arange(0, len(current), node_size)
+        current = np.stack([np.minimum.reduceat(current[:, 0], starts), np.minimum.reduceat(current[:, 1], starts),
+                            np.maximum.reduceat(current[:, 2], starts), np.maximum.reduceat(current[:, 3], starts)], axis=1)
+        levels.append(current)
+
+    return levels
+
+
+def build_index(folder, table, node_size=DEFAULT_NODE_SIZE, precision=buildingfile.DEFAULT_PRECISION):
+    """
+        Writes an index of every building in table into folder.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+
+    boxes = building_boxes(table) if len(table.way_ids) > 0 else np.zeros((0, 4))
+    (tile_x, tile_y) = bingmaps.lat_lon_to_tile_xy_batch((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2, SORT_LEVEL)
+    order = np.argsort(quadkeys.tile_xy_to_code(tile_x, tile_y), kind="stable")
+
+    buildingfile.write_buildings_binary(folder / BUILDINGS_FILE, take_buildings(table, order), precision)
+    boxes = boxes[order]
+    np.save(folder / BOXES_FILE, boxes)
+
+    levels = pack_nodes(boxes, node_size)
+    np.save(folder / NODES_FILE, np.concatenate(levels) if levels else np.zeros((0, 4)))
+
+    offsets = np.cumsum([0] + [len(level) for level in levels])
+    index = {"node_size": node_size, "buildings": len(boxes),
+             "levels": [[int(offset), len(level)] for (offset, level) in zip(offsets, levels)]}
+    with open(folder / INDEX_FILE, "w") as out:
+        json.dump(index, out, indent=2)
+
+
+def _box_distances(boxes, latitude, longitude, scale):
+    """
+        Metres from a point to each box, 0 inside, on a local equirectangular projection.
+    """
+    dlat = np.maximum(np.maximum(boxes[:, 0] - latitude, latitude - boxes[:, 2]), 0)
+    dlon = np.maximum(np.maximum(boxes[:, 1] - longitude, longitude - boxes[:, 3]), 0)
+    return METRES_PER_DEGREE * np.hypot(dlat, dlon * scale)
+
+
+def polygon_distance(latitudes, longitudes, latitude, longitude):
+    """
+        Metres from a point to a polygon, treated as a closed ring, 0 when the point is inside.
+    """
+    scale = cos(latitude * pi / 180)
+    x = (np.asarray(longitudes) - longitude) * scale * METRES_PER_DEGREE
+    y = (np.asarray(latitudes) - latitude) * METRES_PER_DEGREE
+    (next_x, next_y) = (np.roll(x, -1), np.roll(y, -1))
+
+    # Point in polygon by counting edge crossings of a ray from the point along +x
+    crossing = (y > 0) != (next_y > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intersect_x = x + (0 - y) * (next_x - x) / (next_y - y)
+    if np.count_nonzero(crossing & (intersect_x > 0)) % 2 == 1:
+        return 0.0
+
+    (edge_x, edge_y) = (next_x - x, next_y - y)
+    lengths = edge_x * edge_x + edge_y * edge_y
+    along = np.clip(-(x * edge_x + y * edge_y) / np.where(lengths > 0, lengths, 1), 0, 1)
+    return float(np.min(np.hypot(x + along * edge_x, y + along * edge_y)))
+
+
+class SpatialIndex:
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        if not (self.folder / INDEX_FILE).exists():
+            raise FileNotFoundError("No spatial index found at %s" % self.folder)
+
+        with open(self.folder / INDEX_FILE) as index_file:
+            index = json.load(index_file)
+
+        self.node_size = index["node_size"]
+        self.boxes = np.load(self.folder / BOXES_FILE, mmap_mode="r")
+        nodes = np.load(self.folder / NODES_FILE, mmap_mode="r")
+        self.levels = [nodes[offset:offset + count] for (offset, count) in index["levels"]]
+        (self.precision, self.columns) = buildingfile.map_buildings_binary(self.folder / BUILDINGS_FILE)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _level_boxes(self, level):
+        """
+            Level 0 is the buildings themselves, the last level the root.
+        """
+        return self.boxes if level == 0 else self.levels[level - 1]
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+            Indices, in file order, of every building whose bounding box intersects the box.
+        """
+        if len(self.boxes) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        candidates = np.arange(len(self._level_boxes(len(self.levels))))
+
+        for level in range(len(self.levels), -1, -1):
+            boxes = self._level_boxes(level)[candidates]
+            hits = candidates[(boxes[:, 0] <= max_lat) & (boxes[:, 2] >= min_lat) & (boxes[:, 1] <= max_lon) & (boxes[:, 3] >= min_lon)]
+
+            if level == 0:
+                return hits
+
+            children = (hits[:, None] * self.node_size + np.arange(self.node_size)).ravel()
+            candidates = children[children < len(self._level_boxes(level - 1))]
+
+    def query_quadkey(self, quadkey):
+        """
+            Indices of every building whose bounding box touches the quadkey's tile.
+        """
+        (tile_x, tile_y, level) = bingmaps.quadkey_to_tile_xy(quadkey)
+        size = bingmaps.BING_TILE_SIZE_PIXELS
+        (max_lat, min_lon) = bingmaps.pixel_xy_to_lat_lon(tile_x * size, tile_y * size, level)
+        (min_lat, max_lon) = bingmaps.pixel_xy_to_lat_lon((tile_x + 1) * size, (tile_y + 1) * size, level)
+        return self.query_bbox(min_lat, min_lon, max_lat, max_lon)
+
+    def nearest(self, latitude, longitude, count=1, max_distance=None):
+        """
+            Up to count (index, metres) of the buildings nearest a point, nearest first, measured to
+            their footprints. Walks the tree best first, so only nodes closer than the answer are opened.
+        """
+        scale = cos(latitude * pi / 180)
+        top = len(self.levels)
+        heap = []
+        nearest = []
+
+        if len(self.boxes) > 0:
+            for (i, distance) in enumerate(_box_distances(self._level_boxes(top), latitude, longitude, scale)):
+                heapq.heappush(heap, (distance, top, i, False))
+
+        # Entries are (metres, level, index, exact); a building is pushed again with its exact distance
+        while heap and len(nearest) < count:
+            (distance, level, i, exact) = heapq.heappop(heap)
+
+            if max_distance is not None and distance > max_distance:
+                break
+
+            if exact:
+                nearest.append((i, distance))
+            elif level == 0:
+                (latitudes, longitudes) = buildingfile.read_polygon((self.precision, self.columns), i)
+                heapq.heappush(heap, (polygon_distance(latitudes, longitudes, latitude, longitude), 0, i, True))
+            else:
+                children = np.arange(i * self.node_size, min((i + 1) * self.node_size, len(self._level_boxes(level - 1))))
+                for (child, child_distance) in zip(children, _box_distances(self._level_boxes(level - 1)[children], latitude, longitude, scale)):
+                    heapq.heappush(heap, (child_distance, level - 1, int(child), False))
+
+        return nearest
+
+    def subset(self, indices):
+        """
+            A BuildingTable of the buildings at indices, e.g. from a query, for the usual table passes.
+        """
+        raw = BuildingTable(self.columns["project_ids"], self.columns["task_ids"], self.columns["way_ids"],
+                            self.columns["latitudes"], self.columns["longitudes"], self.columns["offsets"])
+        taken = take_buildings(raw, indices)
+        scale = 10 ** self.precision
+
+        return taken._replace(latitudes=buildingfile.delta_decode(taken.latitudes, taken.offsets) / scale,
+                              longitudes=buildingfile.delta_decode(taken.longitudes, taken.offsets) / scale)
+
+    def get(self, i):
+        """
+            (project_id, task_id, way_id, latitudes, longitudes) of building i.
+        """
+        (latitudes, longitudes) = buildingfile.read_polygon((self.precision, self.columns), i)
+        return (int(self.columns["project_ids"][i]), int(self.columns["task_ids"][i]), int(self.columns["way_ids"][i]),
+                latitudes, longitudes)
@@ -0,0 +1,183 @@
+"""
+    Local stand-ins for the remote services, built on http.server, so fetching can be checked
+    offline against failures that are hard to provoke on demand.
+
+    A TileServer serves a JPEG per quadkey at <url>a<quadkey>.jpeg, the way Bing's tile urls end.
+    Each quadkey can be given a script of faults, one per request in turn, after which it is
+    served whole:
+
+        ("status", code, retry_after)   an empty response with that status, and a Retry-After
+                                        header unless retry_after is None
+        ("drop", size)                  the full Content-Length, then the connection closed after
+                                        size bytes of the body
+        ("truncated", size)             only the first size bytes, as a complete response
+        ("placeholder",)                a no imagery placeholder, marked as Bing marks them
+
+    An OverpassServer answers the building queries collect_building_geometries.py posts with
+    canned JSON, the nodes and ways of every canned building with a node inside the query's
+    bounding box. Faults are applied to its first requests in turn, whatever they ask for, and a
+    query whose bounding box is larger than max_area square degrees is answered as Overpass
+    answers a timeout: HTTP 200, half of the elements and a "runtime error" remark.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote_plus
+
+import json
+import re
+import socket
+import threading
+
+PLACEHOLDER_TILE = b"\xff\xd8standin placeholder\xff\xd9"
+OVERPASS_TIMEOUT_REMARK = 'runtime error: Query timed out in "query" at line 3 after 25 seconds.'
+_BOUNDING_BOX = re.compile(r"\(\s*([-\d.]+),\s*([-\d.]+),\s*([-\d.]+),\s*([-\d.]+)\s*\)")
+
+
+class StandInServer:
+    """
+        Runs a handler class on a free local port in a background thread, as a context manager.
+        The handler reaches the stand-in through self.server.standin.
+    """
+
+    def __init__(self, handler):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s/" % self.server.server_address[1]
+
+    def count_request(self, key):
+        """
+            Counts a request for key, returning how many came before it.
+        """
+        with self.lock:
+            count = self.requests.get(key, 0)
+            self.requests[key] = count + 1
+        return count
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_body(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, code, retry_after=None):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _TileHandler(_StandInHandler):
+
+    def do_GET(self):
+        standin = self.server.standin
+        quadkey = self.path.rpartition("/a")[2].partition(".")[0]
+        if quadkey not in standin.tiles:
+            self.send_status(404)
+            return
+
+        attempt = standin.count_request(quadkey)
+        faults = standin.faults.get(quadkey, [])
+        fault = faults[attempt] if attempt < len(faults) else None
+        tile = standin.tiles[quadkey]
+
+        if fault is None:
+            self.send_body(tile, "image/jpeg")
+        elif fault[0] == "status":
+            self.send_status(fault[1], fault[2])
+        elif fault[0] == "truncated":
+            self.send_body(tile[:fault[1]], "image/jpeg")
+        elif fault[0] == "placeholder":
+            self.send_body(PLACEHOLDER_TILE, "image/jpeg", {"X-VE-Tile-Info": "no-tile"})
+        elif fault[0] == "drop":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(tile)))
+            self.end_headers()
+            self.wfile.write(tile[:fault[1]])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+        else:
+            raise ValueError("Unknown stand-in fault %s" % (fault,))
+
+
+class TileServer(StandInServer):
+    """
+        Serves tiles, a dict of quadkey to JPEG bytes, with faults, a dict of quadkey to a list of
+        faults, applied to its first requests in turn.
+    """
+
+    def __init__(self, tiles, faults=None):
+        super().__init__(_TileHandler)
+        self.tiles = tiles
+        self.faults = faults or {}
+
+
+class _OverpassHandler(_StandInHandler):
+
+    def do_POST(self):
+        standin = self.server.standin
+        query = unquote_plus(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+
+        attempt = standin.count_request("all")
+        if attempt < len(standin.faults):
+            fault = standin.faults[attempt]
+            self.send_status(fault[1], fault[2])
+            return
+
+        (min_lat, min_lon, max_lat, max_lon) = [float(v) for v in _BOUNDING_BOX.search(query).groups()]
+        standin.count_request((min_lat, min_lon, max_lat, max_lon))
+
+        nodes = []
+        ways = []
+        for (way_id, way_nodes) in standin.buildings:
+            if any(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon for (_, lat, lon) in way_nodes):
+                nodes.extend({"type": "node", "id": node_id, "lat": lat, "lon": lon} for (node_id, lat, lon) in way_nodes)
+                ways.append({"type": "way", "id": way_id, "nodes": [node_id for (node_id, _, _) in way_nodes]})
+
+        response = {"version": 0.6, "generator": "stand-in", "elements": nodes + ways}
+        if standin.max_area is not None and (max_lat - min_lat) * (max_lon - min_lon) > standin.max_area:
+            response["elements"] = response["elements"][:len(response["elements"]) // 2]
+            response["remark"] = OVERPASS_TIMEOUT_REMARK
+
+        self.send_body(json.dumps(response).encode("utf-8"), "application/json")
+
+
+class OverpassServer(StandInServer):
+    """
+        Serves buildings, a list of (way_id, [(node_id, lat, lon), ...]), to Overpass queries.
+        faults is a list of ("status", code, retry_after) applied to the first requests in turn.
+        Requests are counted under "all", and under the (min_lat, min_lon, max_lat, max_lon) each
+        answered query asked for.
+    """
+
+    def __init__(self, buildings, faults=None, max_area=None):
+        super().__init__(_OverpassHandler)
+        self.buildings = buildings
+        self.faults = faults or []
+        self.max_area = max_area
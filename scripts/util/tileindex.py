@@ -0,0 +1,258 @@
+"""
+    A content hash index of map tiles, filled in as each tile is written, so Bing's "no imagery"
+    placeholder tiles, truncated or undecodable JPEGs and exact duplicates are known without
+    reading every tile again.
+
+    The index is an append-only file, tiles.hash, of (packed quadkey, sha1, length, status) records
+    kept beside the tiles it describes. The last record written for a quadkey wins. Digests of known
+    placeholder tiles are kept as hex, one per line, in placeholders.txt beside it, and apply to
+    every tile indexed with that digest, including those indexed before it was added.
+
+    Tiles whose content exactly matches another tile's are flagged as DUPLICATE, all but the copy
+    with the lowest packed quadkey, which stays OK. No two places look exactly alike, so at most one
+    of them can be real imagery of its place. That status is worked out from the whole index when
+    flagged tiles are listed, rather than stored.
+"""
+
+from pathlib import Path
+
+import hashlib
+import threading
+
+import cv2
+import numpy as np
+
+from util import quadkeys
+
+INDEX_FILE = "tiles.hash"
+PLACEHOLDERS_FILE = "placeholders.txt"
+RECORD_DTYPE = np.dtype([("key", "<u8"), ("digest", "V20"), ("length", "<u4"), ("status", "u1")])
+
+OK = 0
+EMPTY = 1
+TRUNCATED = 2
+UNDECODABLE = 3
+PLACEHOLDER = 4
+DUPLICATE = 5
+MISSING = 255
+STATUS_NAMES = {OK: "ok", EMPTY: "empty", TRUNCATED: "truncated", UNDECODABLE: "undecodable", PLACEHOLDER: "placeholder",
+                DUPLICATE: "duplicate"}
+
+# A fresh request usually returns the whole tile, whereas a placeholder stays a placeholder
+REFETCH_STATUSES = (EMPTY, TRUNCATED, UNDECODABLE)
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+TAIL_BYTES = 16
+
+
+class TileDigest:
+    """
+        Hashes a tile as its bytes arrive, keeping its ends to check the JPEG start and end markers.
+    """
+
+    def __init__(self, data=b""):
+        self.sha1 = hashlib.sha1()
+        self.length = 0
+        self.head = b""
+        self.tail = b""
+        self.update(data)
+
+    def update(self, chunk):
+        self.sha1.update(chunk)
+        self.length = self.length + len(chunk)
+        if len(self.head) < len(JPEG_START):
+            self.head = self.head + chunk[:len(JPEG_START) - len(self.head)]
+        self.tail = (self.tail + chunk[-TAIL_BYTES:])[-TAIL_BYTES:]
+
+    def digest(self):
+        return self.sha1.digest()
+
+    def status(self):
+        """
+            EMPTY, TRUNCATED when either JPEG marker is missing, allowing zero padding after the end, or OK.
+        """
+        if self.length == 0:
+            return EMPTY
+        if self.head != JPEG_START or not self.tail.rstrip(b"\x00").endswith(JPEG_END):
+            return TRUNCATED
+        return OK
+
+
+def check_tile(data, decode=False):
+    """
+        (sha1, status) of a tile's bytes. With decode, tiles whose markers look whole are decoded too.
+    """
+    tile = TileDigest(data)
+    status = tile.status()
+
+    if decode and status == OK and cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR) is None:
+        status = UNDECODABLE
+
+    return (tile.digest(), status)
+
+
+def index_exists(folder):
+    return (Path(folder) / INDEX_FILE).exists()
+
+
+class TileIndex:
+
+    def __init__(self, folder, writable=False):
+        self.folder = Path(folder)
+        self.writable = writable
+        self.lock = threading.Lock()
+
+        if writable:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            (self.folder / INDEX_FILE).touch()
+        elif not index_exists(self.folder):
+            raise FileNotFoundError("No tile index found at %s" % self.folder)
+
+        self._load()
+
+        if writable:
+            self.index_out = open(self.folder / INDEX_FILE, "ab")
+
+    def _load(self):
+        raw = (self.folder / INDEX_FILE).read_bytes()
+
+        # Drop a partially written trailing record, then keep the last record for each key
+        usable = len(raw) - len(raw) % RECORD_DTYPE.itemsize
+        records = np.frombuffer(raw[:usable], dtype=RECORD_DTYPE)
+        (keys, first_in_reversed) = np.unique(records["key"][::-1], return_index=True)
+
+        self.records = records[::-1][first_in_reversed]
+        self.appended = {}
+
+        placeholders = self.folder / PLACEHOLDERS_FILE
+        lines = placeholders.read_text().split() if placeholders.exists() else []
+        self.placeholders = set(bytes.fromhex(line) for line in lines)
+
+    def _lookup(self, key):
+        if key in self.appended:
+            return self.appended[key]
+
+        i = np.searchsorted(self.records["key"], key)
+        if i < len(self.records) and self.records["key"][i] == key:
+            return self.records[i]
+
+        return None
+
+    def record(self, quadkey, digest, length, status):
+        """
+            Indexes a tile as written, returning its status, PLACEHOLDER if its digest is a known placeholder.
+        """
+        if not self.writable:
+            raise IOError("Tile index %s was opened read only" % self.folder)
+
+        key = quadkeys.from_quadkey(quadkey)
+        record = np.array([(key, np.void(digest), length, status)], dtype=RECORD_DTYPE)
+
+        with self.lock:
+            self.index_out.write(record.tobytes())
+            self.index_out.flush()
+            self.appended[key] = record[0]
+
+        return self.status(quadkey)
+
+    def add_placeholder(self, digest):
+        if not self.writable:
+            raise IOError("Tile index %s was opened read only" % self.folder)
+
+        with self.lock:
+            if digest in self.placeholders:
+                return
+            self.placeholders.add(digest)
+            with open(self.folder / PLACEHOLDERS_FILE, "a") as out:
+                out.write(digest.hex() + "\n")
+
+    def status(self, quadkey):
+        """
+            The tile's status, or None when it was never indexed.
+        """
+        record = self._lookup(quadkeys.from_quadkey(quadkey))
+        if record is None:
+            return None
+        if record["digest"].tobytes() in self.placeholders:
+            return PLACEHOLDER
+        return int(record["status"])
+
+    def __contains__(self, quadkey):
+        return self._lookup(quadkeys.from_quadkey(quadkey)) is not None
+
+    def __len__(self):
+        return len(self.all_records())
+
+    def all_records(self):
+        """
+            The latest record of every indexed tile, sorted by packed quadkey, with placeholder statuses applied.
+        """
+        records = self.records
+        if len(self.appended) > 0:
+            appended = np.array(list(self.appended.values()), dtype=RECORD_DTYPE)
+            records = np.concatenate([records[~np.isin(records["key"], appended["key"])], appended])
+            records = records[np.argsort(records["key"], kind="stable")]
+        else:
+            records = records.copy()
+
+        if len(self.placeholders) > 0:
+            known = np.array(list(self.placeholders), dtype="V20")
+            records["status"][np.isin(records["digest"], known)] = PLACEHOLDER
+
+        return records
+
+    def statuses(self, tile_quadkeys):
+        """
+            The status of each of many quadkeys at once, MISSING for those never indexed.
+        """
+        records = self.all_records()
+        keys = quadkeys.from_quadkeys(tile_quadkeys)
+        if len(records) == 0:
+            return np.full(len(keys), MISSING, dtype=np.uint8)
+
+        i = np.minimum(np.searchsorted(records["key"], keys), len(records) - 1)
+        return np.where(records["key"][i] == keys, records["status"][i], MISSING).astype(np.uint8)
+
+    def flagged(self):
+        """
+            Quadkeys and records of every tile indexed as anything but OK, or as an exact duplicate
+            of an OK tile with a lower packed quadkey, whose status is then DUPLICATE.
+        """
+        records = self.all_records()
+        ok = np.flatnonzero(records["status"] == OK)
+
+        # Records are sorted by key, so the first record with each digest is the copy kept
+        (_, first, inverse) = np.unique(records["digest"][ok], return_index=True, return_inverse=True)
+        records["status"][ok[first[inverse.ravel()] != np.arange(len(ok))]] = DUPLICATE
+
+        records = records[records["status"] != OK]
+        return (quadkeys.to_quadkeys(records["key"]).tolist() if len(records) > 0 else [], records)
+
+    def duplicates(self, min_count=2):
+        """
+            (digest, quadkeys) of each set of at least min_count OK tiles with identical content, largest first.
+        """
+        records = self.all_records()
+        records = records[records["status"] == OK]
+        if len(records) == 0:
+            return []
+
+        (digests, inverse, counts) = np.unique(records["digest"], return_inverse=True, return_counts=True)
+        keys_by_digest = np.split(records["key"][np.argsort(inverse.ravel(), kind="stable")], np.cumsum(counts)[:-1])
+
+        groups = []
+        for i in np.flatnonzero(counts >= min_count):
+            groups.append((digests[i].tobytes(), quadkeys.to_quadkeys(keys_by_digest[i]).tolist()))
+
+        return sorted(groups, key=lambda group: -len(group[1]))
+
+    def close(self):
+        if self.writable:
+            self.index_out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
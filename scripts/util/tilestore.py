@@ -0,0 +1,153 @@
+"""
+    A packed tile store: every tile's bytes appended to one pack file, plus an append-only index
+    of (packed quadkey, offset, length) records. Reads go through a memory map of the pack file,
+    so looking up a tile costs an index search and a slice rather than a file open.
+
+    A store is a folder holding tiles.pack and tiles.idx. Quadkeys of any zoom level can share
+    one store. Writing the same quadkey twice keeps the latest bytes.
+"""
+
+from pathlib import Path
+
+import mmap
+import os
+import threading
+
+import numpy as np
+
+from util import quadkeys
+
+PACK_FILE = "tiles.pack"
+INDEX_FILE = "tiles.idx"
+INDEX_DTYPE = np.dtype([("key", "<u8"), ("offset", "<u8"), ("length", "<u4")])
+
+
+class TileStore:
+
+    def __init__(self, path, writable=False):
+        self.path = Path(path)
+        self.writable = writable
+        self.lock = threading.Lock()
+        self.map = None
+        self.mapped_size = 0
+
+        if writable:
+            self.path.mkdir(parents=True, exist_ok=True)
+            (self.path / PACK_FILE).touch()
+            (self.path / INDEX_FILE).touch()
+        elif not (self.path / INDEX_FILE).exists():
+            raise FileNotFoundError("No tile store found at %s" % self.path)
+
+        self.pack = open(self.path / PACK_FILE, "r+b" if writable else "rb")
+        self.pack.seek(0, os.SEEK_END)
+        self.pack_size = self.pack.tell()
+
+        self._load_index()
+
+        if writable:
+            self.index_out = open(self.path / INDEX_FILE, "ab")
+
+    def _load_index(self):
+        raw = (self.path / INDEX_FILE).read_bytes()
+
+        # Drop a partially written trailing record, and any record whose data never reached the pack
+        usable = len(raw) - len(raw) % INDEX_DTYPE.itemsize
+        records = np.frombuffer(raw[:usable], dtype=INDEX_DTYPE)
+        records = records[records["offset"] + records["length"] <= self.pack_size]
+
+        # Keep the last record written for each key
+        (keys, first_in_reversed) = np.unique(records["key"][::-1], return_index=True)
+        latest = records[::-1][first_in_reversed]
+
+        self.keys = keys
+        self.offsets = latest["offset"].copy()
+        self.lengths = latest["length"].copy()
+        self.appended = {}
+
+    def _locate(self, key):
+        if key in self.appended:
+            return self.appended[key]
+
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return (int(self.offsets[i]), int(self.lengths[i]))
+
+        return None
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.pack.fileno(), 0, access=mmap.ACCESS_READ) if self.pack_size > 0 else None
+        self.mapped_size = self.pack_size
+
+    def put(self, quadkey, data):
+        if not self.writable:
+            raise IOError("Tile store %s was opened read only" % self.path)
+
+        key = quadkeys.from_quadkey(quadkey)
+        data = bytes(data)
+
+        with self.lock:
+            offset = self.pack_size
+            self.pack.seek(offset)
+            self.pack.write(data)
+            self.pack.flush()
+            self.pack_size = offset + len(data)
+
+            record = np.array([(key, offset, len(data))], dtype=INDEX_DTYPE)
+            self.index_out.write(record.tobytes())
+            self.index_out.flush()
+
+            self.appended[key] = (offset, len(data))
+
+    def get(self, quadkey, default=None):
+        location = self._locate(quadkeys.from_quadkey(quadkey))
+        if location is None:
+            return default
+
+        (offset, length) = location
+        with self.lock:
+            if offset + length > self.mapped_size:
+                self._remap()
+            return self.map[offset:offset + length] if length > 0 else b""
+
+    def __getitem__(self, quadkey):
+        data = self.get(quadkey)
+        if data is None:
+            raise KeyError(quadkey)
+        return data
+
+    def __contains__(self, quadkey):
+        return self._locate(quadkeys.from_quadkey(quadkey)) is not None
+
+    def packed_keys(self):
+        """
+            All packed quadkeys in the store, sorted in quadtree order.
+        """
+        if len(self.appended) == 0:
+            return self.keys.copy()
+        appended = np.fromiter(self.appended.keys(), dtype=np.uint64, count=len(self.appended))
+        return np.union1d(self.keys, appended)
+
+    def quadkeys(self, level_of_detail=None):
+        keys = self.packed_keys()
+        if level_of_detail is not None:
+            keys = keys[quadkeys.level_of(keys) == level_of_detail]
+        return quadkeys.to_quadkeys(keys).tolist() if len(keys) > 0 else []
+
+    def __len__(self):
+        return len(self.packed_keys())
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.pack.close()
+        if self.writable:
+            self.index_out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
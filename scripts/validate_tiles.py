@@ -0,0 +1,134 @@
+"""
+    Checks fetched map tiles against their content hash index. Tiles saved before the index existed
+    are hashed and added to it, then every tile's status comes from the index alone, so a pass over a
+    whole collection reads each tile at most once. Flagged tiles are fetched again, or skipped, by
+    fetch_bing_tiles.py and left out of the training set by generate_training_and_truth.py.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tqdm import tqdm
+from util import metrics, tileindex
+from util.tileindex import TileIndex
+from util.tilestore import TileStore
+
+import csv
+
+import numpy as np
+
+import convert_tiles_to_store
+
+
+def iterate_tiles(folder, store=None, zoom_level=None):
+    """
+        Quadkeys of the tiles in the store, or the loose tiles in folder.
+    """
+    if store is not None:
+        return store.quadkeys(zoom_level)
+
+    matches = (convert_tiles_to_store.TILE_NAME.match(path.name) for path in Path(folder).glob("a*.jpeg"))
+    return [match.group(1) for match in matches if match is not None]
+
+
+def read_tile(folder, quadkey, store=None):
+    if store is not None:
+        return store.get(quadkey)
+
+    return (Path(folder) / ("a%s.jpeg" % quadkey)).read_bytes()
+
+
+def index_tiles(index, folder, tiles, store=None, decode=False):
+    """
+        Hashes every tile missing from the index. With decode, every tile indexed as OK is decoded
+        as well, and re-recorded if it fails. Returns the number of records written.
+    """
+    recorded = 0
+    statuses = index.statuses(tiles)
+    unchecked = statuses == tileindex.MISSING
+    if decode:
+        unchecked |= statuses == tileindex.OK
+
+    for (quadkey, status) in tqdm(zip(np.asarray(tiles)[unchecked], statuses[unchecked]), total=int(unchecked.sum())):
+        data = read_tile(folder, quadkey, store)
+        (digest, checked) = tileindex.check_tile(data, decode)
+
+        if checked != status:
+            index.record(quadkey, digest, len(data), checked)
+            metrics.increment("tiles_indexed", status=tileindex.STATUS_NAMES[checked])
+            recorded = recorded + 1
+
+    return recorded
+
+
+def write_flagged_csv(path, flagged, records):
+    """
+        A row per flagged tile, duplicates included, with its content's digest.
+    """
+    with open(path, "w", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(["quadkey", "status", "digest"])
+
+        for (quadkey, record) in zip(flagged, records):
+            writer.writerow([quadkey, tileindex.STATUS_NAMES[int(record["status"])], record["digest"].tobytes().hex()])
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--mapTiles", dest="mapTiles", default="data/map_tiles",
+                        help="Check the tiles fetch_bing_tiles.py saved under this folder")
+    parser.add_argument("-z", "--zoomLevel", dest="zoomLevel", type=int, required=True,
+                        help="Level of zoom of the tiles to check")
+    parser.add_argument("-s", "--tileStore", dest="tileStore", default=None,
+                        help="Check the tiles in this packed tile store instead of the folder structure")
+    parser.add_argument("--decode", dest="decode", action="store_true",
+                        help="Also decode every tile not already flagged, rather than only checking its JPEG markers")
+    parser.add_argument("--placeholderHash", dest="placeholderHashes", action="append", default=[],
+                        help="Treat tiles with this sha1, in hex, as placeholders, may be repeated")
+    parser.add_argument("--duplicateLimit", dest="duplicateLimit", type=int, default=None,
+                        help="Treat any content shared by at least this many tiles as a placeholder")
+    parser.add_argument("-o", "--flaggedCsv", dest="flaggedCsv", default=None,
+                        help="List flagged tiles, duplicates included, in this csv")
+    metrics.add_metrics_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    exporter = metrics.metrics_from_arguments(args)
+
+    store = TileStore(args.tileStore) if args.tileStore is not None else None
+    folder = Path(args.tileStore) if store is not None else Path(args.mapTiles) / str(args.zoomLevel)
+
+    with TileIndex(folder, writable=True) as index:
+        with metrics.stage("index_tiles"):
+            tiles = iterate_tiles(folder, store, args.zoomLevel)
+            recorded = index_tiles(index, folder, tiles, store, args.decode)
+
+        for digest in args.placeholderHashes:
+            index.add_placeholder(bytes.fromhex(digest))
+
+        if args.duplicateLimit is not None:
+            for (digest, _) in index.duplicates(args.duplicateLimit):
+                index.add_placeholder(digest)
+
+        (flagged, records) = index.flagged()
+        print("Checked %s tiles in %s, indexing %s of them. The index now holds:" % (len(tiles), folder, recorded))
+        print("  %-12s %s" % ("ok", len(index) - len(flagged)))
+        for (status, name) in tileindex.STATUS_NAMES.items():
+            if status != tileindex.OK:
+                print("  %-12s %s" % (name, int((records["status"] == status).sum())))
+
+        duplicates = index.duplicates()
+        for (digest, quadkeys) in duplicates[:5]:
+            print("    %s shared by %s tiles, e.g. %s" % (digest.hex(), len(quadkeys), quadkeys[0]))
+
+        if args.flaggedCsv is not None:
+            write_flagged_csv(args.flaggedCsv, flagged, records)
+
+    if store is not None:
+        store.close()
+
+    if exporter is not None:
+        exporter.close()